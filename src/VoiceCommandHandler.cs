@@ -128,6 +128,13 @@ public class VoiceCommandHandler : MonoBehaviour
         CommandResponse response = JsonUtility.FromJson<CommandResponse>(jsonResponse);
         string command = response.command.ToLower();
 
+        // Nessun comando abbastanza probabile (rumore o parola fuori vocabolario): nessuna azione
+        if (command == "unknown")
+        {
+            Debug.Log($"Comando non riconosciuto (confidenza {response.confidence:F2})");
+            return;
+        }
+
         // Se il gioco  in pausa, ignora tutti i comandi tranne "continua" e "esci"
         if (isGamePaused && command != "continua" && command != "esci")
         {
@@ -251,4 +258,5 @@ public class VoiceCommandHandler : MonoBehaviour
 public class CommandResponse
 {
     public string command;
+    public float confidence;
 }
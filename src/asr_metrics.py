@@ -0,0 +1,95 @@
+from functools import lru_cache
+
+import numpy as np
+
+
+def levenshtein(reference, hypothesis):
+    """
+    Distanza di Levenshtein (sostituzioni + cancellazioni + inserimenti) tra due sequenze qualsiasi
+    (stringhe, liste di parole o di indici). Programmazione dinamica per righe in NumPy: la dipendenza
+    dagli inserimenti nella stessa riga si risolve con un minimo cumulativo.
+    """
+    reference, hypothesis = list(reference), list(hypothesis)
+    if not reference or not hypothesis:
+        return max(len(reference), len(hypothesis))
+    symbols = {symbol: i for i, symbol in enumerate(dict.fromkeys(reference + hypothesis))}
+    ref = np.array([symbols[symbol] for symbol in reference])
+    hyp = np.array([symbols[symbol] for symbol in hypothesis])
+    offsets = np.arange(len(hyp) + 1)
+    row = offsets.copy()
+    for i, symbol in enumerate(ref, start=1):
+        candidates = np.empty_like(row)
+        candidates[0] = i
+        # Cancellazione (riga precedente) o sostituzione/corrispondenza (diagonale)
+        candidates[1:] = np.minimum(row[1:] + 1, row[:-1] + (hyp != symbol))
+        # Inserimento: row[j] = min_k<=j (candidates[k] + j - k)
+        row = np.minimum.accumulate(candidates - offsets) + offsets
+    return int(row[-1])
+
+
+@lru_cache(maxsize=65536)
+def _cached_levenshtein(reference, hypothesis):
+    return levenshtein(reference, hypothesis)
+
+
+def error_rate(hypotheses, references, tokenize):
+    """
+    Errori di Levenshtein sui token diviso il numero di token dei riferimenti. Le distanze sono
+    memorizzate per coppia: con un vocabolario chiuso ogni coppia viene allineata una sola volta.
+    """
+    errors = total = 0
+    for hypothesis, reference in zip(hypotheses, references):
+        reference = tuple(tokenize(reference))
+        errors += _cached_levenshtein(reference, tuple(tokenize(hypothesis)))
+        total += len(reference)
+    return errors / total if total > 0 else 0.0
+
+
+def word_error_rate(hypotheses, references):
+    return error_rate(hypotheses, references, str.split)
+
+
+def char_error_rate(hypotheses, references):
+    return error_rate(hypotheses, references, list)
+
+
+@lru_cache(maxsize=8)
+def distance_tables(labels):
+    """
+    Distanze precalcolate tra tutte le coppie del vocabolario (tupla di etichette):
+    [ipotesi, riferimento] in parole e in caratteri, piu' la lunghezza di ogni riferimento.
+    """
+    words = np.array([[levenshtein(ref.split(), hyp.split()) for ref in labels] for hyp in labels])
+    chars = np.array([[levenshtein(ref, hyp) for ref in labels] for hyp in labels])
+    return words, chars, np.array([len(label.split()) for label in labels]), np.array([len(label) for label in labels])
+
+
+def label_error_rates(predictions, targets, labels):
+    """WER e CER di array di indici di etichette: una lettura delle tabelle per coppia, senza allineamenti."""
+    if len(targets) == 0:
+        return 0.0, 0.0
+    words, chars, ref_words, ref_chars = distance_tables(tuple(labels))
+    wer = words[predictions, targets].sum() / ref_words[targets].sum()
+    cer = chars[predictions, targets].sum() / ref_chars[targets].sum()
+    return float(wer), float(cer)
+
+
+def confusion_matrix(predictions, targets, num_classes):
+    """Matrice di confusione [target, predizione] calcolata con un solo np.bincount."""
+    counts = np.bincount(targets * num_classes + predictions, minlength=num_classes * num_classes)
+    return counts.reshape(num_classes, num_classes)
+
+
+def compute_metrics(predictions, targets, labels):
+    """Accuratezza, matrice di confusione, WER e CER vettorizzati su array di indici."""
+    correct = predictions == targets
+    total = len(targets)
+    wer, cer = label_error_rates(predictions, targets, labels)
+    return {
+        'total': total,
+        'correct': int(correct.sum()),
+        'accuracy': float(correct.mean()) * 100 if total > 0 else 0.0,
+        'confusion_matrix': confusion_matrix(predictions, targets, len(labels)),
+        'wer': wer,
+        'cer': cer,
+    }
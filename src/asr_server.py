@@ -1,15 +1,33 @@
-from flask import Flask, request, jsonify
-from nemo.collections.asr.models import ASRModel
+from flask import Flask, Response, request, jsonify, stream_with_context
+from inference import UNKNOWN_COMMAND, decode_audio, load_classifier, quantized_path
+from batching import MicroBatcher
+from audio_archive import AudioArchiver
+from prefork import serve_prefork
+from prediction_cache import PredictionCache, audio_fingerprint, model_fingerprint
+from telemetry import Registry, SharedSnapshots, configure_logging, timed
+from vad import EnergyVAD
+import numpy as np
+import soundfile as sf
+import argparse
+import atexit
+import io
+import json
+import logging
 import os
-import uuid
 import shutil
+import tarfile
+import tempfile
+import time
+from collections import deque
+import torch
 
-app = Flask(__name__)
+try:
+    from flask_sock import Sock
+except ImportError:  # Lo streaming WebSocket e' opzionale
+    Sock = None
 
-# Carica il modello .nemo
-print("Caricamento del modello...")
-model = ASRModel.restore_from("../asr_model2.nemo")
-print("Modello caricato correttamente.")
+app = Flask(__name__)
+sock = Sock(app) if Sock is not None else None
 
 labels = [
     "avanti", "indietro", "sinistra", "destra",
@@ -20,60 +38,376 @@ labels = [
 
 # Directory di destinazione per salvare gli audio
 SAVED_AUDIO_DIR = "./saved_audio"
-os.makedirs(SAVED_AUDIO_DIR, exist_ok=True)  # Crea la cartella se non esiste
 
-def generate_unique_filename(base_name, extension, directory):
-    """Genera un nome unico per il file nella directory specificata."""
-    counter = 1
-    file_name = f"{base_name}.{extension}"
-    file_path = os.path.join(directory, file_name)
-    
-    while os.path.exists(file_path):
-        file_name = f"{base_name}_{counter}.{extension}"
-        file_path = os.path.join(directory, file_name)
-        counter += 1
+# Modello caricato (in load_model) e scheduler di micro-batching tra Flask e il modello (in start_batcher)
+classifier = None
+batcher = None
+# Archiviazione asincrona degli audio ricevuti (inizializzata in start_archiver)
+archiver = None
+# Risultati gia' calcolati dal modello di questo processo, indicizzati dall'impronta del PCM (configurata in configure_cache)
+prediction_cache = PredictionCache()
+# Parametri del VAD per le connessioni di streaming (sovrascrivibili da riga di comando)
+vad_options = {}
+# Comandi restituiti con la loro probabilita' e soglia sotto cui la risposta e' "unknown" (0 = mai, default)
+decision_options = {'top_k': 3, 'threshold': 0.0}
+# Le risposte "unknown" vengono archiviate come unknown*.wav, separate dai comandi riconosciuti
+archive_options = {'rejected': True}
+# Clip lette e accodate al modello per volta da /predict_batch
+batch_chunk_size = 64
+
+# Log strutturato (JSON su stderr da un thread dedicato, configurato in ogni worker) e metriche per /metrics
+log = logging.getLogger("asr_server")
+metrics = Registry()
+# Con piu' worker pre-fork: snapshot delle metriche di questo processo, letto dagli altri worker (in init_worker)
+metrics_snapshots = None
+stage_seconds = metrics.histogram(
+    "asr_stage_seconds",
+    "Durata delle fasi: upload, decode, cache, queue e archive per richiesta; features e forward per batch",
+    ["stage"])
+request_seconds = metrics.histogram("asr_request_seconds", "Latenza totale per richiesta", ["endpoint"])
+predictions_total = metrics.counter("asr_predictions_total", "Comandi restituiti", ["endpoint", "command"])
+errors_total = metrics.counter("asr_errors_total", "Richieste fallite", ["endpoint", "kind"])
+cache_lookups_total = metrics.counter("asr_cache_lookups_total", "Ricerche nella cache delle predizioni", ["result"])
+metrics.gauge("asr_batch_queue_depth", "Clip in attesa del modello", lambda: batcher.queue_depth() if batcher else 0)
+metrics.gauge("asr_archive_queue_depth", "Audio in attesa di salvataggio", lambda: archiver.queue_depth() if archiver else 0)
+
+
+def observe_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage=stage)
+
+
+def load_model(model_path):
+    """
+    Carica il modello una sola volta per processo (nel padre in modalita' multi-processo).
+    Con un modello esportato (.ts/.onnx, vedi export_model.py) NeMo non viene importato.
+    """
+    global classifier
+    print("Caricamento del modello...")
+    classifier = load_classifier(model_path, labels)
+    # La cache e' per processo e il modello non viene ricaricato: i risultati in cache sono sempre di questo modello
+    # (l'impronta svuota la cache solo se load_model viene richiamato con un altro file)
+    prediction_cache.set_model(model_fingerprint(model_path))
+    print("Modello caricato correttamente.")
+
+
+def configure_cache(max_entries=4096, ttl_s=3600.0):
+    """Dimensione massima (0 = disattivata) e durata dei risultati nella cache delle predizioni."""
+    prediction_cache.max_entries = max_entries
+    prediction_cache.ttl_s = ttl_s
+
+
+def decide(ranking):
+    """
+    Risposta a partire dalla classifica (comando, probabilita') di un unico forward: se il comando
+    piu' probabile non supera la soglia si risponde "unknown" e il client puo' rinunciare subito.
+    """
+    command, confidence = ranking[0]
+    if confidence < decision_options['threshold']:
+        command = UNKNOWN_COMMAND
+    return {
+        'command': command,
+        'confidence': confidence,
+        'top_k': [{'command': label, 'probability': probability} for label, probability in ranking],
+    }
+
+
+def start_batcher(max_batch_size=16, max_wait_ms=5.0):
+    """Avvia lo scheduler di batching (un thread per processo, dopo l'eventuale fork)."""
+    global batcher
+    classifier.stage_observer = observe_stage
+    batcher = MicroBatcher(classifier, max_batch_size, max_wait_ms,
+                           queue_observer=lambda seconds: observe_stage("queue", seconds)).start()
+
+
+def start_archiver(max_queue_size=256, policy="drop", sample_rate=1.0):
+    """Avvia il thread che salva gli audio in SAVED_AUDIO_DIR fuori dal percorso della richiesta."""
+    global archiver
+    archiver = AudioArchiver(SAVED_AUDIO_DIR, max_queue_size, policy, sample_rate=sample_rate).start()
+    atexit.register(archiver.close)
+
+
+def archive(command, audio_bytes):
+    """
+    Accoda l'audio all'archivio con il comando riconosciuto. Le clip rifiutate (sotto la soglia) sono
+    salvate come "unknown": sono quelle da etichettare a mano, e non finiscono tra gli esempi di un comando.
+    """
+    if command == UNKNOWN_COMMAND and not archive_options['rejected']:
+        return
+    archiver.submit(command, audio_bytes)
+
+
+def cached_ranking(key):
+    ranking = prediction_cache.get(key)
+    if prediction_cache.enabled:
+        cache_lookups_total.inc(result="miss" if ranking is None else "hit")
+    return ranking
 
-    return file_path
 
 @app.route('/predict', methods=['POST'])
 def predict():
+    started_at = time.perf_counter()
     try:
-        print("Richiesta ricevuta.")
-        
-        # Ottieni il file audio dalla richiesta
-        if 'file' not in request.files:
-            print("File audio mancante nella richiesta.")
+        # Ottieni il file audio dalla richiesta (il form multipart viene letto al primo accesso)
+        with timed(stage_seconds, stage="upload"):
+            audio_file = request.files.get('file')
+            audio_bytes = audio_file.read() if audio_file is not None else None
+        if audio_bytes is None:
+            errors_total.inc(endpoint="predict", kind="missing_file")
+            log.warning("File audio mancante nella richiesta")
             return jsonify({'error': 'File audio mancante'}), 400
-        
-        audio_file = request.files['file']
-        temp_audio_path = f"/tmp/{uuid.uuid4()}.wav"
-        audio_file.save(temp_audio_path)
-        print(f"File audio salvato temporaneamente in: {temp_audio_path}")
-
-        # Esegui la trascrizione
-        print("Inizio trascrizione...")
-        predictions = model.transcribe([temp_audio_path])  # Restituisce una lista di tensori
-        print(f"Predizioni ricevute: {predictions}")
-
-        # Converte il tensore in indice e poi in comando
-        if predictions and len(predictions) > 0:
-            index = predictions[0].item()  # Estrai il valore numerico dal tensore
-            command = labels[index] if index < len(labels) else "Unknown"
-        else:
-            command = "Unknown"
 
-        # Genera un nuovo nome per l'audio da salvare definitivamente
-        base_name = command
-        saved_audio_path = generate_unique_filename(base_name, "wav", SAVED_AUDIO_DIR)
-        shutil.move(temp_audio_path, saved_audio_path)
-        print(f"File audio spostato in: {saved_audio_path}")
+        # Decodifica in memoria; il forward avviene in batch con le richieste concorrenti
+        with timed(stage_seconds, stage="decode"):
+            signal = decode_audio(audio_bytes)
+        with timed(stage_seconds, stage="cache"):
+            key = audio_fingerprint(signal)
+            ranking = cached_ranking(key)
+        cached = ranking is not None
+        if not cached:
+            ranking = batcher.rank(signal, decision_options['top_k'])
+            prediction_cache.put(key, ranking)
+        result = decide(ranking)
+
+        # Salvataggio in background anche con risultato in cache: --archive-percent si applica a tutte
+        # le richieste, e il campionamento dell'archivio non dipende da cosa e' gia' stato visto
+        with timed(stage_seconds, stage="archive"):
+            archive(result['command'], audio_bytes)
 
-        return jsonify({'command': command})
+        predictions_total.inc(endpoint="predict", command=result['command'])
+        elapsed = time.perf_counter() - started_at
+        request_seconds.observe(elapsed, endpoint="predict")
+        log.info("predict", extra={'fields': {
+            'command': result['command'], 'confidence': round(result['confidence'], 4),
+            'cached': cached, 'latency_ms': round(elapsed * 1000, 2)}})
+        return jsonify(result)
 
     except Exception as e:
-        print(f"Errore durante l'elaborazione: {e}")
+        errors_total.inc(endpoint="predict", kind=type(e).__name__)
+        log.exception("Errore durante l'elaborazione")
         return jsonify({'error': str(e)}), 500
 
 
+def encode_wav(signal, sample_rate=16000):
+    buffer = io.BytesIO()
+    sf.write(buffer, signal, sample_rate, format='WAV')
+    return buffer.getvalue()
+
+
+def stream_commands(ws):
+    """
+    Streaming continuo: il client invia frame PCM 16 kHz mono int16 little-endian (messaggi binari),
+    il VAD separa gli enunciati e ogni comando viene inviato appena finisce il parlato.
+    Un messaggio di testo "end" chiude il flusso e classifica l'eventuale enunciato in corso.
+    """
+    vad = EnergyVAD(**vad_options)
+    log.info("Connessione di streaming aperta")
+    while True:
+        message = ws.receive()
+        finished = message is None or message == "end"
+        if finished:
+            segments = vad.flush()
+        elif isinstance(message, str):
+            continue
+        else:
+            segments = vad.feed(np.frombuffer(message, dtype='<i2').astype(np.float32) / 32768.0)
+
+        for audio, start, speech_end in segments:
+            result = decide(batcher.rank(audio, decision_options['top_k']))
+            command = result['command']
+            ws.send(json.dumps({
+                **result,
+                'start_ms': round(start * 1000 / vad.sample_rate),
+                'end_ms': round(speech_end * 1000 / vad.sample_rate),
+                'server_time': time.time(),
+            }))
+            predictions_total.inc(endpoint="stream", command=command)
+            log.info("stream", extra={'fields': {'command': command, 'confidence': round(result['confidence'], 4)}})
+            archive(command, encode_wav(audio, vad.sample_rate))
+        if finished:
+            break
+    log.info("Connessione di streaming chiusa")
+
+
+if sock is not None:
+    sock.route('/stream')(stream_commands)
+
+
+def iter_uploaded_clips():
+    """
+    (nome, bytes) dei clip inviati a /predict_batch. Un archivio tar (anche compresso) viene letto
+    in streaming dal corpo della richiesta, un membro alla volta; in alternativa form multipart con
+    uno o piu' campi 'files'.
+    """
+    if request.mimetype in ('application/x-tar', 'application/tar', 'application/gzip', 'application/x-gzip'):
+        with tarfile.open(fileobj=request.stream, mode='r|*') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, archive.extractfile(member).read()
+    else:
+        for audio_file in request.files.getlist('files'):
+            yield audio_file.filename, audio_file.read()
+
+
+def submit_chunk(clips):
+    """Decodifica un gruppo di clip e le accoda al batcher; le clip gia' in cache non passano dal modello."""
+    pending = []
+    for name, audio_bytes in clips:
+        try:
+            with timed(stage_seconds, stage="decode"):
+                signal = decode_audio(audio_bytes)
+        except Exception as e:
+            errors_total.inc(endpoint="predict_batch", kind=type(e).__name__)
+            pending.append((name, None, None, str(e)))
+            continue
+        key = audio_fingerprint(signal)
+        ranking = cached_ranking(key)
+        pending.append((name, key, ranking, None if ranking is not None else batcher.submit(signal)))
+    return pending
+
+
+def collect_chunk(pending):
+    """Attende i logits di un gruppo accodato con submit_chunk e restituisce le righe JSON dei risultati."""
+    for name, key, ranking, outcome in pending:
+        if key is None:
+            yield json.dumps({'name': name, 'error': outcome}) + "\n"
+            continue
+        if ranking is None:
+            try:
+                ranking = batcher.classifier.rank(outcome.result(), decision_options['top_k'])
+            except Exception as e:
+                # Un batch fallito non interrompe la risposta: le altre clip restano valide
+                errors_total.inc(endpoint="predict_batch", kind=type(e).__name__)
+                yield json.dumps({'name': name, 'error': str(e)}) + "\n"
+                continue
+            prediction_cache.put(key, ranking)
+        result = decide(ranking)
+        predictions_total.inc(endpoint="predict_batch", command=result['command'])
+        yield json.dumps({'name': name, **result}) + "\n"
+
+
+@app.route('/predict_batch', methods=['POST'])
+def predict_batch():
+    """
+    Classifica molte clip in una sola richiesta (tar in streaming o multipart) e restituisce una riga
+    JSON per clip, nell'ordine di arrivo, man mano che i batch vengono completati. Al massimo due gruppi
+    da batch_chunk_size clip sono in memoria: mentre il modello elabora uno, si legge il successivo.
+    Le clip non vengono archiviate di nuovo in saved_audio.
+    """
+    def generate():
+        started_at = time.perf_counter()
+        in_flight = deque()
+        chunk = []
+        for clip in iter_uploaded_clips():
+            chunk.append(clip)
+            if len(chunk) == batch_chunk_size:
+                in_flight.append(submit_chunk(chunk))
+                chunk = []
+                if len(in_flight) > 1:
+                    yield from collect_chunk(in_flight.popleft())
+        if chunk:
+            in_flight.append(submit_chunk(chunk))
+        while in_flight:
+            yield from collect_chunk(in_flight.popleft())
+        request_seconds.observe(time.perf_counter() - started_at, endpoint="predict_batch")
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Metriche nel formato testuale di Prometheus. Con piu' worker ogni serie ha l'etichetta worker
+    e la risposta contiene tutti i worker, qualunque processo risponda (gli altri con al piu' 1 s di ritardo).
+    """
+    others = metrics_snapshots.others() if metrics_snapshots is not None else ()
+    return Response(metrics.render(others), content_type=Registry.CONTENT_TYPE)
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Contatori dello scheduler di batching, dell'archiviazione degli audio e della cache delle predizioni."""
+    return jsonify({'worker': os.getpid(), 'batching': batcher.stats(), 'archive': archiver.stats(),
+                    'cache': prediction_cache.stats()})
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001)
+    parser = argparse.ArgumentParser(description="Server ASR per i comandi vocali.")
+    parser.add_argument("--model", default="../asr_model2.nemo", help="Modello .nemo oppure grafo esportato .ts/.onnx")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--workers", type=int, default=1, help="Processi worker pre-fork (1 = server Flask singolo)")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="Thread torch per worker (default: core disponibili / worker)")
+    parser.add_argument("--quantized", action="store_true",
+                        help="Carica il modello int8 prodotto da quantize_model.py (<modello>.int8.ts)")
+    parser.add_argument("--max-batch-size", type=int, default=16, help="Numero massimo di clip per batch")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0, help="Attesa massima per completare un batch (ms)")
+    parser.add_argument("--archive-queue-size", type=int, default=256, help="Audio in attesa di salvataggio prima di applicare la policy")
+    parser.add_argument("--archive-policy", choices=AudioArchiver.POLICIES, default="drop",
+                        help="Comportamento con coda piena: scarta subito o attendi brevemente")
+    parser.add_argument("--archive-percent", type=float, default=100.0,
+                        help="Percentuale di richieste /predict e /stream da archiviare (0-100), comprese quelle in cache")
+    parser.add_argument("--cache-size", type=int, default=4096, help="Predizioni in cache per processo (0 = disattivata)")
+    parser.add_argument("--cache-ttl", type=float, default=3600.0, help="Durata di una predizione in cache (secondi)")
+    parser.add_argument("--top-k", type=int, default=3, help="Comandi alternativi restituiti con la loro probabilita'")
+    parser.add_argument("--reject-threshold", type=float, default=0.0,
+                        help="Probabilita' minima del comando migliore, altrimenti la risposta e' \"unknown\" "
+                             "(default 0 = mai, come prima dell'introduzione della soglia)")
+    parser.add_argument("--no-archive-rejected", action="store_true",
+                        help="Non salva in saved_audio le clip con risposta \"unknown\"")
+    parser.add_argument("--batch-chunk-size", type=int, default=64,
+                        help="Clip lette e accodate al modello per volta da /predict_batch")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR", "OFF"],
+                        help="Livello del log JSON su stderr (OFF = disattivato)")
+    parser.add_argument("--vad-threshold-db", type=float, default=-45.0, help="Energia minima di un frame parlato (dBFS)")
+    parser.add_argument("--vad-end-silence-ms", type=int, default=300, help="Silenzio che chiude un enunciato in streaming")
+    args = parser.parse_args()
+
+    batch_chunk_size = max(1, args.batch_chunk_size)
+    decision_options.update(top_k=max(1, args.top_k), threshold=args.reject_threshold)
+    archive_options.update(rejected=not args.no_archive_rejected)
+    vad_options.update(threshold_db=args.vad_threshold_db, end_silence_ms=args.vad_end_silence_ms)
+    if sock is None:
+        print("[INFO] flask-sock non installato: endpoint WebSocket /stream disabilitato.")
+
+    model_path = quantized_path(args.model) if args.quantized else args.model
+    configure_cache(args.cache_size, args.cache_ttl)
+    load_model(model_path)
+    threads = args.threads_per_worker
+    if args.workers > 1 and threads is None:
+        threads = max(1, (os.cpu_count() or 1) // args.workers)
+
+    # Directory condivisa in cui ogni worker pubblica le proprie metriche per /metrics
+    metrics_dir = tempfile.mkdtemp(prefix="asr_metrics_") if args.workers > 1 else None
+
+    def init_worker(index=0):
+        global metrics_snapshots
+        # Thread intra-op per processo: worker x thread = core disponibili
+        if threads:
+            torch.set_num_threads(threads)
+        # Il thread che scrive i log non sopravvive al fork: si avvia in ogni worker
+        _, log_listener = configure_logging("asr_server", args.log_level)
+        start_batcher(args.max_batch_size, args.max_wait_ms)
+        start_archiver(args.archive_queue_size, args.archive_policy, args.archive_percent / 100.0)
+        if metrics_dir is not None:
+            # Un worker riavviato riparte da zero con lo stesso indice: Prometheus lo vede come reset del contatore
+            metrics.const_labels['worker'] = str(index)
+            metrics_snapshots = SharedSnapshots(metrics, metrics_dir, f"worker-{index}").start()
+
+        def close():
+            if metrics_snapshots is not None:
+                metrics_snapshots.close()
+            archiver.close()
+            if log_listener is not None:
+                log_listener.stop()
+        return close
+
+    if args.workers > 1:
+        print(f"[INFO] {args.workers} worker x {threads} thread torch")
+        # I pesi caricati nel padre sono condivisi copy-on-write dai worker
+        try:
+            serve_prefork(app, '0.0.0.0', args.port, args.workers, init_worker)
+        finally:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+    else:
+        init_worker()
+        app.run(host='0.0.0.0', port=args.port, threaded=True)
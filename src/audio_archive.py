@@ -0,0 +1,136 @@
+import os
+import queue
+import random
+import threading
+import time
+
+# Tempo massimo concesso a close() per salvare gli audio ancora in coda
+CLOSE_TIMEOUT_S = 5.0
+
+
+class AudioArchiver:
+    """
+    Salva gli audio ricevuti in background, fuori dal percorso della richiesta.
+
+    I nomi seguono lo schema originale (avanti.wav, avanti_1.wav, ...) ma vengono
+    assegnati da un contatore per etichetta, inizializzato con una sola scansione
+    della directory all'avvio. Se la coda e' piena l'audio viene scartato
+    (policy "drop") oppure si attende al massimo block_timeout secondi (policy "block").
+    """
+
+    POLICIES = ("drop", "block")
+
+    def __init__(self, directory, max_queue_size=256, policy="drop", block_timeout=0.05, sample_rate=1.0):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Policy di archiviazione non valida: {policy}")
+        self.directory = directory
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.sample_rate = sample_rate
+        os.makedirs(directory, exist_ok=True)
+        self._counters = self._scan_counters()
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closing = threading.Event()
+        self._stats = {'written': 0, 'dropped': 0, 'sampled_out': 0, 'errors': 0}
+
+    def _scan_counters(self):
+        """Calcola il prossimo indice libero per ogni etichetta gia' presente su disco."""
+        counters = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                stem, extension = os.path.splitext(entry.name)
+                if extension != ".wav":
+                    continue
+                base, sep, suffix = stem.rpartition("_")
+                if sep and suffix.isdigit():
+                    label, index = base, int(suffix)
+                else:
+                    label, index = stem, 0
+                counters[label] = max(counters.get(label, 0), index + 1)
+        return counters
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="audio-archiver", daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self, timeout=CLOSE_TIMEOUT_S):
+        """
+        Rifiuta nuovi audio, salva quelli in coda e ferma il thread di scrittura, attendendo al massimo
+        timeout secondi: con il disco bloccato gli audio rimasti vanno persi (il thread e' daemon).
+        """
+        if self._thread is None:
+            return
+        self._closing.set()
+        deadline = time.monotonic() + timeout
+        try:
+            # Con la coda piena il segnale di fine entra appena il thread libera un posto
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            print(f"Archiviazione non terminata entro {timeout:.1f} s: {self.queue_depth()} audio non salvati")
+        else:
+            self._thread.join(max(0.0, deadline - time.monotonic()))
+        self._thread = None
+
+    def submit(self, label, audio_bytes):
+        """Accoda un audio da archiviare. Restituisce False se e' stato scartato."""
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self._increment('sampled_out')
+            return False
+        if self._closing.is_set():
+            self._increment('dropped')
+            return False
+        try:
+            if self.policy == "block":
+                self._queue.put((label, audio_bytes), timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait((label, audio_bytes))
+        except queue.Full:
+            self._increment('dropped')
+            return False
+        return True
+
+    def _next_index(self, label):
+        with self._lock:
+            index = self._counters.get(label, 0)
+            self._counters[label] = index + 1
+        return index
+
+    def _write(self, label, audio_bytes):
+        # La creazione esclusiva evita sovrascritture anche con piu' processi sulla stessa directory
+        while True:
+            index = self._next_index(label)
+            file_name = f"{label}.wav" if index == 0 else f"{label}_{index}.wav"
+            try:
+                with open(os.path.join(self.directory, file_name), 'xb') as f:
+                    f.write(audio_bytes)
+                return
+            except FileExistsError:
+                continue
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+                self._increment('written')
+            except OSError as e:
+                print(f"Errore durante l'archiviazione dell'audio: {e}")
+                self._increment('errors')
+
+    def _increment(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, queue_depth=self.queue_depth(), policy=self.policy,
+                        sample_rate=self.sample_rate)
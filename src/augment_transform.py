@@ -0,0 +1,125 @@
+from fractions import Fraction
+
+import numpy as np
+import torch
+from scipy.signal import butter, firwin, lfilter, resample_poly
+
+# Nomi delle trasformazioni, nello stesso ordine dei suffissi di data_augmentation.py
+AUGMENTATIONS = ("original", "noise", "timeshift", "pitch", "lowpass", "highpass")
+
+
+class BatchAugmenter:
+    """
+    Versione a batch delle augmentation di data_augmentation.py, da applicare nel DataLoader.
+
+    A ogni clip del batch viene assegnata a caso una delle sei varianti (originale, rumore,
+    time shift, pitch, passa-basso, passa-alto), quindi ogni epoca vede in media la stessa
+    distribuzione del dataset materializzato ma con casualita' sempre nuova e senza file su disco.
+    I filtri usano coefficienti butter precalcolati su tutto il sotto-batch; il pitch shift e'
+    un ricampionamento polifase con kernel FIR calcolato una sola volta.
+    """
+
+    def __init__(self, sample_rate=16000, noise_factor=0.005, shift_max=0.2, n_steps=2,
+                 lowpass_cutoff=3000, highpass_cutoff=500, weights=None, seed=None):
+        nyquist = 0.5 * sample_rate
+        self.noise_factor = noise_factor
+        self.shift_max = shift_max
+        self.lowpass = butter(1, lowpass_cutoff / nyquist, btype='low', analog=False)
+        self.highpass = butter(1, highpass_cutoff / nyquist, btype='high', analog=False)
+        # Pitch piu' alto di n_steps semitoni = riproduzione piu' veloce di 2^(n/12)
+        ratio = Fraction(2 ** (n_steps / 12)).limit_denominator(64)
+        self.resample_up, self.resample_down = ratio.denominator, ratio.numerator
+        max_rate = max(self.resample_up, self.resample_down)
+        self.resample_kernel = firwin(2 * 10 * max_rate + 1, 1.0 / max_rate, window=('kaiser', 5.0))
+        weights = np.ones(len(AUGMENTATIONS)) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.weights = weights / weights.sum()
+        self.seed = seed
+        self._rng = None
+        self._rng_seed = None
+
+    @property
+    def rng(self):
+        # Ogni worker del DataLoader ha un seed torch diverso: il generatore numpy lo segue
+        seed = torch.initial_seed() if self.seed is None else self.seed
+        if self._rng is None or seed != self._rng_seed:
+            self._rng = np.random.default_rng(seed)
+            self._rng_seed = seed
+        return self._rng
+
+    @staticmethod
+    def _valid_mask(lengths, max_len):
+        return np.arange(max_len)[None, :] < lengths[:, None]
+
+    @staticmethod
+    def _normalize(audio, mask):
+        peak = np.abs(np.where(mask, audio, 0.0)).max(axis=1, keepdims=True)
+        return np.where(mask, audio / np.where(peak > 0, peak, 1.0), 0.0)
+
+    def add_noise(self, audio, lengths):
+        noise = self.rng.standard_normal(audio.shape)
+        return audio + self.noise_factor * noise, lengths
+
+    def time_shift(self, audio, lengths):
+        # np.roll di ogni clip all'interno della propria lunghezza valida, con un solo gather
+        limits = (lengths * self.shift_max).astype(np.int64)
+        shifts = np.floor(self.rng.random(len(lengths)) * np.maximum(limits, 1)).astype(np.int64) * (limits > 0)
+        shifts = np.where(self.rng.integers(0, 2, len(lengths)) == 1, -shifts, shifts)
+        positions = np.arange(audio.shape[1])[None, :]
+        source = (positions - shifts[:, None]) % np.maximum(lengths, 1)[:, None]
+        return np.take_along_axis(audio, source, axis=1), lengths
+
+    def pitch_shift(self, audio, lengths):
+        shifted = resample_poly(audio, self.resample_up, self.resample_down, axis=1, window=self.resample_kernel)
+        new_lengths = -(-lengths * self.resample_up // self.resample_down)
+        out = np.zeros_like(audio)
+        width = min(audio.shape[1], shifted.shape[1])
+        out[:, :width] = shifted[:, :width]
+        return out, np.minimum(new_lengths, audio.shape[1])
+
+    def lowpass_filter(self, audio, lengths):
+        return lfilter(*self.lowpass, audio, axis=1), lengths
+
+    def highpass_filter(self, audio, lengths):
+        return lfilter(*self.highpass, audio, axis=1), lengths
+
+    def __call__(self, audio, lengths):
+        """Applica le augmentation a un batch [B, T] (numpy) con lunghezze [B]; restituisce (audio, lunghezze)."""
+        audio = np.asarray(audio, dtype=np.float64)
+        lengths = np.asarray(lengths, dtype=np.int64).copy()
+        choices = self.rng.choice(len(AUGMENTATIONS), size=len(lengths), p=self.weights)
+        transforms = {
+            "noise": self.add_noise,
+            "timeshift": self.time_shift,
+            "pitch": self.pitch_shift,
+            "lowpass": self.lowpass_filter,
+            "highpass": self.highpass_filter,
+        }
+        out = audio.copy()
+        for k, name in enumerate(AUGMENTATIONS):
+            rows = np.flatnonzero(choices == k)
+            if name == "original" or len(rows) == 0:
+                continue
+            augmented, new_lengths = transforms[name](audio[rows], lengths[rows])
+            out[rows] = self._normalize(augmented, self._valid_mask(new_lengths, audio.shape[1]))
+            lengths[rows] = new_lengths
+        return out.astype(np.float32), lengths
+
+
+class OnlineAugmentCollate:
+    """Avvolge il collate_fn NeMo (audio, lunghezze, etichette, lunghezze etichette) e aumenta l'audio del batch."""
+
+    def __init__(self, collate_fn, augmenter):
+        self.collate_fn = collate_fn
+        self.augmenter = augmenter
+
+    def __call__(self, batch):
+        audio, audio_len, labels, labels_len = self.collate_fn(batch)
+        augmented, new_len = self.augmenter(audio.numpy(), audio_len.numpy())
+        return torch.from_numpy(augmented), torch.from_numpy(new_len), labels, labels_len
+
+
+def enable_online_augmentation(model, augmenter=None):
+    """Aggiunge le augmentation al DataLoader di training gia' configurato del modello."""
+    loader = model._train_dl
+    loader.collate_fn = OnlineAugmentCollate(loader.collate_fn, augmenter or BatchAugmenter())
+    return model
@@ -0,0 +1,85 @@
+import argparse
+import json
+import os
+import tarfile
+import time
+
+import requests
+
+TAR_BLOCK = tarfile.BLOCKSIZE
+
+
+def list_clips(source):
+    """Percorsi dei .wav di una directory (es. saved_audio) oppure di un manifest JSON-lines."""
+    if os.path.isdir(source):
+        return sorted(os.path.join(root, name) for root, _, files in os.walk(source) for name in files
+                      if name.endswith(".wav"))
+    with open(source, 'r') as f:
+        return [json.loads(line)["audio_filepath"] for line in f]
+
+
+def expected_label(path):
+    """Etichetta dal nome del file di saved_audio: avanti_12.wav -> avanti."""
+    return os.path.splitext(os.path.basename(path))[0].split("_")[0]
+
+
+def tar_stream(paths):
+    """Genera un archivio tar un file alla volta: l'upload non viene mai costruito tutto in memoria."""
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        info = tarfile.TarInfo(name=path)
+        info.size = len(data)
+        yield info.tobuf(format=tarfile.PAX_FORMAT)
+        yield data + b"\0" * (-len(data) % TAR_BLOCK)
+    yield b"\0" * (2 * TAR_BLOCK)
+
+
+def predict_batch(url, paths, output):
+    """Invia le clip a /predict_batch e scrive i risultati JSON-lines man mano che arrivano."""
+    results = []
+    response = requests.post(f"{url}/predict_batch", data=tar_stream(paths),
+                             headers={'Content-Type': 'application/x-tar'}, stream=True)
+    response.raise_for_status()
+    for line in response.iter_lines():
+        if line:
+            output.write(line.decode() + "\n")
+            results.append(json.loads(line))
+    return results
+
+
+def predict_single(url, paths):
+    """Percorso precedente: una richiesta /predict per file."""
+    session = requests.Session()
+    for path in paths:
+        with open(path, 'rb') as f:
+            session.post(f"{url}/predict", files={'file': ('audio.wav', f.read(), 'audio/wav')}).raise_for_status()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rietichettatura offline: molte clip in una sola richiesta a /predict_batch.")
+    parser.add_argument("source", nargs="?", default="./saved_audio", help="Directory di .wav oppure manifest")
+    parser.add_argument("--url", default="http://localhost:5001")
+    parser.add_argument("--output", default="predictions.jsonl", help="Risultati JSON-lines, una riga per clip")
+    parser.add_argument("--compare-single", action="store_true",
+                        help="Misura anche il tempo con una richiesta /predict per file (server con --cache-size 0)")
+    args = parser.parse_args()
+
+    paths = list_clips(args.source)
+    start = time.perf_counter()
+    with open(args.output, 'w') as output:
+        results = predict_batch(args.url, paths, output)
+    elapsed = time.perf_counter() - start
+    print(f"[TEMPO] /predict_batch: {len(results)} clip in {elapsed:.2f} s ({len(results) / elapsed:.1f} clip/s)")
+
+    errors = sum('error' in result for result in results)
+    labelled = [result for result in results if 'error' not in result]
+    if os.path.isdir(args.source) and labelled:
+        agreement = sum(result['command'] == expected_label(result['name']) for result in labelled) / len(labelled) * 100
+        print(f"[INFO] Predizioni uguali all'etichetta del nome del file: {agreement:.2f}%   errori: {errors}")
+
+    if args.compare_single:
+        start = time.perf_counter()
+        predict_single(args.url, paths)
+        single = time.perf_counter() - start
+        print(f"[TEMPO] /predict singolo: {len(paths)} clip in {single:.2f} s ({len(paths) / single:.1f} clip/s)")
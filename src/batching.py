@@ -0,0 +1,123 @@
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class _PendingRequest:
+    __slots__ = ("signal", "future", "enqueued_at")
+
+    def __init__(self, signal):
+        self.signal = signal
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class MicroBatcher:
+    """
+    Raccoglie le richieste concorrenti e le esegue in un unico forward del modello.
+
+    Un batch parte quando raggiunge max_batch_size clip oppure quando la prima
+    richiesta in coda ha atteso max_wait_ms millisecondi.
+    """
+
+    def __init__(self, classifier, max_batch_size=16, max_wait_ms=5.0, stats_window=1000, queue_observer=None):
+        self.classifier = classifier
+        # Funzione opzionale chiamata con il tempo di attesa in coda (secondi) di ogni richiesta
+        self.queue_observer = queue_observer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        # Contatori per bilanciare throughput e latenza di coda
+        self._batches = 0
+        self._requests = 0
+        self._batch_sizes = Counter()
+        self._queue_times = deque(maxlen=stats_window)
+        self._max_queue_time = 0.0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def submit(self, signal):
+        """Accoda un segnale e restituisce un Future con la riga di logits corrispondente."""
+        request = _PendingRequest(signal)
+        self._queue.put(request)
+        return request.future
+
+    def predict(self, signal, timeout=None):
+        """Classifica un segnale passando dal batch condiviso e restituisce il comando."""
+        logits = self.submit(signal).result(timeout=timeout)
+        return self.classifier.label_for(int(logits.argmax()))
+
+    def rank(self, signal, top_k=3, timeout=None):
+        """Come predict, ma restituisce i top_k comandi con la probabilita' (softmax dello stesso forward)."""
+        logits = self.submit(signal).result(timeout=timeout)
+        return self.classifier.rank(logits, top_k)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = batch[0].enqueued_at + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started_at = time.perf_counter()
+            try:
+                logits = self.classifier.logits([request.signal for request in batch])
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+            else:
+                for request, row in zip(batch, logits):
+                    request.future.set_result(row)
+            self._record(batch, started_at)
+
+    def _record(self, batch, started_at):
+        if self.queue_observer is not None:
+            for request in batch:
+                self.queue_observer(started_at - request.enqueued_at)
+        with self._lock:
+            self._batches += 1
+            self._requests += len(batch)
+            self._batch_sizes[len(batch)] += 1
+            for request in batch:
+                queue_time = (started_at - request.enqueued_at) * 1000
+                self._queue_times.append(queue_time)
+                self._max_queue_time = max(self._max_queue_time, queue_time)
+
+    def stats(self):
+        """Restituisce i contatori su dimensione dei batch e tempo di attesa in coda."""
+        with self._lock:
+            queue_times = np.array(self._queue_times) if self._queue_times else np.zeros(1)
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000,
+                'batches': self._batches,
+                'requests': self._requests,
+                'avg_batch_size': self._requests / self._batches if self._batches else 0.0,
+                'batch_size_histogram': {str(size): count for size, count in sorted(self._batch_sizes.items())},
+                'queue_time_ms': {
+                    'p50': float(np.percentile(queue_times, 50)),
+                    'p99': float(np.percentile(queue_times, 99)),
+                    'max': self._max_queue_time,
+                },
+                'queue_depth': self.queue_depth(),
+            }
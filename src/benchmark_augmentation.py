@@ -0,0 +1,60 @@
+import argparse
+import tempfile
+import time
+
+import torch
+
+from augment_transform import BatchAugmenter
+from data_augmentation import AUGMENTATIONS, augment_file, list_audio_files
+from inference import decode_audio, pad_batch
+
+
+def file_pipeline(audio_files, input_dir):
+    """Pipeline su file: carica, genera le 5 augmentation e scrive 6 wav per clip."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        for file_path in audio_files:
+            augment_file(file_path, input_dir, tmp_dir)
+        return time.perf_counter() - start
+
+
+def batch_pipeline(signals, batch_size, epochs):
+    """Trasformazione a batch su audio gia' in memoria, come nel collate del DataLoader."""
+    augmenter = BatchAugmenter(seed=0)
+    batches = [pad_batch(signals[i:i + batch_size]) for i in range(0, len(signals), batch_size)]
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for audio, lengths in batches:
+            augmenter(audio.numpy(), lengths.numpy())
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Clip/s per core: augmentation su file contro trasformazione a batch.")
+    parser.add_argument("--input-dir", default="../audio")
+    parser.add_argument("--limit", type=int, default=200, help="Numero massimo di clip sorgente")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--epochs", type=int, default=5, help="Epoche simulate per la trasformazione a batch")
+    args = parser.parse_args()
+
+    # Un solo core per entrambe le pipeline, cosi' i numeri sono per core
+    torch.set_num_threads(1)
+    audio_files = list_audio_files(args.input_dir)[:args.limit]
+    signals = []
+    for file_path in audio_files:
+        with open(file_path, 'rb') as f:
+            signals.append(decode_audio(f.read()))
+
+    file_time = file_pipeline(audio_files, args.input_dir)
+    batch_time = batch_pipeline(signals, args.batch_size, args.epochs)
+
+    clips = len(audio_files)
+    file_rate = clips / file_time
+    batch_rate = clips * args.epochs / batch_time
+    print(f"[TEMPO] {clips} clip sorgente, 1 core")
+    print(f"File (6 wav per clip):        {file_rate:8.1f} clip sorgente/s")
+    print(f"Batch (1 variante per clip):  {batch_rate:8.1f} clip/s   ({batch_rate / file_rate:.1f}x)")
+    # La pipeline su file produce 6 varianti per sorgente una volta sola;
+    # la trasformazione produce una variante nuova per clip a ogni epoca
+    print(f"[INFO] Varianti generate: file {clips * (1 + len(AUGMENTATIONS))} (fisse), "
+          f"batch {clips * args.epochs} (nuove a ogni epoca)")
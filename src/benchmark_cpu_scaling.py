@@ -0,0 +1,87 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from trainer_profiles import trainer_kwargs
+
+RESULT_PREFIX = "[RISULTATO] "
+
+
+def count_samples(manifest_path):
+    with open(manifest_path, 'r') as f:
+        return sum(1 for _ in f)
+
+
+def run_single(args):
+    """Una configurazione: training con il profilo cpu e `args.ranks` rank; stampa la durata mediana per epoca."""
+    import pytorch_lightning as pl
+    from omegaconf import OmegaConf
+    from nemo.collections.asr.models import EncDecClassificationModel
+
+    from training_callbacks import EpochTimer
+
+    cfg = OmegaConf.load(args.config)
+    cfg.model.train_ds.manifest_filepath = args.manifest
+    cfg.model.validation_ds.manifest_filepath = args.val_manifest
+    timer = EpochTimer()
+    trainer = pl.Trainer(
+        max_epochs=args.epochs,
+        **trainer_kwargs(cfg, "cpu", ranks=args.ranks, threads=args.threads),
+        callbacks=[timer],
+        logger=False,
+        enable_checkpointing=False,
+        # Solo l'epoca di training: la validazione non fa parte della misura
+        limit_val_batches=0,
+        num_sanity_val_steps=0,
+    )
+    model = EncDecClassificationModel(cfg=cfg.model)
+    model.setup_training_data(train_data_config=cfg.model.train_ds)
+    trainer.fit(model)
+    if trainer.is_global_zero:
+        # La prima epoca include l'avvio dei worker e del process group
+        durations = timer.durations[1:] or timer.durations
+        print(RESULT_PREFIX + json.dumps({'epoch_s': float(np.median(durations)), 'precision': str(trainer.precision)}))
+
+
+def run_configuration(args, ranks, threads):
+    """Ogni configurazione in un processo nuovo: con ddp Lightning riesegue lo script per ogni rank."""
+    command = [sys.executable, __file__, "--single", "--ranks", str(ranks), "--threads", str(threads),
+               "--epochs", str(args.epochs), "--config", args.config,
+               "--manifest", args.manifest, "--val-manifest", args.val_manifest]
+    output = subprocess.run(command, capture_output=True, text=True)
+    for line in output.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError(f"Configurazione con {ranks} rank fallita:\n{output.stderr[-2000:]}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Campioni/s del training su CPU da 1 a N rank data-parallel.")
+    parser.add_argument("--config", default="../config.yaml")
+    parser.add_argument("--manifest", default="../train_manifest_augmented.json")
+    parser.add_argument("--val-manifest", default="../val_manifest.json")
+    parser.add_argument("--max-ranks", type=int, default=os.cpu_count())
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--ranks", type=int, default=1, help=argparse.SUPPRESS)
+    parser.add_argument("--threads", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(args)
+    else:
+        samples = count_samples(args.manifest)
+        cores = os.cpu_count() or 1
+        counts = sorted({1, *[n for n in (2, 4, 8, 16, 32) if n < args.max_ranks], args.max_ranks})
+        baseline = None
+        for ranks in counts:
+            threads = max(1, cores // ranks)
+            result = run_configuration(args, ranks, threads)
+            throughput = samples / result['epoch_s']
+            baseline = baseline or throughput
+            print(f"{ranks:>2} rank x {threads:>2} thread   epoca: {result['epoch_s']:7.2f} s   "
+                  f"{throughput:8.1f} campioni/s ({throughput / baseline:4.2f}x)   precisione: {result['precision']}")
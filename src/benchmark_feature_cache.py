@@ -0,0 +1,53 @@
+import argparse
+import time
+
+import numpy as np
+import pytorch_lightning as pl
+from omegaconf import OmegaConf
+from nemo.collections.asr.models import EncDecClassificationModel
+
+from feature_cache import cached_features, prepare_caches
+from training_callbacks import EpochTimer
+
+
+def run(cfg, epochs, feature_caches=None):
+    timer = EpochTimer()
+    trainer = pl.Trainer(
+        max_epochs=epochs,
+        accelerator=cfg.trainer.accelerator,
+        devices=cfg.trainer.devices,
+        callbacks=[timer],
+        logger=False,
+        enable_checkpointing=False,
+    )
+    model = EncDecClassificationModel(cfg=cfg.model)
+    if feature_caches is None:
+        model.setup_training_data(train_data_config=cfg.model.train_ds)
+        model.setup_validation_data(val_data_config=cfg.model.validation_ds)
+        trainer.fit(model)
+    else:
+        with cached_features(model, *feature_caches, cfg.model.train_ds, cfg.model.validation_ds):
+            trainer.fit(model)
+    # La prima epoca include l'avvio dei worker: la mediana e' piu' rappresentativa
+    return np.median(timer.durations)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tempo per epoca con e senza la cache delle feature mel.")
+    parser.add_argument("--config", default="../config.yaml")
+    parser.add_argument("--cache-dir", default="../feature_cache")
+    parser.add_argument("--epochs", type=int, default=3)
+    args = parser.parse_args()
+
+    cfg = OmegaConf.load(args.config)
+    cfg.model.train_ds.manifest_filepath = "../train_manifest_augmented.json"
+    cfg.model.validation_ds.manifest_filepath = "../val_manifest.json"
+
+    start = time.perf_counter()
+    caches = prepare_caches(cfg, args.cache_dir)
+    print(f"Costruzione/verifica della cache: {time.perf_counter() - start:.2f} s")
+
+    audio_time = run(cfg, args.epochs)
+    cache_time = run(cfg, args.epochs, caches)
+    print(f"Epoca da audio:      {audio_time:.2f} s")
+    print(f"Epoca da cache mel:  {cache_time:.2f} s   ({audio_time / cache_time:.2f}x)")
@@ -0,0 +1,85 @@
+import argparse
+import sys
+import time
+from difflib import SequenceMatcher
+
+import numpy as np
+
+from asr_metrics import char_error_rate, distance_tables, label_error_rates, levenshtein
+
+LABELS = [
+    "avanti", "indietro", "sinistra", "destra",
+    "cammina", "corri", "fermo", "salta",
+    "vola", "su", "giu", "pausa",
+    "continua", "esci"
+]
+
+
+def reference_levenshtein(a, b):
+    """Implementazione di riferimento: DP classica a matrice completa, in Python puro."""
+    d = [[i + j if i * j == 0 else 0 for j in range(len(b) + 1)] for i in range(len(a) + 1)]
+    for i in range(1, len(a) + 1):
+        for j in range(1, len(b) + 1):
+            d[i][j] = min(d[i - 1][j] + 1, d[i][j - 1] + 1, d[i - 1][j - 1] + (a[i - 1] != b[j - 1]))
+    return d[len(a)][len(b)]
+
+
+def difflib_cer(hypotheses, references):
+    """Vecchio calcolo di evaluate_model.py (blocchi di SequenceMatcher, non Levenshtein)."""
+    errors = 0
+    for hyp, ref in zip(hypotheses, references):
+        matching = sum(block.size for block in SequenceMatcher(None, ref, hyp).get_matching_blocks())
+        errors += len(ref) + len(hyp) - 2 * matching
+    return errors / sum(len(ref) for ref in references)
+
+
+def check_kernel(rng, cases):
+    """Confronta levenshtein() con il riferimento su stringhe casuali, liste di parole e tutto il vocabolario."""
+    failures = 0
+    alphabet = list("aeiousrt")
+    for _ in range(cases):
+        a = "".join(rng.choice(alphabet, rng.integers(0, 12)))
+        b = "".join(rng.choice(alphabet, rng.integers(0, 12)))
+        failures += levenshtein(a, b) != reference_levenshtein(a, b)
+        words_a, words_b = a.split("s"), b.split("t")
+        failures += levenshtein(words_a, words_b) != reference_levenshtein(words_a, words_b)
+    _, chars, _, _ = distance_tables(tuple(LABELS))
+    for i, hyp in enumerate(LABELS):
+        for j, ref in enumerate(LABELS):
+            failures += chars[i, j] != reference_levenshtein(ref, hyp)
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verifica del kernel di Levenshtein e confronto di velocita' del CER.")
+    parser.add_argument("--pairs", type=int, default=100_000, help="Coppie ipotesi/riferimento del microbenchmark")
+    parser.add_argument("--cases", type=int, default=2000, help="Coppie casuali confrontate con il riferimento")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    failures = check_kernel(rng, args.cases)
+    print(f"[INFO] Kernel contro l'implementazione di riferimento: {failures} differenze")
+
+    targets = rng.integers(0, len(LABELS), args.pairs)
+    # Circa il 10% di errori, come su un validation set realistico
+    predictions = np.where(rng.random(args.pairs) < 0.1, rng.integers(0, len(LABELS), args.pairs), targets)
+    hypotheses = [LABELS[i] for i in predictions]
+    references = [LABELS[i] for i in targets]
+
+    distance_tables.cache_clear()
+    start = time.perf_counter()
+    _, table_cer = label_error_rates(predictions, targets, LABELS)
+    table_time = time.perf_counter() - start
+    start = time.perf_counter()
+    old_cer = difflib_cer(hypotheses, references)
+    difflib_time = time.perf_counter() - start
+    start = time.perf_counter()
+    string_cer = char_error_rate(hypotheses, references)
+    string_time = time.perf_counter() - start
+
+    print(f"[TEMPO] {args.pairs} coppie   tabella su indici: {table_time * 1000:9.2f} ms   "
+          f"Levenshtein su stringhe: {string_time * 1000:9.2f} ms   difflib: {difflib_time * 1000:9.2f} ms")
+    print(f"[INFO] CER tabella: {table_cer:.6f}   Levenshtein su stringhe: {string_cer:.6f}   difflib: {old_cer:.6f}")
+    if failures or abs(table_cer - string_cer) > 1e-12:
+        sys.exit(1)
@@ -0,0 +1,94 @@
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+import numpy as np
+import torch
+from nemo.collections.asr.models import ASRModel
+
+from inference import CommandClassifier, decode_audio
+
+
+def load_clips(manifest_path, limit):
+    """Legge i byte dei file audio elencati nel manifest."""
+    clips = []
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            with open(json.loads(line)["audio_filepath"], 'rb') as audio:
+                clips.append(audio.read())
+            if len(clips) >= limit:
+                break
+    return clips
+
+
+def legacy_predict(model, audio_bytes):
+    """Percorso originale: file temporaneo su disco + model.transcribe()."""
+    temp_audio_path = f"/tmp/{uuid.uuid4()}.wav"
+    with open(temp_audio_path, 'wb') as f:
+        f.write(audio_bytes)
+    predictions = model.transcribe([temp_audio_path])
+    os.remove(temp_audio_path)
+    return predictions[0].item()
+
+
+def in_memory_predict(classifier, audio_bytes):
+    """Nuovo percorso: decodifica in memoria e forward diretto del modello."""
+    return classifier.predict(decode_audio(audio_bytes))
+
+
+def check_batch_parity(classifier, signals, tolerance):
+    """
+    Logits di un batch con clip di lunghezze diverse (originali e versioni accorciate) contro quelli
+    di ogni clip classificata da sola: il padding non deve cambiare le predizioni.
+    """
+    signals = [s for signal in signals for s in (signal, signal[:len(signal) // 2])]
+    batched = classifier.logits(signals)
+    single = torch.cat([classifier.logits([signal]) for signal in signals])
+    max_diff = float((batched - single).abs().max())
+    agree = int((batched.argmax(dim=-1) == single.argmax(dim=-1)).sum())
+    print(f"Parita' batch/singola su {len(signals)} clip: top-1 concorde {agree}/{len(signals)}, "
+          f"differenza massima logits {max_diff:.2e}")
+    return agree == len(signals) and max_diff <= tolerance
+
+
+def measure(fn, clips, repeats):
+    latencies = []
+    for _ in range(repeats):
+        for clip in clips:
+            start = time.perf_counter()
+            fn(clip)
+            latencies.append((time.perf_counter() - start) * 1000)
+    return np.array(latencies)
+
+
+def report(name, latencies):
+    print(f"{name:<16} p50: {np.percentile(latencies, 50):8.2f} ms   "
+          f"p99: {np.percentile(latencies, 99):8.2f} ms   "
+          f"richieste: {len(latencies)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Confronta la latenza di /predict: file temporaneo vs in memoria.")
+    parser.add_argument("--model", default="../asr_model2.nemo")
+    parser.add_argument("--manifest", default="../val_manifest.json")
+    parser.add_argument("--limit", type=int, default=68)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="Differenza massima ammessa sui logits")
+    args = parser.parse_args()
+
+    model = ASRModel.restore_from(args.model)
+    classifier = CommandClassifier(model)
+    clips = load_clips(args.manifest, args.limit)
+
+    # Warm-up di entrambi i percorsi
+    legacy_predict(model, clips[0])
+    in_memory_predict(classifier, clips[0])
+
+    report("file+transcribe", measure(lambda c: legacy_predict(model, c), clips, args.repeats))
+    report("in memoria", measure(lambda c: in_memory_predict(classifier, c), clips, args.repeats))
+
+    if not check_batch_parity(classifier, [decode_audio(clip) for clip in clips[:16]], args.tolerance):
+        sys.exit(1)
@@ -0,0 +1,64 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+from benchmark_predict import check_batch_parity
+from inference import decode_audio, load_classifier, quantized_path
+
+
+def load_manifest(manifest_path):
+    signals, labels = [], []
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            entry = json.loads(line)
+            with open(entry["audio_filepath"], 'rb') as audio:
+                signals.append(decode_audio(audio.read()))
+            labels.append(entry["label"])
+    return signals, labels
+
+
+def evaluate(classifier, signals, labels):
+    """Accuratezza top-1 e latenza di una richiesta singola (una clip per forward, come /predict)."""
+    classifier.logits(signals[:1])
+    predictions, latencies = [], []
+    for signal in signals:
+        start = time.perf_counter()
+        logits = classifier.logits([signal])
+        latencies.append((time.perf_counter() - start) * 1000)
+        predictions.append(classifier.label_for(int(logits.argmax())))
+    accuracy = np.mean([p == label for p, label in zip(predictions, labels)]) * 100
+    return accuracy, np.array(latencies), predictions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Confronto fp32 / int8: accuratezza, dimensione e latenza per richiesta.")
+    parser.add_argument("--model", default="../asr_model2.nemo")
+    parser.add_argument("--quantized", default=None, help="Modello int8 (default: <modello>.int8.ts)")
+    parser.add_argument("--manifest", default="../val_manifest.json")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="Differenza massima batch/singola sui logits int8")
+    parser.add_argument("--threads", type=int, default=None, help="Thread torch (default: quelli di sistema)")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    quantized = args.quantized or quantized_path(args.model)
+    signals, labels = load_manifest(args.manifest)
+
+    results = {}
+    for name, path in (("fp32 (.nemo)", args.model), ("int8", quantized)):
+        accuracy, latencies, predictions = evaluate(load_classifier(path), signals, labels)
+        results[name] = predictions
+        print(f"{name:<13} top-1: {accuracy:6.2f}%   dimensione: {os.path.getsize(path) / 1e6:6.2f} MB   "
+              f"p50: {np.percentile(latencies, 50):7.2f} ms   p99: {np.percentile(latencies, 99):7.2f} ms")
+
+    agreement = np.mean([a == b for a, b in zip(*results.values())]) * 100
+    print(f"[INFO] {len(signals)} clip, predizioni int8 uguali a fp32: {agreement:.2f}%")
+
+    # Il padding di un batch non deve cambiare le predizioni del modello int8
+    if not check_batch_parity(load_classifier(quantized), signals[:16], args.tolerance):
+        sys.exit(1)
@@ -0,0 +1,80 @@
+import argparse
+import json
+import subprocess
+import sys
+
+import numpy as np
+import torch
+
+from inference import decode_audio, load_classifier
+
+# Eseguito in un processo separato: misura import + caricamento del modello partendo da zero
+STARTUP_SNIPPET = """
+import json, resource, time
+start = time.perf_counter()
+from inference import load_classifier
+classifier = load_classifier({model_path!r})
+import numpy as np
+classifier.predict(np.zeros(16000, dtype=np.float32))
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}}))
+"""
+
+
+def measure_startup(model_path):
+    """Tempo di avvio (import, caricamento, prima inferenza) e memoria residente massima."""
+    result = subprocess.run([sys.executable, "-c", STARTUP_SNIPPET.format(model_path=model_path)],
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def check_parity(nemo_path, exported_path, manifest_path, tolerance, batch_clips=16):
+    """
+    Confronta clip per clip i logits del modello NeMo con quelli del grafo esportato, poi quelli di
+    un batch con padding (clip originali e accorciate) del grafo esportato con NeMo clip per clip.
+    """
+    reference = load_classifier(nemo_path)
+    exported = load_classifier(exported_path)
+    max_diff = 0.0
+    agree = total = 0
+    signals = []
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            with open(json.loads(line)["audio_filepath"], 'rb') as audio:
+                signal = decode_audio(audio.read())
+            expected = reference.logits([signal])[0]
+            actual = exported.logits([signal])[0]
+            max_diff = max(max_diff, float((expected - actual).abs().max()))
+            agree += int(expected.argmax() == actual.argmax())
+            total += 1
+            if len(signals) < batch_clips:
+                signals.append(signal)
+    print(f"Parita' su {total} clip: top-1 concorde {agree}/{total}, differenza massima logits {max_diff:.2e}")
+
+    batch = [s for signal in signals for s in (signal, signal[:len(signal) // 2])]
+    expected = torch.cat([reference.logits([signal]) for signal in batch])
+    actual = exported.logits(batch)
+    batch_diff = float((expected - actual).abs().max())
+    batch_agree = int((expected.argmax(dim=-1) == actual.argmax(dim=-1)).sum())
+    print(f"Parita' di un batch con padding ({len(batch)} clip): top-1 concorde {batch_agree}/{len(batch)}, "
+          f"differenza massima logits {batch_diff:.2e}")
+    return agree == total and max_diff <= tolerance and batch_agree == len(batch) and batch_diff <= tolerance
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Avvio, RSS e parita' del modello esportato rispetto a NeMo.")
+    parser.add_argument("--nemo", default="../asr_model2.nemo")
+    parser.add_argument("--exported", default="../asr_model2.ts")
+    parser.add_argument("--manifest", default="../val_manifest.json")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="Differenza massima ammessa sui logits")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    for model_path in (args.nemo, args.exported):
+        runs = [measure_startup(model_path) for _ in range(args.repeats)]
+        seconds = np.median([run["seconds"] for run in runs])
+        rss = np.median([run["max_rss_mb"] for run in runs])
+        print(f"{model_path:<28} avvio: {seconds:6.2f} s   RSS massimo: {rss:8.1f} MB")
+
+    if not check_parity(args.nemo, args.exported, args.manifest, args.tolerance):
+        sys.exit(1)
@@ -0,0 +1,111 @@
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+import torch
+from nemo.collections.asr.models import ASRModel
+
+from inference import CommandClassifier, decode_audio
+from streaming import StreamingClassifier, average_feature_stats, clip_feature_stats
+
+
+def load_signals(manifest_path, limit):
+    signals = []
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            with open(json.loads(line)["audio_filepath"], 'rb') as audio:
+                signals.append(decode_audio(audio.read()))
+            if len(signals) >= limit:
+                break
+    return signals
+
+
+def check_parity(streaming, classifier, signals, chunk_sizes, tolerance):
+    """Con le statistiche della clip la posterior finale a blocchi deve coincidere con quella a clip intera."""
+    worst = 0.0
+    for signal in signals:
+        reference = torch.softmax(classifier.logits([signal]), dim=1)[0].numpy()
+        stats = clip_feature_stats(streaming.frontend, signal)
+        for chunk_size in chunk_sizes:
+            final = streaming.run(signal, chunk_size, stats)[-1]
+            worst = max(worst, float(np.abs(final - reference).max()))
+    print(f"[INFO] Parita' streaming/clip intera su {len(signals)} clip: differenza massima {worst:.2e}")
+    return worst <= tolerance
+
+
+def decision_report(streaming, classifier, signals, chunk_size, stats=None):
+    """Accordo con la clip intera e frazione di clip dopo la quale la predizione non cambia piu'."""
+    agree, fractions = 0, []
+    for signal in signals:
+        reference = int(classifier.logits([signal]).argmax())
+        predictions = [int(np.argmax(p)) if p is not None else -1 for p in streaming.run(signal, chunk_size, stats)]
+        agree += predictions[-1] == reference
+        # Primo blocco da cui la predizione resta uguale a quella finale
+        stable = len(predictions) - 1
+        while stable > 0 and predictions[stable - 1] == predictions[-1]:
+            stable -= 1
+        fractions.append(min(1.0, (stable + 1) * chunk_size / len(signal)))
+    return agree / len(signals), float(np.median(fractions))
+
+
+def chunk_costs(streaming, signals, chunk_size):
+    latencies = []
+    for signal in signals:
+        streaming.reset()
+        for start in range(0, len(signal), chunk_size):
+            begin = time.perf_counter()
+            streaming.step(signal[start:start + chunk_size])
+            latencies.append((time.perf_counter() - begin) * 1000)
+        streaming.finish()
+    return np.array(latencies)
+
+
+def whole_clip_costs(classifier, signals):
+    latencies = []
+    for signal in signals:
+        begin = time.perf_counter()
+        classifier.logits([signal])
+        latencies.append((time.perf_counter() - begin) * 1000)
+    return np.array(latencies)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parita' e costo per blocco dell'inferenza in streaming.")
+    parser.add_argument("--model", default="../asr_model2.nemo")
+    parser.add_argument("--manifest", default="../val_manifest.json")
+    parser.add_argument("--stats-manifest", default="../train_manifest.json",
+                        help="Clip usate per stimare statistiche di normalizzazione fisse")
+    parser.add_argument("--limit", type=int, default=68)
+    parser.add_argument("--chunk-ms", type=int, nargs="+", default=[20, 40, 100])
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="Differenza massima ammessa tra le posterior")
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    model = ASRModel.restore_from(args.model, map_location="cpu")
+    classifier = CommandClassifier(model)
+    streaming = StreamingClassifier(model)
+    signals = load_signals(args.manifest, args.limit)
+    sample_rate = streaming.sample_rate
+    chunk_sizes = [sample_rate * ms // 1000 for ms in args.chunk_ms]
+    print(f"[INFO] Ritardo algoritmico (FFT + contesto destro delle convoluzioni): {streaming.lookahead_ms:.0f} ms")
+
+    parity_ok = check_parity(streaming, classifier, signals[:10], chunk_sizes + [sample_rate // 7], args.tolerance)
+
+    global_stats = average_feature_stats(streaming.frontend, load_signals(args.stats_manifest, 200))
+    for name, stats in (("cumulative", None), ("fisse (train)", global_stats)):
+        agreement, fraction = decision_report(streaming, classifier, signals, chunk_sizes[0], stats)
+        print(f"Normalizzazione {name:<14} accordo top-1: {agreement * 100:6.2f}%   "
+              f"predizione stabile dopo il {fraction * 100:5.1f}% della clip (mediana)")
+
+    whole = whole_clip_costs(classifier, signals)
+    print(f"{'clip intera':<12} p50: {np.percentile(whole, 50):7.2f} ms   p99: {np.percentile(whole, 99):7.2f} ms")
+    for chunk_ms, chunk_size in zip(args.chunk_ms, chunk_sizes):
+        costs = chunk_costs(streaming, signals, chunk_size)
+        print(f"{f'blocco {chunk_ms} ms':<12} p50: {np.percentile(costs, 50):7.2f} ms   "
+              f"p99: {np.percentile(costs, 99):7.2f} ms   tempo reale: {np.percentile(costs, 50) / chunk_ms:.3f}x")
+
+    if not parity_ok:
+        print("[INFO] Parita' NON rispettata")
+        sys.exit(1)
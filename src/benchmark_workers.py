@@ -0,0 +1,127 @@
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import requests
+
+
+def load_clips(manifest_path, limit):
+    clips = []
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            with open(json.loads(line)["audio_filepath"], 'rb') as audio:
+                clips.append(audio.read())
+            if len(clips) >= limit:
+                break
+    return clips
+
+
+def process_tree(pid):
+    pids = [pid]
+    for child in pids:
+        try:
+            with open(f"/proc/{child}/task/{child}/children") as f:
+                pids.extend(int(p) for p in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def total_pss_mb(pid):
+    """Memoria proporzionale (PSS) del server e dei worker: le pagine condivise sono contate una volta sola."""
+    total = 0
+    for child in process_tree(pid):
+        try:
+            with open(f"/proc/{child}/smaps_rollup") as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith("Pss:"))
+        except (OSError, StopIteration):
+            return None
+    return total / 1024
+
+
+def start_server(model, workers, threads, port):
+    command = [sys.executable, "asr_server.py", "--model", model, "--port", str(port), "--workers", str(workers),
+               "--threads-per-worker", str(threads), "--archive-percent", "0"]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 300
+    while time.time() < deadline:
+        try:
+            # In prefork ogni risposta viene da un worker qualsiasi: attende che rispondano tutti
+            seen = {requests.get(f"http://localhost:{port}/stats", timeout=1).json()["worker"] for _ in range(workers * 8)}
+            if len(seen) >= workers or workers == 1:
+                return server
+        except requests.RequestException:
+            pass
+        if server.poll() is not None:
+            raise RuntimeError("Il server si e' chiuso durante l'avvio")
+        time.sleep(0.5)
+    server.kill()
+    raise RuntimeError("Timeout all'avvio del server")
+
+
+def run_load(port, clips, concurrency, duration):
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def client(offset):
+        session = requests.Session()
+        i = offset
+        while time.perf_counter() < stop_at:
+            start = time.perf_counter()
+            response = session.post(f"http://localhost:{port}/predict",
+                                    files={'file': ('audio.wav', clips[i % len(clips)], 'audio/wav')})
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                if response.ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+            i += concurrency
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return np.array(latencies), errors[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput di /predict al variare del numero di worker pre-fork.")
+    parser.add_argument("--model", default="../asr_model2.nemo")
+    parser.add_argument("--manifest", default="../val_manifest.json")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--concurrency", type=int, default=None, help="Client concorrenti (default: 4 x max-workers)")
+    parser.add_argument("--duration", type=float, default=20.0, help="Secondi di carico per configurazione")
+    parser.add_argument("--port", type=int, default=5101)
+    args = parser.parse_args()
+
+    clips = load_clips(args.manifest, 68)
+    concurrency = args.concurrency or 4 * args.max_workers
+    cores = os.cpu_count() or 1
+    counts = sorted({1, *[n for n in (2, 4, 8, 16, 32) if n < args.max_workers], args.max_workers})
+
+    baseline = None
+    for workers in counts:
+        threads = max(1, cores // workers)
+        server = start_server(args.model, workers, threads, args.port)
+        try:
+            run_load(args.port, clips, concurrency, min(3.0, args.duration))  # warm-up
+            latencies, errors = run_load(args.port, clips, concurrency, args.duration)
+            pss = total_pss_mb(server.pid)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=30)
+        throughput = len(latencies) / args.duration
+        baseline = baseline or throughput
+        memory = f"{pss:7.0f} MB" if pss is not None else "    n/d"
+        print(f"{workers:>2} worker x {threads:>2} thread   {throughput:7.1f} richieste/s ({throughput / baseline:4.2f}x)   "
+              f"p50: {np.percentile(latencies, 50):7.1f} ms   p99: {np.percentile(latencies, 99):7.1f} ms   "
+              f"PSS: {memory}   errori: {errors}")
@@ -1,19 +1,26 @@
 import os
-import subprocess
+import argparse
+import hashlib
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
 import librosa
 import numpy as np
 import soundfile as sf
 from scipy.signal import butter, lfilter
 import json
+from manifest import TRAIN_MANIFEST, build_manifests, probe_duration
 
-def add_background_noise(y, noise_factor=0.005):
-    noise = np.random.randn(len(y))
+def add_background_noise(y, noise_factor=0.005, rng=None):
+    rng = rng if rng is not None else np.random.default_rng()
+    noise = rng.standard_normal(len(y))
     augmented_data = y + noise_factor * noise
     return normalize_audio(augmented_data)
 
-def time_shift(y, shift_max=0.2):
-    shift = np.random.randint(int(len(y) * shift_max))
-    if np.random.randint(2):
+def time_shift(y, shift_max=0.2, rng=None):
+    rng = rng if rng is not None else np.random.default_rng()
+    shift = rng.integers(int(len(y) * shift_max))
+    if rng.integers(2):
         shift = -shift
     augmented_data = np.roll(y, shift)
     return normalize_audio(augmented_data)
@@ -38,15 +45,11 @@ def apply_highpass_filter(y, sr, cutoff=500):
 def normalize_audio(y):
     return y / np.max(np.abs(y)) if np.max(np.abs(y)) > 0 else y
 
-def update_manifest(manifest_path, file_path, duration, label):
-    """Aggiunge un file al manifest."""
-    entry = {
-        "audio_filepath": file_path,
-        "duration": duration,
-        "label": label
-    }
-    with open(manifest_path, 'a') as f:
-        f.write(json.dumps(entry) + '\n')
+def write_manifest(manifest_path, entries):
+    """Scrive il manifest in un'unica passata, nell'ordine ricevuto."""
+    with open(manifest_path, 'w') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
 
 def extract_label_from_path(file_path):
     """Estrae il label dal percorso del file."""
@@ -54,66 +57,244 @@ def extract_label_from_path(file_path):
     label = filename.split('_')[1].split('.')[0]  # Estrai la parte tra l'underscore e l'estensione
     return label
 
-def augment_data(input_dir, output_dir, manifest_path, sample_rate=16000):
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    
+# Tecniche di data augmentation: suffisso del file -> (funzione, parametri).
+# Suffisso e parametri fanno parte della chiave di cache di ogni file generato.
+AUGMENTATIONS = {
+    '_noise': (lambda y, sr, rng, **params: add_background_noise(y, rng=rng, **params), {'noise_factor': 0.005}),
+    '_timeshift': (lambda y, sr, rng, **params: time_shift(y, rng=rng, **params), {'shift_max': 0.2}),
+    '_pitch': (lambda y, sr, rng, **params: change_pitch_and_speed(y, sr, **params), {'n_steps': 2}),
+    '_lowpass': (lambda y, sr, rng, **params: apply_lowpass_filter(y, sr, **params), {'cutoff': 3000}),
+    '_highpass': (lambda y, sr, rng, **params: apply_highpass_filter(y, sr, **params), {'cutoff': 500}),
+}
+# Suffisso della copia dell'originale (ricampionato a sample_rate)
+ORIGINAL = ''
+CACHE_INDEX_NAME = '.augmentation_cache.json'
+# Percorsi predefiniti di input, output e manifest di training aumentato
+INPUT_DIR = '../audio'
+OUTPUT_DIR = '../augmented_audio'
+AUGMENTED_MANIFEST = '../train_manifest_augmented.json'
+
+def file_seed(base_seed, rel_path):
+    """Seed deterministico per file: non dipende dall'ordine di esecuzione ne' dal worker."""
+    digest = hashlib.sha256(f"{base_seed}:{rel_path}".encode()).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+def list_audio_files(input_dir):
+    """Elenca i .wav in ordine stabile, cosi' il manifest e' riproducibile."""
+    audio_files = []
     for subdir, dirs, files in os.walk(input_dir):
-        for file in files:
+        dirs.sort()
+        for file in sorted(files):
             if file.endswith('.wav'):
-                file_path = os.path.join(subdir, file)
-                try:
-                    y, sr = librosa.load(file_path, sr=sample_rate)
-                    duration = librosa.get_duration(y=y, sr=sr)
-                except Exception as e:
-                    print(f"Errore nel caricamento del file {file_path}: {e}")
-                    continue
-                
-                # Estrai l'etichetta dal nome del file (ad esempio "label.wav")
-                label = extract_label_from_path(file_path)
-
-
-                # Crea la stessa struttura di directory nell'output
-                rel_dir = os.path.relpath(subdir, input_dir)
-                output_subdir = os.path.join(output_dir, rel_dir)
-                os.makedirs(output_subdir, exist_ok=True)
-                
-                # Salva il file originale nella directory di output
-                output_file = os.path.join(output_subdir, file)
-                sf.write(output_file, y, sr)
-                update_manifest(manifest_path, output_file, duration, label)
-                
-                # Lista di tecniche di data augmentation
-                augmentations = [
-                    ('_noise', add_background_noise(y)),
-                    ('_timeshift', time_shift(y)), 
-                    ('_pitch', change_pitch_and_speed(y, sr)),
-                    ('_lowpass', apply_lowpass_filter(y, sr)),
-                    ('_highpass', apply_highpass_filter(y, sr)),
-                ]
-                
-                # Applica e salva ogni data augmentation
-                for aug_suffix, aug_data in augmentations:
-                    aug_file = file.replace('.wav', f'{aug_suffix}.wav')
-                    aug_file_path = os.path.join(output_subdir, aug_file)
-                    sf.write(aug_file_path, aug_data, sr)
-                    update_manifest(manifest_path, aug_file_path, duration, label)
+                audio_files.append(os.path.join(subdir, file))
+    return audio_files
+
+def list_manifest_files(manifest_path, input_dir):
+    """I .wav di input_dir elencati in un manifest (es. solo quelli di training), in ordine stabile."""
+    with open(manifest_path, 'r') as f:
+        paths = {json.loads(line)['audio_filepath'] for line in f}
+    root = os.path.abspath(input_dir) + os.sep
+    return sorted((path for path in paths if os.path.abspath(path).startswith(root)),
+                  key=lambda path: os.path.relpath(path, input_dir))
+
+def hash_file(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def output_key(source_hash, suffix, sample_rate, seed):
+    """Chiave di un file generato: contenuto sorgente + augmentation + parametri."""
+    params = AUGMENTATIONS[suffix][1] if suffix != ORIGINAL else {}
+    payload = json.dumps([source_hash, suffix, params, sample_rate, seed], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+def output_path(output_dir, rel_path, suffix):
+    """Stessa struttura di directory dell'input: gio1/gio1_avanti.wav -> gio1/gio1_avanti_noise.wav"""
+    stem, extension = os.path.splitext(rel_path)
+    return os.path.join(output_dir, f"{stem}{suffix}{extension}")
+
+def load_cache_index(output_dir):
+    index_path = os.path.join(output_dir, CACHE_INDEX_NAME)
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path, 'r') as f:
+        return json.load(f).get('sources', {})
+
+def save_cache_index(output_dir, sources):
+    # Scrittura atomica: un'interruzione non lascia un indice corrotto
+    index_path = os.path.join(output_dir, CACHE_INDEX_NAME)
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump({'version': 1, 'sources': sources}, f)
+    os.replace(index_path + '.tmp', index_path)
+
+def remove_outputs(output_dir, rel_path, suffixes):
+    for suffix in suffixes:
+        path = output_path(output_dir, rel_path, suffix)
+        if os.path.exists(path):
+            os.remove(path)
+
+def prune_outputs(output_dir, expected):
+    """Elimina i .wav di output_dir che non sono output di un sorgente attuale (anche se l'indice e' andato perso)."""
+    expected = {os.path.normpath(path) for path in expected}
+    pruned = 0
+    for subdir, dirs, files in os.walk(output_dir):
+        for file in files:
+            path = os.path.normpath(os.path.join(subdir, file))
+            if file.endswith('.wav') and path not in expected:
+                os.remove(path)
+                pruned += 1
+    return pruned
+
+def augment_file(file_path, input_dir, output_dir, sample_rate=16000, seed=0, suffixes=None):
+    """Genera i file richiesti (originale e/o augmentation) per un sorgente; restituisce la durata."""
+    try:
+        y, sr = librosa.load(file_path, sr=sample_rate)
+        duration = librosa.get_duration(y=y, sr=sr)
+    except Exception as e:
+        print(f"Errore nel caricamento del file {file_path}: {e}")
+        return None
+
+    rel_path = os.path.relpath(file_path, input_dir)
+    os.makedirs(os.path.dirname(output_path(output_dir, rel_path, ORIGINAL)), exist_ok=True)
+    if suffixes is None:
+        suffixes = [ORIGINAL] + list(AUGMENTATIONS)
+
+    for suffix in suffixes:
+        if suffix == ORIGINAL:
+            data = y
+        else:
+            # Un generatore per augmentation: rigenerarne una non cambia le altre
+            augment, params = AUGMENTATIONS[suffix]
+            data = augment(y, sr, np.random.default_rng(file_seed(seed, rel_path + suffix)), **params)
+        sf.write(output_path(output_dir, rel_path, suffix), data, sr)
+    return duration
+
+def _augment_task(args):
+    return augment_file(*args)
+
+def augment_data(input_dir, output_dir, manifest_path, sample_rate=16000, workers=1, seed=0, force=False,
+                 source_manifest=None):
+    """
+    Aumenta in modo incrementale i .wav di input_dir, distribuendo il lavoro su `workers` processi.
+    Con source_manifest solo i file elencati li' (il training): i parlanti di validazione non devono
+    finire, nemmeno aumentati, nel manifest di training.
+
+    Ogni file generato e' indicizzato dall'hash del sorgente piu' nome e parametri
+    dell'augmentation: quelli gia' presenti vengono saltati, quelli di sorgenti
+    rimossi o non piu' leggibili vengono cancellati, insieme a ogni altro .wav orfano in output_dir.
+    Il manifest e' ricostruito dall'indice alla fine.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    suffixes = [ORIGINAL] + list(AUGMENTATIONS)
+    cached_sources = {} if force else load_cache_index(output_dir)
+    sources = {}
+    tasks = []
+    audio_files = list_manifest_files(source_manifest, input_dir) if source_manifest else list_audio_files(input_dir)
+    for file_path in audio_files:
+        rel_path = os.path.relpath(file_path, input_dir)
+        stat = os.stat(file_path)
+        cached = cached_sources.get(rel_path, {})
+        # L'hash viene ricalcolato solo se dimensione o data di modifica sono cambiate
+        if cached.get('mtime_ns') == stat.st_mtime_ns and cached.get('size') == stat.st_size:
+            source_hash = cached['sha256']
+        else:
+            source_hash = hash_file(file_path)
+        same_source = cached.get('sha256') == source_hash
+
+        keys = {suffix: output_key(source_hash, suffix, sample_rate, seed) for suffix in suffixes}
+        cached_keys = cached.get('outputs', {}) if same_source else {}
+        missing = [suffix for suffix in suffixes
+                   if cached_keys.get(suffix) != keys[suffix]
+                   or not os.path.exists(output_path(output_dir, rel_path, suffix))]
+        remove_outputs(output_dir, rel_path, set(cached.get('outputs', {})) - set(suffixes))
+
+        sources[rel_path] = {
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'sha256': source_hash,
+            'label': extract_label_from_path(file_path),
+            'duration': cached.get('duration') if same_source else None,
+            'outputs': keys,
+        }
+        if not missing and sources[rel_path]['duration'] is None:
+            # Output gia' aggiornati: la durata si legge dall'header, senza decodificare e rigenerare
+            try:
+                sources[rel_path]['duration'] = probe_duration(file_path)
+            except Exception as e:
+                print(f"Errore nella lettura dell'header di {file_path}: {e}")
+                missing = suffixes
+        if missing:
+            tasks.append((file_path, input_dir, output_dir, sample_rate, seed, missing))
+
+    # Sorgenti spariti: eliminane gli output (l'indice su disco vale anche con force)
+    previous_sources = cached_sources if not force else load_cache_index(output_dir)
+    removed = [rel_path for rel_path in previous_sources if rel_path not in sources]
+    for rel_path in removed:
+        remove_outputs(output_dir, rel_path, previous_sources[rel_path].get('outputs', {}))
+
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            durations = list(executor.map(_augment_task, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+    else:
+        durations = [_augment_task(task) for task in tasks]
+
+    for task, duration in zip(tasks, durations):
+        rel_path = os.path.relpath(task[0], input_dir)
+        if duration is None:
+            # Sorgente non leggibile: via la voce dell'indice e gli output di generazioni precedenti
+            remove_outputs(output_dir, rel_path, suffixes)
+            del sources[rel_path]
+        else:
+            sources[rel_path]['duration'] = duration
+    save_cache_index(output_dir, sources)
+
+    entries = [
+        {"audio_filepath": output_path(output_dir, rel_path, suffix), "duration": source['duration'], "label": source['label']}
+        for rel_path, source in sources.items()
+        for suffix in suffixes
+    ]
+    write_manifest(manifest_path, entries)
+    pruned = prune_outputs(output_dir, [entry["audio_filepath"] for entry in entries])
+    generated = sum(len(task[5]) for task, duration in zip(tasks, durations) if duration is not None)
+    print(f"[CACHE] {len(sources)} sorgenti, {generated} file generati, "
+          f"{len(entries) - generated} riutilizzati, {len(removed)} sorgenti rimossi, {pruned} file orfani eliminati")
+    return len(sources), entries
+
+def timed_augment(input_dir, output_dir, manifest_path, workers, seed, force=False, source_manifest=None):
+    start = time.perf_counter()
+    num_files, entries = augment_data(input_dir, output_dir, manifest_path, workers=workers, seed=seed, force=force,
+                                      source_manifest=source_manifest)
+    elapsed = time.perf_counter() - start
+    print(f"[TEMPO] {num_files} file sorgente, {len(entries)} voci di manifest, {workers} worker: "
+          f"{elapsed:.2f} s ({num_files / elapsed:.1f} file/s)")
+    return elapsed
 
 if __name__ == "__main__":
-    input_directory = '../audio'    
-    output_directory = '../augmented_audio'
-    manifest_path = '../train_manifest_augmented.json'
-
-    # Esegui il primo script di data augmentation
-    script1 = 'manifest.py'
-    result1 = subprocess.run(['python3', script1], capture_output=True, text=True)
-    print(f"Uscita di {script1}:\n{result1.stdout}")
-    if result1.stderr:
-        print(f"Errori di {script1}:\n{result1.stderr}")
-    
-    # Crea un nuovo manifest o svuota il vecchio
-    open(manifest_path, 'w').close()
-    
+    parser = argparse.ArgumentParser(description="Data augmentation dei file audio e creazione del manifest di training.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processi paralleli (1 = seriale)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed base: ogni file riceve un seed derivato dal suo percorso")
+    parser.add_argument("--force", action="store_true", help="Ignora la cache e rigenera tutti i file")
+    parser.add_argument("--compare-serial", action="store_true",
+                        help="Rigenera tutto e confronta con la versione seriale in una directory temporanea")
+    args = parser.parse_args()
+
+    input_directory = INPUT_DIR
+    output_directory = OUTPUT_DIR
+    manifest_path = AUGMENTED_MANIFEST
+
+    # Manifest degli originali e divisione training/validation, nello stesso processo
+    build_manifests()
+
     print("[INFO] Inizio del processo di data augmentation...")
-    augment_data(input_directory, output_directory, manifest_path)
+    # Solo i file di training: la validazione resta fatta di parlanti mai visti, nemmeno aumentati
+    parallel_time = timed_augment(input_directory, output_directory, manifest_path, args.workers, args.seed,
+                                  force=args.force or args.compare_serial, source_manifest=TRAIN_MANIFEST)
     print("[INFO] Processo di data augmentation completato. Manifest aggiornato!")
+
+    if args.compare_serial:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            serial_time = timed_augment(input_directory, os.path.join(tmp_dir, 'audio'),
+                                        os.path.join(tmp_dir, 'manifest.json'), 1, args.seed,
+                                        source_manifest=TRAIN_MANIFEST)
+        print(f"[TEMPO] Speedup con {args.workers} worker: {serial_time / parallel_time:.2f}x")
@@ -1,22 +1,43 @@
 import nemo.collections.asr as nemo_asr
-from difflib import SequenceMatcher
-from nemo.collections.asr.metrics.wer import word_error_rate
+from torch.utils.data import DataLoader, Dataset
+from inference import CommandClassifier, decode_audio
+from asr_metrics import char_error_rate, compute_metrics
+import argparse
 import json
+import numpy as np
 import torch
 import os
 
 
+class ManifestAudioDataset(Dataset):
+    """Decodifica gli audio del manifest (eseguito nei worker del DataLoader)."""
+
+    def __init__(self, audio_paths):
+        self.audio_paths = audio_paths
+
+    def __len__(self):
+        return len(self.audio_paths)
+
+    def __getitem__(self, idx):
+        with open(self.audio_paths[idx], 'rb') as f:
+            return decode_audio(f.read())
+
+
 class ASRInference:
-    def __init__(self, model_path, val_manifest, use_gpu=True):
-        # Load the ASR classification model
-        self.model = nemo_asr.models.EncDecClassificationModel.restore_from(model_path)
+    def __init__(self, model_path, val_manifest, use_gpu=True, batch_size=32, num_workers=4, verbose=False, model=None):
+        # Load the ASR classification model (oppure usa quello gia' in memoria, ad esempio appena addestrato)
+        self.model = model if model is not None else nemo_asr.models.EncDecClassificationModel.restore_from(model_path)
         self.audio_paths = self.load_audio_paths(val_manifest)
         # Get labels from the model configuration
         self.labels = self.model.cfg.labels
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.verbose = verbose
         # Set the model to evaluation mode
         self.model.eval()
         if use_gpu and torch.cuda.is_available():
             self.model.cuda()
+        self.classifier = CommandClassifier(self.model, self.labels)
 
     @staticmethod
     def load_audio_paths(manifest_path):
@@ -24,22 +45,25 @@ class ASRInference:
         with open(manifest_path, 'r') as f:
             return [json.loads(line)["audio_filepath"] for line in f]
 
-    def transcribe_audio(self):
-        # Esegue la trascrizione per i file audio specificati
-        transcriptions = []
-        with torch.no_grad():
-            for audio_path in self.audio_paths:
-                transcription = self.model.transcribe([audio_path])
-                
-                # Converti l'indice in una stringa di etichetta
-                if isinstance(transcription[0], torch.Tensor):
-                    index = transcription[0].item()  # Estrai l'indice dal tensore
-                    predicted_label = self.labels[index] if 0 <= index < len(self.labels) else "indice_non_valido"
-                else:
-                    predicted_label = transcription[0]
-                
-                print(f"Raw model output for {audio_path}: {transcription}, Predicted Label: {predicted_label}")
-                transcriptions.append(predicted_label)
+    def compute_logits(self):
+        """Logits [N, num_classes] per tutto il manifest, calcolati a batch."""
+        loader = DataLoader(
+            ManifestAudioDataset(self.audio_paths),
+            batch_size=self.batch_size,
+            num_workers=self.num_workers,
+            collate_fn=list,
+        )
+        return torch.cat([self.classifier.logits(signals) for signals in loader]).numpy()
+
+    def transcribe_audio(self, logits=None):
+        # Converte i logits (un forward per batch) nelle etichette predette
+        if logits is None:
+            logits = self.compute_logits()
+        indices = logits.argmax(axis=1)
+        transcriptions = [self.labels[index] for index in indices]
+        if self.verbose:
+            for audio_path, predicted_label in zip(self.audio_paths, transcriptions):
+                print(f"Raw model output for {audio_path}: Predicted Label: {predicted_label}")
         return transcriptions
 
     def extract_label_from_path(self, path):
@@ -51,17 +75,15 @@ class ASRInference:
         except IndexError:
             print(f"Error extracting label from file: {base}")
             return None
-    
+
     def calculate_cer(self, hypotheses, references):
         """
-        Calcola il CER (Character Error Rate).
+        Calcola il CER (Character Error Rate) con la distanza di Levenshtein.
         """
-        total_chars = sum(len(ref) for ref in references)
-        total_errors = sum(
-            len(ref) + len(hyp) - 2 * sum(block.size for block in SequenceMatcher(None, ref, hyp).get_matching_blocks())
-            for ref, hyp in zip(references, hypotheses)
-        )
-        return total_errors / total_chars if total_chars > 0 else 0
+        return char_error_rate(hypotheses, references)
+
+    def compute_metrics(self, predictions, targets):
+        return compute_metrics(predictions, targets, self.labels)
 
     def display_results(self):
         """
@@ -70,66 +92,64 @@ class ASRInference:
         print("========================")
         print("Inizio Trascrizione e Valutazione")
         print("========================")
-        
-        # Trascrivi gli audio
-        transcriptions = self.transcribe_audio()
-        correct = []
-        incorrect = []
-
-        for idx, (path, transcription) in enumerate(zip(self.audio_paths, transcriptions), start=1):
-            # Estrai il ground truth dall'etichetta
-            ground_truth = self.extract_label_from_path(path)
-            if ground_truth is None:
-                continue
-
-            # Determina il label predetto
-            predicted_label = transcription.lower() if isinstance(transcription, str) else "formato_non_riconosciuto"
-
-            # Confronta label predetto e ground truth
-            if predicted_label == ground_truth:
-                correct.append((path, predicted_label))
-            else:
-                incorrect.append((path, ground_truth, predicted_label))
-
-            # Mostra i risultati per file
-            print(f"File {idx}: {path}")
-            print(f"   Ground Truth: {ground_truth}")
-            print(f"   Prediction:   {predicted_label}")
-            print("---------------------------")
-
-        # Calcola statistiche di accuratezza
-        total = len(correct) + len(incorrect)
-        accuracy = (len(correct) / total) * 100 if total > 0 else 0
+
+        # Un forward per batch su tutto il manifest
+        logits = self.compute_logits()
+        transcriptions = self.transcribe_audio(logits)
+
+        # Estrai il ground truth dall'etichetta, scartando i file con nome non valido
+        label_index = {label: i for i, label in enumerate(self.labels)}
+        ground_truths = [self.extract_label_from_path(path) for path in self.audio_paths]
+        valid = np.array([label in label_index for label in ground_truths], dtype=bool)
+        targets = np.array([label_index[label] for label in ground_truths if label in label_index], dtype=np.int64)
+        predictions = logits.argmax(axis=1)[valid]
+        metrics = self.compute_metrics(predictions, targets)
+
+        if self.verbose:
+            for idx, (path, ground_truth, predicted_label) in enumerate(zip(self.audio_paths, ground_truths, transcriptions), start=1):
+                print(f"File {idx}: {path}")
+                print(f"   Ground Truth: {ground_truth}")
+                print(f"   Prediction:   {predicted_label}")
+                print("---------------------------")
 
         # Mostra statistiche generali
         print("========================")
         print("Risultati Generali")
         print("========================")
-        print(f"Total files analyzed: {total}")
-        print(f"Correct predictions: {len(correct)}")
-        print(f"Incorrect predictions: {len(incorrect)}")
-        print(f"Accuracy percentage: {accuracy:.2f}%\n")
+        print(f"Total files analyzed: {metrics['total']}")
+        print(f"Correct predictions: {metrics['correct']}")
+        print(f"Incorrect predictions: {metrics['total'] - metrics['correct']}")
+        print(f"Accuracy percentage: {metrics['accuracy']:.2f}%\n")
 
-        # Carica WER e CER
-        ground_truths = [self.extract_label_from_path(path) for path in self.audio_paths]
-        wer = word_error_rate(hypotheses=transcriptions, references=ground_truths)
-        cer = self.calculate_cer(transcriptions, ground_truths)
+        print("========================")
+        print("Matrice di Confusione (righe: ground truth, colonne: predizioni)")
+        print("========================")
+        print(" " * 10 + " ".join(f"{label[:4]:>4}" for label in self.labels))
+        for label, row in zip(self.labels, metrics['confusion_matrix']):
+            print(f"{label:<10}" + " ".join(f"{count:>4}" for count in row))
 
         # Mostra metriche di valutazione
         print("========================")
         print("Metriche di Valutazione")
         print("========================")
-        print(f"Word Error Rate (WER): {wer:.2f}")
-        print(f"Character Error Rate (CER): {cer:.2f}")
-
-
-# Parameters for inference
-model_path = "../asr_model.nemo"
-print("Model path:", model_path)
-
-val_manifest = "../val_manifest.json"
-
-# Perform inference
-inference = ASRInference(model_path, val_manifest)
-inference.display_results()
-
+        print(f"Word Error Rate (WER): {metrics['wer']:.2f}")
+        print(f"Character Error Rate (CER): {metrics['cer']:.2f}")
+        return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Valutazione a batch del modello sul manifest di validazione.")
+    parser.add_argument("--model", default="../asr_model.nemo")
+    parser.add_argument("--manifest", default="../val_manifest.json")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--num-workers", type=int, default=4, help="Worker del DataLoader per la decodifica degli audio")
+    parser.add_argument("--verbose", action="store_true", help="Stampa il risultato di ogni singolo file")
+    args = parser.parse_args()
+
+    # Parameters for inference
+    print("Model path:", args.model)
+
+    # Perform inference
+    inference = ASRInference(args.model, args.manifest, batch_size=args.batch_size,
+                             num_workers=args.num_workers, verbose=args.verbose)
+    inference.display_results()
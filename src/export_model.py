@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+from torch import nn
+from nemo.collections.asr.models import ASRModel
+from nemo.core.classes import typecheck
+
+from inference import classify_encoded
+from mel_frontend import MelFrontend
+
+
+class ExportableClassifier(nn.Module):
+    """Grafo completo audio -> logits: frontend mel, encoder Jasper e decoder di classificazione."""
+
+    def __init__(self, frontend, encoder, decoder):
+        super().__init__()
+        self.frontend = frontend
+        self.encoder = encoder
+        self.decoder = decoder
+
+    def forward(self, audio_signal, length):
+        features, feature_length = self.frontend(audio_signal, length)
+        encoded, encoded_len = self.encoder(audio_signal=features, length=feature_length)
+        # Pooling sui soli frame validi, come CommandClassifier: stesso risultato in batch e clip per clip
+        return classify_encoded(self.decoder, encoded, encoded_len)
+
+
+def build_frontend(model, sample_rate=16000):
+    """
+    Copia il preprocessor del modello in un MelFrontend e sceglie il padding della STFT
+    (constant/reflect, dipende dalla versione di NeMo) confrontando le feature prodotte.
+    """
+    preprocessor = model.preprocessor
+    preprocessor.featurizer.dither = 0.0
+    preprocessor.featurizer.pad_to = 0
+    audio = torch.from_numpy(np.random.default_rng(0).standard_normal((1, sample_rate)).astype(np.float32)) * 0.1
+    length = torch.tensor([sample_rate])
+    with torch.no_grad():
+        reference, _ = preprocessor(input_signal=audio, length=length)
+        best = None
+        for pad_mode in ("constant", "reflect"):
+            frontend = MelFrontend.from_nemo(preprocessor, pad_mode=pad_mode)
+            error = (frontend(audio, length)[0] - reference.cpu()).abs().max().item()
+            if best is None or error < best[0]:
+                best = (error, frontend)
+    print(f"[INFO] Frontend mel: padding '{best[1].pad_mode}', errore massimo rispetto a NeMo {best[0]:.2e}")
+    return best[1]
+
+
+def export(model_path, output_path, export_format="torchscript", opset=17):
+    model = ASRModel.restore_from(model_path, map_location="cpu")
+    model.eval()
+    labels = list(model.cfg.labels)
+
+    frontend = build_frontend(model, model.cfg.sample_rate)
+    # Stessa preparazione usata da NeMo per l'export (niente typecheck), ma le MaskedConv1d restano
+    # mascherate: senza maschera il padding di un batch entrerebbe nelle conv delle clip piu' corte
+    masked = {name for name, module in model.encoder.named_modules() if getattr(module, "use_mask", False)}
+    for module in (model.encoder, model.decoder):
+        if hasattr(module, "_prepare_for_export"):
+            module._prepare_for_export()
+    for name, module in model.encoder.named_modules():
+        if name in masked and hasattr(module, "use_mask"):
+            module.use_mask = True
+    wrapper = ExportableClassifier(torch.jit.script(frontend), model.encoder, model.decoder).eval()
+
+    audio = torch.randn(2, model.cfg.sample_rate) * 0.1
+    length = torch.tensor([model.cfg.sample_rate, model.cfg.sample_rate // 2])
+    with torch.no_grad(), typecheck.disable_checks():
+        if export_format == "onnx":
+            import onnx
+
+            torch.onnx.export(
+                wrapper, (audio, length), output_path,
+                input_names=["audio_signal", "length"], output_names=["logits"],
+                dynamic_axes={"audio_signal": {0: "batch", 1: "time"}, "length": {0: "batch"}, "logits": {0: "batch"}},
+                opset_version=opset,
+            )
+            # Le etichette viaggiano nei metadati del modello ONNX
+            onnx_model = onnx.load(output_path)
+            entry = onnx_model.metadata_props.add()
+            entry.key, entry.value = "labels", json.dumps(labels)
+            onnx.save(onnx_model, output_path)
+        else:
+            traced = torch.jit.trace(wrapper, (audio, length), check_trace=False)
+            traced = torch.jit.freeze(traced)
+            torch.jit.save(traced, output_path, _extra_files={"labels.json": json.dumps(labels)})
+
+    print(f"[INFO] Modello esportato in {output_path} ({os.path.getsize(output_path) / 1e6:.2f} MB)")
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Esporta un modello .nemo in un grafo TorchScript/ONNX autonomo (preprocessor incluso).")
+    parser.add_argument("model", nargs="?", default="../asr_model2.nemo", help="Checkpoint .nemo da esportare")
+    parser.add_argument("--format", choices=["torchscript", "onnx"], default="torchscript")
+    parser.add_argument("--output", default=None, help="File di destinazione (default: stesso nome con estensione .ts/.onnx)")
+    parser.add_argument("--opset", type=int, default=17, help="Versione opset ONNX")
+    args = parser.parse_args()
+
+    extension = ".onnx" if args.format == "onnx" else ".ts"
+    output = args.output or os.path.splitext(args.model)[0] + extension
+    export(args.model, output, args.format, args.opset)
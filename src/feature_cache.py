@@ -0,0 +1,211 @@
+import argparse
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from functools import partial
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+from torch import nn
+from torch.utils.data import DataLoader, Dataset
+from nemo.collections.asr.models import EncDecClassificationModel
+from nemo.core.classes import typecheck
+
+from inference import decode_audio, pad_batch
+
+FEATURES_FILE = "features.f32"
+INDEX_FILE = "index.npz"
+META_FILE = "meta.json"
+
+
+def cache_fingerprint(manifest_path, preprocessor_cfg, labels):
+    """
+    Impronta di manifest, file audio e configurazione del preprocessor: se cambia la cache va ricostruita.
+    Il manifest contiene solo i percorsi e data_augmentation.py riscrive i file con lo stesso nome:
+    dimensione e data di modifica di ogni file fanno parte dell'impronta.
+    """
+    digest = hashlib.sha256()
+    with open(manifest_path, 'rb') as f:
+        for line in f:
+            digest.update(line)
+            stat = os.stat(json.loads(line)["audio_filepath"])
+            digest.update(f"{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    digest.update(json.dumps(OmegaConf.to_container(preprocessor_cfg, resolve=True), sort_keys=True).encode())
+    digest.update(json.dumps(list(labels)).encode())
+    return digest.hexdigest()
+
+
+def is_cache_valid(cache_dir, fingerprint):
+    meta_path = os.path.join(cache_dir, META_FILE)
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, 'r') as f:
+        return json.load(f).get("fingerprint") == fingerprint
+
+
+def build_feature_cache(manifest_path, cache_dir, preprocessor_cfg, labels, batch_size=32, force=False):
+    """
+    Calcola una sola volta le feature log-mel di un manifest e le salva in un unico
+    array [frame totali, n_mels] (float32 grezzo, letto con np.memmap) piu' un indice
+    con offset, lunghezze ed etichette di ogni clip.
+    """
+    fingerprint = cache_fingerprint(manifest_path, preprocessor_cfg, labels)
+    if not force and is_cache_valid(cache_dir, fingerprint):
+        print(f"[CACHE] Feature gia' aggiornate in {cache_dir}")
+        return cache_dir
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # Senza meta.json la cache non e' valida: una ricostruzione interrotta non lascia
+    # feature e indice a meta' accanto all'impronta della cache precedente
+    meta_path = os.path.join(cache_dir, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    preprocessor = EncDecClassificationModel.from_config_dict(preprocessor_cfg)
+    preprocessor.eval()
+    # Feature deterministiche: niente dither e nessun padding a multipli di pad_to
+    preprocessor.featurizer.dither = 0.0
+    preprocessor.featurizer.pad_to = 0
+
+    with open(manifest_path, 'r') as f:
+        entries = [json.loads(line) for line in f]
+    label_index = {label: i for i, label in enumerate(labels)}
+
+    offsets, lengths = [], []
+    offset = 0
+    with open(os.path.join(cache_dir, FEATURES_FILE), 'wb') as features_file, torch.no_grad():
+        for start in range(0, len(entries), batch_size):
+            signals = []
+            for entry in entries[start:start + batch_size]:
+                with open(entry["audio_filepath"], 'rb') as audio:
+                    signals.append(decode_audio(audio.read()))
+            audio, audio_len = pad_batch(signals)
+            features, features_len = preprocessor(input_signal=audio, length=audio_len)
+            for clip, clip_len in zip(features, features_len.tolist()):
+                # Layout [T, n_mels]: ogni clip e' una fetta contigua del file
+                features_file.write(clip[:, :clip_len].t().contiguous().numpy().tobytes())
+                offsets.append(offset)
+                lengths.append(clip_len)
+                offset += clip_len
+
+    np.savez(
+        os.path.join(cache_dir, INDEX_FILE),
+        offsets=np.array(offsets, dtype=np.int64),
+        lengths=np.array(lengths, dtype=np.int64),
+        labels=np.array([label_index[entry["label"]] for entry in entries], dtype=np.int64),
+    )
+    # meta.json per ultimo e in modo atomico: esiste solo se feature e indice sono completi
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump({
+            "fingerprint": fingerprint,
+            "manifest": manifest_path,
+            "n_mels": int(preprocessor_cfg.features),
+            "pad_to": int(preprocessor_cfg.get("pad_to", 16)),
+            "total_frames": offset,
+            "labels": list(labels),
+        }, f)
+    os.replace(meta_path + '.tmp', meta_path)
+    print(f"[CACHE] {len(entries)} clip, {offset} frame salvati in {cache_dir}")
+    return cache_dir
+
+
+class MelFeatureDataset(Dataset):
+    """Legge le feature dalla cache senza copie: ogni elemento e' una vista sul file mappato in memoria."""
+
+    def __init__(self, cache_dir):
+        with open(os.path.join(cache_dir, META_FILE), 'r') as f:
+            meta = json.load(f)
+        index = np.load(os.path.join(cache_dir, INDEX_FILE))
+        self.offsets = index["offsets"]
+        self.lengths = index["lengths"]
+        self.labels = index["labels"]
+        self.features_path = os.path.join(cache_dir, FEATURES_FILE)
+        self.shape = (meta["total_frames"], meta["n_mels"])
+        self.pad_to = meta.get("pad_to", 0)
+        self._features = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        # Il memmap viene aperto in modo pigro, quindi una volta per ogni worker del DataLoader.
+        # mode='c' restituisce viste scrivibili (copy-on-write) senza copiare i dati
+        if self._features is None:
+            self._features = np.memmap(self.features_path, dtype=np.float32, mode='c', shape=self.shape)
+        start = self.offsets[idx]
+        return self._features[start:start + self.lengths[idx]], int(self.labels[idx])
+
+
+def collate_features(batch, pad_to=0):
+    """
+    Stesso formato dei batch NeMo (segnale, lunghezza, etichetta, lunghezza etichetta), con
+    feature [B, n_mels, T]. Come il preprocessor in training, T e' arrotondato a un multiplo di pad_to.
+    """
+    lengths = torch.tensor([len(features) for features, _ in batch], dtype=torch.long)
+    max_len = int(lengths.max())
+    if pad_to > 0 and max_len % pad_to:
+        max_len += pad_to - max_len % pad_to
+    padded = torch.zeros(len(batch), batch[0][0].shape[1], max_len, dtype=torch.float32)
+    for i, (features, _) in enumerate(batch):
+        padded[i, :, :len(features)] = torch.from_numpy(features).t()
+    labels = torch.tensor([label for _, label in batch], dtype=torch.long)
+    return padded, lengths, labels, torch.ones_like(labels)
+
+
+def feature_loader(cache_dir, batch_size, shuffle=False, num_workers=0):
+    dataset = MelFeatureDataset(cache_dir)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                      collate_fn=partial(collate_features, pad_to=dataset.pad_to), pin_memory=torch.cuda.is_available())
+
+
+class PrecomputedFeatures(nn.Module):
+    """Sostituisce il preprocessor durante il training: il batch contiene gia' le feature."""
+
+    def forward(self, input_signal, length):
+        return input_signal, length
+
+
+@contextmanager
+def cached_features(model, train_cache_dir, val_cache_dir, train_cfg, val_cfg):
+    """
+    Addestra `model` leggendo le feature dalla cache invece di decodificare audio e calcolare la STFT.
+    SpecAugment resta attivo; all'uscita il preprocessor originale viene ripristinato,
+    quindi il modello salvato con save_to() lavora ancora su audio grezzo.
+    """
+    original = model.preprocessor
+    model._train_dl = feature_loader(train_cache_dir, train_cfg.batch_size, train_cfg.get("shuffle", True),
+                                     train_cfg.get("num_workers", 0))
+    model._validation_dl = feature_loader(val_cache_dir, val_cfg.batch_size, False, val_cfg.get("num_workers", 0))
+    model.preprocessor = PrecomputedFeatures()
+    # I controlli sui tipi NeMo si aspettano audio [B, T] in input al modello
+    typecheck.set_typecheck_enabled(False)
+    try:
+        yield model
+    finally:
+        typecheck.set_typecheck_enabled(True)
+        model.preprocessor = original.to(model.device)
+
+
+def prepare_caches(cfg, cache_root, force=False):
+    """Costruisce (se necessario) le cache di training e validazione e ne restituisce le directory."""
+    train_dir = os.path.join(cache_root, "train")
+    val_dir = os.path.join(cache_root, "validation")
+    build_feature_cache(cfg.model.train_ds.manifest_filepath, train_dir, cfg.model.preprocessor, cfg.model.labels, force=force)
+    build_feature_cache(cfg.model.validation_ds.manifest_filepath, val_dir, cfg.model.preprocessor, cfg.model.labels, force=force)
+    return train_dir, val_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precalcola le feature log-mel dei manifest di training e validazione.")
+    parser.add_argument("--config", default="../config.yaml")
+    parser.add_argument("--train-manifest", default="../train_manifest_augmented.json")
+    parser.add_argument("--val-manifest", default="../val_manifest.json")
+    parser.add_argument("--cache-dir", default="../feature_cache")
+    parser.add_argument("--force", action="store_true", help="Ricostruisce la cache anche se aggiornata")
+    args = parser.parse_args()
+
+    cfg = OmegaConf.load(args.config)
+    cfg.model.train_ds.manifest_filepath = args.train_manifest
+    cfg.model.validation_ds.manifest_filepath = args.val_manifest
+    prepare_caches(cfg, args.cache_dir, args.force)
@@ -0,0 +1,191 @@
+import io
+import json
+import os
+import time
+from contextlib import contextmanager
+from math import gcd
+
+import numpy as np
+import soundfile as sf
+import torch
+from scipy.signal import resample_poly
+
+SAMPLE_RATE = 16000
+# Risposta quando nessun comando supera la soglia di confidenza
+UNKNOWN_COMMAND = "unknown"
+
+
+def decode_audio(data, sample_rate=SAMPLE_RATE):
+    """Decodifica un file audio (bytes) in memoria in un array mono float32."""
+    audio, sr = sf.read(io.BytesIO(data), dtype='float32', always_2d=True)
+    # Stessa conversione di NeMo: media dei canali per ottenere un segnale mono
+    audio = audio.mean(axis=1)
+    if sr != sample_rate:
+        divisor = gcd(sr, sample_rate)
+        audio = resample_poly(audio, sample_rate // divisor, sr // divisor)
+    return np.ascontiguousarray(audio, dtype=np.float32)
+
+
+def pad_batch(signals):
+    """Impacchetta una lista di segnali 1D in un tensore [B, T] con le relative lunghezze."""
+    lengths = torch.tensor([len(s) for s in signals], dtype=torch.long)
+    batch = torch.zeros(len(signals), int(lengths.max()), dtype=torch.float32)
+    for i, signal in enumerate(signals):
+        batch[i, :len(signal)] = torch.from_numpy(signal)
+    return batch, lengths
+
+
+def valid_frames(encoded, lengths):
+    """Maschera [B, 1, T] dei frame che cadono dentro la lunghezza di ogni clip."""
+    return (torch.arange(encoded.shape[2], device=encoded.device).unsqueeze(0) < lengths.unsqueeze(1)).unsqueeze(1)
+
+
+def masked_mean(encoded, lengths):
+    """Media temporale [B, C, T] -> [B, C] sui soli frame validi: il padding del batch non entra nel pooling."""
+    valid = valid_frames(encoded, lengths)
+    total = torch.where(valid, encoded, torch.zeros_like(encoded)).sum(dim=2)
+    return total / lengths.clamp(min=1).unsqueeze(1).to(encoded.dtype)
+
+
+def classify_encoded(decoder, encoded, encoded_len):
+    """
+    Equivalente di ConvASRDecoderClassification.forward, ma con pooling limitato a encoded_len.
+    Il decoder di NeMo fa la media su tutti i frame, compresi quelli di padding (le MaskedConv1d
+    non azzerano l'uscita oltre la lunghezza): in un batch il risultato dipenderebbe dalle altre clip.
+    """
+    if isinstance(decoder.pooling, torch.nn.AdaptiveMaxPool1d):
+        pooled = encoded.masked_fill(~valid_frames(encoded, encoded_len), float("-inf")).amax(dim=2)
+    else:
+        pooled = masked_mean(encoded, encoded_len)
+    return decoder.decoder_layers(pooled)
+
+
+class _Classifier:
+    """Interfaccia comune: logits() su una lista di segnali e conversione indice -> comando."""
+
+    labels = []
+    # Funzione opzionale (fase, secondi) chiamata a ogni batch con la durata di "features" e "forward"
+    stage_observer = None
+
+    def logits(self, signals):
+        raise NotImplementedError
+
+    def _observe(self, stage, started_at):
+        if self.stage_observer is not None:
+            self.stage_observer(stage, time.perf_counter() - started_at)
+
+    def label_for(self, index):
+        return self.labels[index] if 0 <= index < len(self.labels) else UNKNOWN_COMMAND
+
+    def rank(self, logits, top_k=3):
+        """Softmax sui logits di una clip: i top_k comandi piu' probabili come [(comando, probabilita'), ...]."""
+        probabilities = torch.softmax(torch.as_tensor(logits).float(), dim=-1)
+        values, indices = probabilities.topk(min(top_k, probabilities.numel()))
+        return [(self.label_for(int(index)), float(value)) for value, index in zip(values, indices)]
+
+    def predict(self, signal):
+        """Classifica un singolo segnale e restituisce il comando riconosciuto."""
+        index = int(self.logits([signal]).argmax(dim=-1)[0])
+        return self.label_for(index)
+
+
+@contextmanager
+def inference_settings(model):
+    """
+    Come model.transcribe(): modalita' eval, niente dither ne' padding a multipli di pad_to, ripristinati
+    all'uscita. Il modello puo' essere quello ancora in memoria dopo il training, che deve restare invariato.
+    """
+    featurizer = model.preprocessor.featurizer
+    dither, pad_to, training = featurizer.dither, featurizer.pad_to, model.training
+    featurizer.dither = 0.0
+    featurizer.pad_to = 0
+    if training:
+        model.eval()
+    try:
+        yield model
+    finally:
+        featurizer.dither = dither
+        featurizer.pad_to = pad_to
+        if training:
+            model.train()
+
+
+class CommandClassifier(_Classifier):
+    """Esegue preprocessor, encoder e decoder direttamente su audio gia' in memoria."""
+
+    def __init__(self, model, labels=None):
+        self.model = model
+        self.labels = list(labels) if labels is not None else list(model.cfg.labels)
+        self.device = next(self.model.parameters()).device
+
+    def logits(self, signals):
+        """Restituisce i logits [B, num_classes] per una lista di segnali."""
+        audio, lengths = pad_batch(signals)
+        with torch.inference_mode(), inference_settings(self.model):
+            # Preprocessor separato dal resto del forward per misurare le due fasi
+            started_at = time.perf_counter()
+            features, feature_lengths = self.model.preprocessor(
+                input_signal=audio.to(self.device),
+                length=lengths.to(self.device),
+            )
+            self._observe("features", started_at)
+            started_at = time.perf_counter()
+            # Encoder e decoder separati: il pooling usa encoded_len, cosi' i logits di una clip
+            # non cambiano con le altre clip del batch
+            encoded, encoded_len = self.model.encoder(audio_signal=features, length=feature_lengths)
+            logits = classify_encoded(self.model.decoder, encoded, encoded_len).float().cpu()
+            self._observe("forward", started_at)
+            return logits
+
+
+class ExportedClassifier(_Classifier):
+    """
+    Esegue un modello esportato da export_model.py (TorchScript .ts oppure ONNX .onnx)
+    senza importare NeMo. Le etichette sono salvate insieme al grafo.
+    """
+
+    def __init__(self, model_path, labels=None):
+        self.model_path = model_path
+        if model_path.endswith(".onnx"):
+            import onnxruntime
+
+            self.session = onnxruntime.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+            stored_labels = self.session.get_modelmeta().custom_metadata_map.get("labels")
+            self.module = None
+        else:
+            extra_files = {"labels.json": ""}
+            self.module = torch.jit.load(model_path, map_location="cpu", _extra_files=extra_files)
+            self.module.eval()
+            stored_labels = extra_files["labels.json"] or None
+            self.session = None
+        if labels is None:
+            labels = json.loads(stored_labels) if stored_labels else []
+        self.labels = list(labels)
+
+    def logits(self, signals):
+        # Frontend mel e rete sono un unico grafo: la durata viene registrata tutta come "forward"
+        audio, lengths = pad_batch(signals)
+        started_at = time.perf_counter()
+        if self.session is not None:
+            outputs = self.session.run(None, {"audio_signal": audio.numpy(), "length": lengths.numpy()})
+            logits = torch.from_numpy(outputs[0])
+        else:
+            with torch.inference_mode():
+                logits = self.module(audio, lengths).float()
+        self._observe("forward", started_at)
+        return logits
+
+
+def quantized_path(model_path):
+    """Percorso predefinito del modello int8 (quantize_model.py): ../asr_model2.nemo -> ../asr_model2.int8.ts"""
+    return os.path.splitext(model_path)[0] + ".int8.ts"
+
+
+def load_classifier(model_path, labels=None):
+    """Carica il classificatore adatto all'estensione del modello (.nemo, .ts/.pt, .onnx)."""
+    if model_path.endswith(".nemo"):
+        # NeMo viene importato solo quando serve davvero
+        from nemo.collections.asr.models import ASRModel
+
+        return CommandClassifier(ASRModel.restore_from(model_path), labels)
+    return ExportedClassifier(model_path, labels)
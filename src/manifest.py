@@ -1,60 +1,246 @@
 import os
 import json
-import librosa
+import re
 import random
+import argparse
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-def create_manifest(data_dir, manifest_path):
+import soundfile as sf
+
+# Indice accanto al manifest: percorso -> [dimensione, mtime_ns, durata] dell'ultima generazione
+PROBE_CACHE_SUFFIX = '.probe_cache.json'
+
+# Directory dei file audio originali
+DATA_DIR = '../audio'
+# Percorsi per i manifest
+DATA_MANIFEST = '../data_manifest.json'
+TRAIN_MANIFEST = '../train_manifest.json'
+VAL_MANIFEST = '../val_manifest.json'
+FOLDS_DIR = '../folds'
+
+
+def probe_duration(file_path):
+    """Durata in secondi letta solo dall'header (frames / samplerate), senza decodificare l'audio."""
+    info = sf.info(file_path)
+    return info.frames / info.samplerate
+
+
+def label_for(file_path):
+    # Estrai l'etichetta dal nome del file dopo il primo underscore
+    file = os.path.basename(file_path)
+    if "_" in file:
+        return file.split("_")[1].split(".")[0]
+    return os.path.basename(os.path.dirname(file_path))
+
+
+def list_wav_files(data_dir):
+    """Elenca i .wav in ordine stabile (os.scandir ricorsivo: un solo stat per voce)."""
+    files, pending = [], [data_dir]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    pending.append(entry.path)
+                elif entry.name.endswith('.wav'):
+                    stat = entry.stat()
+                    files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+    return sorted(files)
+
+
+def load_probe_cache(manifest_path):
+    try:
+        with open(manifest_path + PROBE_CACHE_SUFFIX, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_probe_cache(manifest_path, cache):
+    # Scrittura atomica: un'interruzione non lascia un indice corrotto
+    path = manifest_path + PROBE_CACHE_SUFFIX
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f)
+    os.replace(path + '.tmp', path)
+
+
+def _probe(file_path):
+    try:
+        return probe_duration(file_path)
+    except Exception as e:
+        print(f"Errore nella lettura dell'header di {file_path}: {e}")
+        return None
+
+
+def create_manifest(data_dir, manifest_path, workers=None, use_cache=True):
+    """
+    Scrive il manifest di data_dir. Le durate vengono lette dagli header in parallelo e solo per i
+    file nuovi o modificati: gli altri riusano la durata salvata con dimensione e mtime alla
+    generazione precedente. Restituisce (voci scritte, file letti).
+    """
+    files = list_wav_files(data_dir)
+    cached = load_probe_cache(manifest_path) if use_cache else {}
+    durations = {}
+    to_probe = []
+    for file_path, size, mtime_ns in files:
+        previous = cached.get(file_path)
+        if previous is not None and previous[0] == size and previous[1] == mtime_ns:
+            durations[file_path] = previous[2]
+        else:
+            to_probe.append(file_path)
+
+    # Lettura degli header limitata dall'I/O: thread e non processi
+    workers = workers or min(32, 4 * (os.cpu_count() or 1))
+    if workers > 1 and len(to_probe) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            durations.update(zip(to_probe, executor.map(_probe, to_probe)))
+    else:
+        durations.update((file_path, _probe(file_path)) for file_path in to_probe)
+
+    cache = {}
     with open(manifest_path, 'w') as manifest_file:
-        for root, dirs, files in os.walk(data_dir):
-            for file in files:
-                if file.endswith('.wav'):
-                    file_path = os.path.join(root, file)
-                    
-                    # Estrai l'etichetta dal nome del file dopo il primo underscore
-                    if "_" in file:
-                        label = file.split("_")[1].split(".")[0]
-                    else:
-                        label = os.path.basename(os.path.dirname(file_path))
-                    
-                    # Calcola la durata del file audio
-                    duration = librosa.get_duration(path=file_path)
-                    entry = {
-                        'audio_filepath': file_path,
-                        'duration': duration,
-                        'label': label
-                    }
-                    manifest_file.write(json.dumps(entry) + '\n')
-
-def split_manifest(manifest_path, train_manifest_path, val_manifest_path, train_split=0.8):
+        for file_path, size, mtime_ns in files:
+            duration = durations[file_path]
+            if duration is None:
+                continue
+            cache[file_path] = [size, mtime_ns, duration]
+            entry = {
+                'audio_filepath': file_path,
+                'duration': duration,
+                'label': label_for(file_path)
+            }
+            manifest_file.write(json.dumps(entry) + '\n')
+    save_probe_cache(manifest_path, cache)
+    print(f"[CACHE] {len(files)} file, {len(to_probe)} header letti, {len(files) - len(to_probe)} riutilizzati")
+    return len(cache), len(to_probe)
+
+
+def speaker_for(file_path):
+    """Parlante di un file: nome della cartella senza il numero finale (gio1, gio2 -> gio)."""
+    folder = os.path.basename(os.path.dirname(file_path))
+    return re.sub(r'\d+$', '', folder) or folder
+
+
+def count_speaker_labels(manifest_path):
+    """Prima passata: solo i conteggi (parlante, etichetta), senza tenere in memoria le righe."""
+    counts = defaultdict(Counter)
     with open(manifest_path, 'r') as f:
-        data = f.readlines()
+        for line in f:
+            entry = json.loads(line)
+            counts[speaker_for(entry['audio_filepath'])][entry['label']] += 1
+    return counts
 
-    # Mischia casualmente i dati
-    random.shuffle(data)
 
-    # Calcola la divisione in 80% training e 20% validation
-    split_idx = int(len(data) * train_split)
-    train_data = data[:split_idx]
-    val_data = data[split_idx:]
+def assign_speakers(counts, weights, seed=0):
+    """
+    Assegna ogni parlante a un gruppo in modo che ogni etichetta sia distribuita tra i gruppi in
+    proporzione a `weights`. Greedy dal parlante con piu' clip: sceglie il gruppo che minimizza lo
+    scarto quadratico dai conteggi obiettivo. L'ordine di partenza e gli spareggi dipendono solo dal seed.
+    """
+    totals = Counter()
+    for speaker_counts in counts.values():
+        totals.update(speaker_counts)
+    targets = [{label: total * weight / sum(weights) for label, total in totals.items()} for weight in weights]
+    speakers = sorted(counts)
+    random.Random(seed).shuffle(speakers)
+    speakers.sort(key=lambda speaker: -sum(counts[speaker].values()))
 
-    # Salva i dati di training
-    with open(train_manifest_path, 'w') as f_train:
-        f_train.writelines(train_data)
+    groups = [Counter() for _ in weights]
+    assignment = {}
+    for speaker in speakers:
+        def cost(index):
+            return sum((groups[index][label] + counts[speaker][label] - targets[index][label]) ** 2
+                       - (groups[index][label] - targets[index][label]) ** 2 for label in totals)
+        best = min(range(len(weights)), key=cost)
+        groups[best].update(counts[speaker])
+        assignment[speaker] = best
+    return assignment, groups
 
-    # Salva i dati di validazione
-    with open(val_manifest_path, 'w') as f_val:
-        f_val.writelines(val_data)
 
-    print(f"Divisione completata: {len(train_data)} campioni per il training, {len(val_data)} campioni per la validazione.")
+def split_manifest(manifest_path, train_manifest_path, val_manifest_path, train_split=0.8, seed=0,
+                   folds=None, folds_dir=None):
+    """
+    Divisione training/validation riproducibile, stratificata per etichetta e senza parlanti in comune.
 
-# Directory dei file audio originali
-data_dir = '../audio'
-# Percorsi per i manifest
-data_manifest_path = '../data_manifest.json'
-train_manifest_path = '../train_manifest.json'
-val_manifest_path = '../val_manifest.json'
-
-# Crea il manifest principale con i dati originali
-create_manifest(data_dir, data_manifest_path)
-# Crea manifest di training e validation
-split_manifest(data_manifest_path, train_manifest_path, val_manifest_path)
+    Con `folds` = k i parlanti vengono divisi in k gruppi bilanciati e in folds_dir sono scritti
+    fold{i}_train.json / fold{i}_val.json per tutti i fold, in un'unica passata sul manifest;
+    train_manifest_path e val_manifest_path ricevono il fold 0. Le righe mantengono l'ordine del manifest.
+    """
+    counts = count_speaker_labels(manifest_path)
+    weights = [1.0] * folds if folds else [1.0 - train_split, train_split]
+    assignment, groups = assign_speakers(counts, weights, seed)
+
+    if folds:
+        os.makedirs(folds_dir, exist_ok=True)
+        outputs = [(os.path.join(folds_dir, f"fold{i}_train.json"), os.path.join(folds_dir, f"fold{i}_val.json"))
+                   for i in range(folds)]
+        outputs[0] = outputs[0] + (train_manifest_path, val_manifest_path)
+    else:
+        outputs = [(train_manifest_path, val_manifest_path)]
+
+    # Seconda passata: ogni riga va nel val del proprio gruppo e nel train di tutti gli altri
+    handles = [[open(path, 'w') for path in paths] for paths in outputs]
+    try:
+        with open(manifest_path, 'r') as f:
+            for line in f:
+                group = assignment[speaker_for(json.loads(line)['audio_filepath'])]
+                for fold, files in enumerate(handles):
+                    is_val = group == fold if folds else group == 0
+                    for i, handle in enumerate(files):
+                        if (i % 2 == 1) == is_val:
+                            handle.write(line)
+    finally:
+        for files in handles:
+            for handle in files:
+                handle.close()
+
+    for index, group in enumerate(groups if folds else groups[:1]):
+        speakers = sorted(speaker for speaker, assigned in assignment.items() if assigned == index)
+        missing = sorted(set().union(*counts.values()) - set(group))
+        name = f"Fold {index}" if folds else "Validazione"
+        print(f"[INFO] {name}: {sum(group.values())} campioni, parlanti {', '.join(speakers)}"
+              + (f" (etichette assenti: {', '.join(missing)})" if missing else ""))
+    total = sum(sum(c.values()) for c in counts.values())
+    val_size = sum(groups[0].values())
+    print(f"Divisione completata: {total - val_size} campioni per il training, {val_size} campioni per la validazione.")
+
+
+def compare_librosa(manifest_path):
+    """Percorso precedente (librosa.get_duration seriale) sugli stessi file: tempo e differenza massima."""
+    import librosa
+
+    with open(manifest_path, 'r') as f:
+        entries = [json.loads(line) for line in f]
+    start = time.perf_counter()
+    reference = [librosa.get_duration(path=entry['audio_filepath']) for entry in entries]
+    elapsed = time.perf_counter() - start
+    difference = max((abs(entry['duration'] - duration) for entry, duration in zip(entries, reference)), default=0.0)
+    print(f"[TEMPO] librosa.get_duration seriale: {elapsed:.2f} s ({len(entries) / elapsed:.1f} file/s), "
+          f"differenza massima delle durate: {difference:.2e} s")
+
+
+def build_manifests(workers=None, use_cache=True, seed=0, folds=None):
+    """Manifest principale dei file originali e divisione training/validation (ed eventuali fold)."""
+    start = time.perf_counter()
+    num_entries, probed = create_manifest(DATA_DIR, DATA_MANIFEST, workers, use_cache=use_cache)
+    elapsed = time.perf_counter() - start
+    print(f"[TEMPO] Manifest con {num_entries} voci in {elapsed:.2f} s ({num_entries / max(elapsed, 1e-9):.1f} file/s)")
+    split_manifest(DATA_MANIFEST, TRAIN_MANIFEST, VAL_MANIFEST, seed=seed, folds=folds, folds_dir=FOLDS_DIR)
+    return num_entries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crea il manifest dei file audio e la divisione training/validation.")
+    parser.add_argument("--workers", type=int, default=None, help="Thread per la lettura degli header (1 = seriale)")
+    parser.add_argument("--no-cache", action="store_true", help="Rilegge gli header di tutti i file")
+    parser.add_argument("--compare-librosa", action="store_true",
+                        help="Confronta tempo e durate con la lettura seriale tramite librosa")
+    parser.add_argument("--seed", type=int, default=0, help="Seed della divisione training/validation")
+    parser.add_argument("--folds", type=int, default=None,
+                        help="Genera k fold con parlanti disgiunti in ../folds (il fold 0 e' anche train/val)")
+    args = parser.parse_args()
+
+    build_manifests(args.workers, not args.no_cache, args.seed, args.folds)
+    if args.compare_librosa:
+        compare_librosa(DATA_MANIFEST)
@@ -0,0 +1,109 @@
+import math
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+# Costante aggiunta alla deviazione standard in NeMo (normalize_batch)
+NORMALIZE_EPS = 1e-5
+
+
+class MelFrontend(nn.Module):
+    """
+    Replica in puro PyTorch di AudioToMelSpectrogramPreprocessor (modalita' inferenza).
+
+    La STFT e' calcolata come convoluzione con una base DFT precalcolata, cosi' il
+    modulo puo' essere compilato con TorchScript ed esportato in ONNX senza NeMo.
+    """
+
+    def __init__(self, filterbank, window, n_fft, hop_length, preemph=0.97, normalize="per_feature",
+                 log_guard=2 ** -24, mag_power=2.0, pad_mode="constant"):
+        super().__init__()
+        self.n_fft = int(n_fft)
+        self.hop_length = int(hop_length)
+        self.preemph = float(preemph) if preemph is not None else 0.0
+        self.normalize = normalize or ""
+        self.log_guard = float(log_guard)
+        self.mag_power = float(mag_power)
+        self.pad_mode = pad_mode
+        self.eps = NORMALIZE_EPS
+        self.register_buffer("fb", filterbank.reshape(-1, self.n_fft // 2 + 1).float())
+        self.register_buffer("dft_basis", self._dft_basis(window.float(), self.n_fft))
+
+    @staticmethod
+    def _dft_basis(window, n_fft):
+        """Base [2 * bins, 1, n_fft] (parte reale e immaginaria) con la finestra centrata come torch.stft."""
+        left = (n_fft - window.numel()) // 2
+        full_window = torch.zeros(n_fft)
+        full_window[left:left + window.numel()] = window
+        bins = torch.arange(n_fft // 2 + 1, dtype=torch.float64).unsqueeze(1)
+        samples = torch.arange(n_fft, dtype=torch.float64).unsqueeze(0)
+        angle = 2 * math.pi * bins * samples / n_fft
+        basis = torch.cat([torch.cos(angle), -torch.sin(angle)], dim=0) * full_window.double()
+        return basis.float().unsqueeze(1)
+
+    @classmethod
+    def from_nemo(cls, preprocessor, pad_mode="constant"):
+        """Costruisce il frontend copiando filtri e parametri da un preprocessor NeMo."""
+        featurizer = preprocessor.featurizer
+        if getattr(featurizer, "frame_splicing", 1) != 1:
+            raise ValueError("frame_splicing > 1 non e' supportato dall'esportazione")
+        if getattr(featurizer, "log_zero_guard_type", "add") != "add":
+            raise ValueError("Solo log_zero_guard_type='add' e' supportato dall'esportazione")
+        window = featurizer.window
+        if window is None:
+            window = torch.ones(featurizer.win_length)
+        return cls(
+            filterbank=featurizer.fb.detach().cpu(),
+            window=window.detach().cpu(),
+            n_fft=featurizer.n_fft,
+            hop_length=featurizer.hop_length,
+            preemph=featurizer.preemph,
+            normalize=featurizer.normalize,
+            log_guard=getattr(featurizer, "log_zero_guard_value", 2 ** -24),
+            mag_power=getattr(featurizer, "mag_power", 2.0),
+            pad_mode=pad_mode,
+        )
+
+    def get_seq_len(self, length):
+        pad_amount = self.n_fft // 2 * 2
+        return torch.div(length + pad_amount - self.n_fft, self.hop_length, rounding_mode="floor") + 1
+
+    def log_mel(self, audio, length):
+        """Spettrogramma log-mel non normalizzato [B, n_mels, T]."""
+        if self.preemph > 0:
+            timemask = torch.arange(audio.shape[1], device=audio.device).unsqueeze(0) < length.unsqueeze(1)
+            audio = torch.cat((audio[:, :1], audio[:, 1:] - self.preemph * audio[:, :-1]), dim=1)
+            audio = audio.masked_fill(~timemask, 0.0)
+        padded = F.pad(audio.unsqueeze(1), (self.n_fft // 2, self.n_fft // 2), mode=self.pad_mode)
+        return self.frames_to_log_mel(padded)
+
+    def frames_to_log_mel(self, padded):
+        """Log-mel dei frame di un segnale gia' pre-enfatizzato e con padding [B, 1, N] (usato anche in streaming)."""
+        spec = F.conv1d(padded, self.dft_basis, stride=self.hop_length)
+        bins = self.n_fft // 2 + 1
+        power = spec[:, :bins].pow(2) + spec[:, bins:].pow(2)
+        if self.mag_power != 2.0:
+            power = power.sqrt().pow(self.mag_power)
+        return torch.log(torch.matmul(self.fb, power) + self.log_guard)
+
+    def normalize_features(self, features, seq_len):
+        valid = (torch.arange(features.shape[2], device=features.device).unsqueeze(0) < seq_len.unsqueeze(1)).unsqueeze(1)
+        if self.normalize == "per_feature":
+            count = valid.sum(dim=2).to(features.dtype)
+            mean = torch.where(valid, features, torch.zeros_like(features)).sum(dim=2) / count
+            centered = torch.where(valid, features - mean.unsqueeze(2), torch.zeros_like(features))
+            std = torch.sqrt(centered.pow(2).sum(dim=2) / (count - 1.0)) + self.eps
+            features = (features - mean.unsqueeze(2)) / std.unsqueeze(2)
+        elif self.normalize == "all_features":
+            count = valid.sum(dim=(1, 2)).to(features.dtype) * features.shape[1]
+            mean = torch.where(valid, features, torch.zeros_like(features)).sum(dim=(1, 2)) / count
+            centered = torch.where(valid, features - mean.view(-1, 1, 1), torch.zeros_like(features))
+            std = torch.sqrt(centered.pow(2).sum(dim=(1, 2)) / (count - 1.0)) + self.eps
+            features = (features - mean.view(-1, 1, 1)) / std.view(-1, 1, 1)
+        return features.masked_fill(~valid, 0.0)
+
+    def forward(self, audio, length):
+        seq_len = self.get_seq_len(length)
+        features = self.normalize_features(self.log_mel(audio, length), seq_len)
+        return features, seq_len
@@ -0,0 +1,197 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+from manifest import DATA_DIR, DATA_MANIFEST, TRAIN_MANIFEST, VAL_MANIFEST, build_manifests
+from data_augmentation import AUGMENTED_MANIFEST, INPUT_DIR, OUTPUT_DIR, timed_augment
+from trainer_profiles import PROFILES, is_launcher_process
+
+# Impronte degli stadi gia' eseguiti: nome -> {fingerprint, durata dell'ultima esecuzione}
+STATE_PATH = '../.pipeline_state.json'
+CONFIG_PATH = '../config.yaml'
+MODEL_PATH = '../asr_model2.nemo'
+METRICS_PATH = '../evaluation_metrics.json'
+STAGE_NAMES = ("manifest", "augment", "train", "evaluate")
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def path_fingerprint(path):
+    """
+    Impronta di un input: sha256 del contenuto per i file; per le directory (migliaia di WAV)
+    percorso relativo, dimensione e data di modifica di ogni file, senza leggerne il contenuto.
+    """
+    if os.path.isfile(path):
+        return hash_file(path)
+    if not os.path.isdir(path):
+        return None
+    digest = hashlib.sha256()
+    for subdir, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(subdir, name)
+            stat = os.stat(file_path)
+            digest.update(f"{os.path.relpath(file_path, path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+class Stage:
+    """Uno stadio della pipeline: funzione da eseguire, file/directory letti, parametri e file prodotti."""
+
+    def __init__(self, name, run, inputs=(), outputs=(), params=None):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+
+    def fingerprint(self):
+        # Calcolata prima di eseguire lo stadio, quando gli stadi precedenti hanno gia' scritto i loro output
+        payload = json.dumps([[(path, path_fingerprint(path)) for path in self.inputs], self.params], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def load_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, 'r') as f:
+        return json.load(f)
+
+
+def save_state(state_path, state):
+    # Scrittura atomica: un'interruzione a meta' lascia valido lo stato degli stadi conclusi
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def run_pipeline(stages, state_path=STATE_PATH, force=()):
+    """
+    Esegue gli stadi in ordine nello stesso processo. Uno stadio e' saltato se impronta di input e
+    parametri coincide con l'ultima esecuzione e i suoi output esistono ancora. I risultati restano
+    nel contesto (es. il modello addestrato), cosi' gli stadi successivi non li ricaricano dal disco.
+    """
+    state = load_state(state_path)
+    context = {}
+    summary = []
+    for stage in stages:
+        start = time.perf_counter()
+        fingerprint = stage.fingerprint()
+        previous = state.get(stage.name, {})
+        if (stage.name not in force and previous.get('fingerprint') == fingerprint
+                and all(os.path.exists(path) for path in stage.outputs)):
+            print(f"[CACHE] Stadio '{stage.name}' aggiornato: saltato")
+            summary.append((stage.name, False, time.perf_counter() - start, previous.get('seconds', 0.0)))
+            continue
+        print(f"[INFO] Stadio '{stage.name}'...")
+        context[stage.name] = stage.run(context)
+        elapsed = time.perf_counter() - start
+        state[stage.name] = {'fingerprint': fingerprint, 'seconds': elapsed}
+        save_state(state_path, state)
+        summary.append((stage.name, True, elapsed, elapsed))
+    print_summary(summary)
+    return context
+
+
+def print_summary(summary):
+    print("========================")
+    print("Tempi della pipeline")
+    print("========================")
+    saved = 0.0
+    for name, executed, elapsed, last_run in summary:
+        if executed:
+            print(f"[TEMPO] {name:<10} eseguito   {elapsed:9.2f} s")
+        else:
+            saved += last_run
+            print(f"[TEMPO] {name:<10} saltato    {elapsed:9.2f} s   (ultima esecuzione: {last_run:.2f} s)")
+    print(f"[TEMPO] Totale {sum(entry[2] for entry in summary):.2f} s, circa {saved:.2f} s risparmiati dagli stadi saltati")
+
+
+def build_stages(args):
+    """Stadi manifest -> augment -> train -> evaluate con input, output e parametri dichiarati."""
+    # Il manifest di training elenca i file audio: anche la loro directory e' un input del training
+    train_manifest, train_audio = (TRAIN_MANIFEST, DATA_DIR) if args.online_augment else (AUGMENTED_MANIFEST, OUTPUT_DIR)
+
+    def manifest(context):
+        return build_manifests(args.workers, seed=args.seed, folds=args.folds)
+
+    def augment(context):
+        # Solo i file del manifest di training: i parlanti di validazione non vengono aumentati
+        return timed_augment(INPUT_DIR, OUTPUT_DIR, AUGMENTED_MANIFEST, args.workers or os.cpu_count(), args.seed,
+                             source_manifest=TRAIN_MANIFEST)
+
+    def train(context):
+        model, trainer = train_model(args)
+        if trainer.is_global_zero:
+            model.save_to(args.model)
+            print(f"Training completato, modello salvato in {args.model}")
+        return model
+
+    def evaluate(context):
+        # Modello in memoria se appena addestrato, altrimenti dal .nemo dell'esecuzione precedente
+        from evaluate_model import ASRInference
+
+        metrics = ASRInference(args.model, VAL_MANIFEST, model=context.get('train')).display_results()
+        with open(METRICS_PATH, 'w') as f:
+            json.dump({**metrics, 'confusion_matrix': metrics['confusion_matrix'].tolist()}, f, indent=2)
+        return metrics
+
+    stages = [Stage("manifest", manifest, inputs=[DATA_DIR], outputs=[DATA_MANIFEST, TRAIN_MANIFEST, VAL_MANIFEST],
+                    params={'seed': args.seed, 'folds': args.folds})]
+    if not args.online_augment:
+        stages.append(Stage("augment", augment, inputs=[INPUT_DIR, TRAIN_MANIFEST], outputs=[OUTPUT_DIR, AUGMENTED_MANIFEST],
+                            params={'seed': args.seed}))
+    stages.append(Stage("train", train, inputs=[CONFIG_PATH, train_manifest, train_audio, VAL_MANIFEST], outputs=[args.model],
+                        params={'online_augment': args.online_augment, 'feature_cache': args.feature_cache,
+                                'profile': args.profile, 'ranks': args.ranks, 'patience': args.patience,
+                                'save_top_k': args.save_top_k}))
+    stages.append(Stage("evaluate", evaluate, inputs=[args.model, VAL_MANIFEST], outputs=[METRICS_PATH]))
+    return stages
+
+
+def train_model(args):
+    # Import qui: NeMo e Lightning si caricano solo se il training va davvero eseguito
+    from train_asr_model import build_config, train
+
+    cfg = build_config(args.online_augment, CONFIG_PATH)
+    return train(cfg, args.feature_cache, args.online_augment, args.profile, args.ranks,
+                 checkpoint_dir=args.checkpoint_dir, save_top_k=args.save_top_k, patience=args.patience)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manifest, augmentation, training e valutazione in un solo processo, "
+                                                 "saltando gli stadi con input invariati.")
+    parser.add_argument("--force", nargs="*", choices=STAGE_NAMES, default=None,
+                        help="Riesegue gli stadi indicati (tutti se nessuno e' indicato) anche se aggiornati")
+    parser.add_argument("--state", default=STATE_PATH, help="File con le impronte degli stadi eseguiti")
+    parser.add_argument("--model", default=MODEL_PATH, help="Modello prodotto dal training e valutato")
+    parser.add_argument("--workers", type=int, default=None, help="Thread per il manifest e processi per l'augmentation")
+    parser.add_argument("--seed", type=int, default=0, help="Seed della divisione training/validation e dell'augmentation")
+    parser.add_argument("--folds", type=int, default=None, help="Genera anche k fold con parlanti disgiunti")
+    parser.add_argument("--feature-cache", metavar="DIR", default=None,
+                        help="Usa le feature log-mel precalcolate in DIR durante il training")
+    parser.add_argument("--online-augment", action="store_true",
+                        help="Augmentation a batch nel DataLoader: lo stadio augment non viene eseguito")
+    parser.add_argument("--profile", choices=PROFILES, default="gpu")
+    parser.add_argument("--ranks", type=int, default=None, help="Processi data-parallel (profilo cpu)")
+    parser.add_argument("--checkpoint-dir", default="checkpoints")
+    parser.add_argument("--save-top-k", type=int, default=3)
+    parser.add_argument("--patience", type=int, default=10)
+    args = parser.parse_args()
+    if args.online_augment and args.feature_cache:
+        parser.error("--online-augment non e' compatibile con --feature-cache")
+
+    if not is_launcher_process():
+        # Rank aggiuntivo avviato da Lightning (ddp): partecipa solo al training
+        train_model(args)
+    else:
+        force = STAGE_NAMES if args.force == [] else (args.force or ())
+        run_pipeline(build_stages(args), args.state, force)
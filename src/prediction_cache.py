@@ -0,0 +1,86 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+def audio_fingerprint(signal):
+    """Hash veloce (blake2b, 128 bit) del PCM decodificato: stesso audio, stessa chiave anche con header diversi."""
+    return hashlib.blake2b(np.ascontiguousarray(signal, dtype=np.float32).tobytes(), digest_size=16).digest()
+
+
+def model_fingerprint(model_path):
+    """Identifica la versione del file del modello senza leggerlo tutto (percorso, dimensione, data di modifica)."""
+    stat = os.stat(model_path)
+    return f"{os.path.abspath(model_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class PredictionCache:
+    """
+    Cache LRU con scadenza dei risultati di inferenza, indicizzata dall'impronta dell'audio.
+
+    Al massimo max_entries risultati; oltre viene eliminato quello usato meno di recente,
+    e un risultato piu' vecchio di ttl_s secondi non viene piu' restituito. Quando cambia
+    il modello (set_model con un'impronta diversa) la cache viene svuotata.
+    """
+
+    def __init__(self, max_entries=4096, ttl_s=3600.0):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.model = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def set_model(self, fingerprint):
+        with self._lock:
+            if fingerprint != self.model:
+                if self._entries:
+                    self._stats['invalidations'] += 1
+                self._entries.clear()
+                self.model = fingerprint
+
+    def get(self, key):
+        """Restituisce il risultato salvato per key, oppure None."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl_s:
+                del self._entries[key]
+                self._stats['expirations'] += 1
+                entry = None
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                **self._stats,
+                'hit_rate': self._stats['hits'] / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_s': self.ttl_s,
+            }
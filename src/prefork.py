@@ -0,0 +1,135 @@
+import gc
+import os
+import random
+import signal
+import socket
+import time
+import traceback
+
+from werkzeug.serving import make_server
+
+# Un worker che termina prima di MIN_UPTIME_S secondi conta come crash all'avvio (es. modello non caricabile)
+MIN_UPTIME_S = 10.0
+# Attesa prima del riavvio: raddoppia a ogni crash consecutivo fino a MAX_RESTART_DELAY_S
+RESTART_DELAY_S = 0.5
+MAX_RESTART_DELAY_S = 30.0
+# Crash consecutivi di uno stesso worker dopo i quali il padre si ferma
+MAX_CRASHES = 5
+# Intervallo con cui il padre controlla i worker terminati e i riavvii in attesa
+POLL_INTERVAL_S = 0.1
+
+
+def _exit_worker(signum, frame):
+    raise SystemExit(0)
+
+
+def _run_worker(app, listener, index, init_worker):
+    # SIGTERM dal padre (o Ctrl-C) chiude il worker passando dalla funzione di chiusura
+    signal.signal(signal.SIGTERM, _exit_worker)
+    signal.signal(signal.SIGINT, _exit_worker)
+    random.seed()
+    code = 0
+    cleanup = None
+    try:
+        # Thread (batching, archivio) e thread pool di torch non sopravvivono al fork: si avviano qui
+        cleanup = init_worker(index) if init_worker is not None else None
+        host, port = listener.getsockname()[:2]
+        server = make_server(host, port, app, threaded=True, fd=listener.fileno())
+        print(f"[INFO] Worker {index} (pid {os.getpid()}) in ascolto")
+        server.serve_forever()
+    except SystemExit as e:
+        code = e.code or 0
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        if cleanup is not None:
+            cleanup()
+        # Mai tornare nel codice del padre
+        os._exit(code)
+
+
+def serve_prefork(app, host, port, workers, init_worker=None):
+    """
+    Serve `app` con `workers` processi figli che condividono lo stesso socket in ascolto.
+
+    Tutto cio' che il padre ha caricato prima della chiamata (ad esempio i pesi del modello) e'
+    condiviso copy-on-write con i figli. `init_worker(index)` viene eseguito in ogni figlio dopo
+    il fork e puo' restituire una funzione di chiusura. Un worker terminato viene riavviato; se esce con
+    errore o per un segnale subito dopo l'avvio (crash) l'attesa prima del riavvio cresce, e dopo MAX_CRASHES
+    crash consecutivi il padre ferma tutti i worker ed esce con errore. Durante l'attesa il padre continua
+    a raccogliere gli altri worker. SIGTERM o SIGINT al padre fermano tutti i worker.
+    """
+    listener = socket.create_server((host, port), backlog=256)
+    listener.set_inheritable(True)
+    children = {}
+    started_at = {}
+    crashes = {}
+    # Worker da riavviare: indice -> istante (time.monotonic) del riavvio
+    restarts = {}
+    stopping = False
+    failed = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(app, listener, index, init_worker)
+        children[pid] = index
+        started_at[index] = time.monotonic()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    # Gli oggetti gia' creati escono dal garbage collector: le loro pagine restano condivise dopo il fork
+    gc.freeze()
+    for index in range(workers):
+        spawn(index)
+    print(f"[INFO] {workers} worker in ascolto su {host}:{port}")
+
+    while children or (restarts and not stopping):
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            # Nessun figlio in vita: restano solo riavvii in attesa
+            pid, status = 0, 0
+        if pid == 0:
+            now = time.monotonic()
+            for index, deadline in list(restarts.items()):
+                if deadline <= now and not stopping:
+                    del restarts[index]
+                    spawn(index)
+            time.sleep(POLL_INTERVAL_S)
+            continue
+        index = children.pop(pid, None)
+        if index is None or stopping:
+            continue
+        code = os.waitstatus_to_exitcode(status)
+        if code == 0:
+            # Uscita pulita (es. SIGTERM inviato al solo worker): riavvio immediato, non e' un crash
+            crashes[index] = 0
+            delay = 0.0
+        else:
+            if time.monotonic() - started_at[index] < MIN_UPTIME_S:
+                crashes[index] = crashes.get(index, 0) + 1
+            else:
+                crashes[index] = 1
+            if crashes[index] >= MAX_CRASHES:
+                print(f"[ERRORE] Worker {index} terminato {crashes[index]} volte subito dopo l'avvio: arresto del server")
+                failed = True
+                stop(None, None)
+                continue
+            delay = min(MAX_RESTART_DELAY_S, RESTART_DELAY_S * 2 ** (crashes[index] - 1))
+        reason = f"dal segnale {-code}" if code < 0 else f"con codice {code}"
+        print(f"[INFO] Worker {index} (pid {pid}) terminato {reason}, riavvio tra {delay:.1f} s")
+        restarts[index] = time.monotonic() + delay
+    listener.close()
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,163 @@
+import argparse
+import json
+import os
+
+import torch
+from torch import nn
+from torch.ao.nn.quantized import FloatFunctional
+from torch.ao.quantization import DeQuantStub, QuantStub, convert, fuse_modules, get_default_qconfig, prepare
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from nemo.collections.asr.models import ASRModel
+
+from export_model import build_frontend
+from inference import decode_audio, masked_mean, quantized_path, valid_frames
+
+
+class QuantizableJasperBlock(nn.Module):
+    """JasperBlock con conv+BN fuse, attivazione ReLU e residuo sommato con FloatFunctional (quantizzabile)."""
+
+    def __init__(self, convs, residual=None):
+        super().__init__()
+        self.convs = nn.ModuleList(convs)
+        self.relus = nn.ModuleList([nn.ReLU() for _ in convs[:-1]])
+        self.residual = residual
+        self.relu = nn.ReLU()
+        self.skip = FloatFunctional()
+
+    @classmethod
+    def from_nemo(cls, block):
+        if getattr(block, "dense_residual", False) or getattr(block, "residual_mode", "add") != "add":
+            raise ValueError("Solo residui 'add' non densi sono quantizzabili")
+        if not all(isinstance(module, nn.ReLU) for module in block.mout if not isinstance(module, nn.Dropout)):
+            raise ValueError("La quantizzazione supporta solo blocchi con attivazione ReLU")
+        # mconv: [conv, bn, (relu, dropout, conv, bn)*] -> conv con BN incorporata
+        convs, pending = [], None
+        for module in block.mconv:
+            if isinstance(getattr(module, "conv", None), nn.Conv1d):
+                pending = module.conv
+            elif isinstance(module, nn.BatchNorm1d):
+                convs.append(fuse_conv_bn_eval(pending, module))
+        # La maschera sulla lunghezza si applica all'ingresso del blocco: con repeat > 1 o stride > 1
+        # servirebbe anche tra le conv interne
+        if len(convs) != 1 or convs[0].stride != (1,):
+            raise ValueError("La quantizzazione supporta solo blocchi con repeat 1 e stride 1")
+        residual = None
+        if block.res is not None:
+            (panes,) = block.res
+            conv = next(module.conv for module in panes if isinstance(getattr(module, "conv", None), nn.Conv1d))
+            bn = next(module for module in panes if isinstance(module, nn.BatchNorm1d))
+            residual = fuse_conv_bn_eval(conv, bn)
+        return cls(convs, residual)
+
+    def fuse_pairs(self, prefix):
+        pairs = [[f"{prefix}.convs.{i}", f"{prefix}.relus.{i}"] for i in range(len(self.relus))]
+        if self.residual is None:
+            pairs.append([f"{prefix}.convs.{len(self.convs) - 1}", f"{prefix}.relu"])
+        return pairs
+
+    def forward(self, x):
+        out = x
+        for conv, relu in zip(self.convs[:-1], self.relus):
+            out = relu(conv(out))
+        out = self.convs[-1](out)
+        if self.residual is not None:
+            return self.skip.add_relu(out, self.residual(x))
+        return self.relu(out)
+
+
+class QuantizableEncoderDecoder(nn.Module):
+    """
+    Feature mel -> logits: encoder int8 statico, pooling medio sui frame validi e decoder lineare float.
+    Come le MaskedConv1d di NeMo, l'ingresso di ogni blocco e' azzerato oltre la lunghezza della clip
+    (in float, tra dequant e quant): i logits di una clip non dipendono dal padding del batch. Il decoder
+    resta in float perche' la quantizzazione dinamica calcolerebbe la scala sull'intero batch.
+    """
+
+    def __init__(self, blocks, decoder):
+        super().__init__()
+        self.quants = nn.ModuleList([QuantStub() for _ in blocks])
+        self.blocks = nn.ModuleList(blocks)
+        self.dequants = nn.ModuleList([DeQuantStub() for _ in blocks])
+        self.decoder = decoder
+
+    def forward(self, features, lengths):
+        valid = valid_frames(features, lengths)
+        encoded = features
+        for quant, block, dequant in zip(self.quants, self.blocks, self.dequants):
+            encoded = dequant(block(quant(encoded.masked_fill(~valid, 0.0))))
+        return self.decoder(masked_mean(encoded, lengths))
+
+
+class QuantizedClassifier(nn.Module):
+    """Stessa interfaccia di ExportableClassifier: il frontend mel resta in float32."""
+
+    def __init__(self, frontend, core):
+        super().__init__()
+        self.frontend = frontend
+        self.core = core
+
+    def forward(self, audio_signal, length):
+        features, feature_length = self.frontend(audio_signal, length)
+        return self.core(features, feature_length)
+
+
+def load_calibration(manifest_path, limit):
+    signals = []
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            with open(json.loads(line)["audio_filepath"], 'rb') as audio:
+                signals.append(decode_audio(audio.read()))
+            if len(signals) >= limit:
+                break
+    return signals
+
+
+def quantize(model_path, output_path, calibration_manifest, calibration_clips=256):
+    """Quantizzazione post-training: encoder int8 statico calibrato sul manifest, decoder float."""
+    model = ASRModel.restore_from(model_path, map_location="cpu")
+    model.eval()
+    labels = list(model.cfg.labels)
+    frontend = build_frontend(model, model.cfg.sample_rate).eval()
+
+    blocks = [QuantizableJasperBlock.from_nemo(block) for block in model.encoder.encoder]
+    (linear,) = [module for module in model.decoder.decoder_layers if isinstance(module, nn.Linear)]
+    core = QuantizableEncoderDecoder(blocks, linear).eval()
+    fuse_modules(core, [pair for i, block in enumerate(blocks) for pair in block.fuse_pairs(f"blocks.{i}")], inplace=True)
+
+    # fbgemm su x86, qnnpack su ARM: il modello salvato va eseguito con lo stesso backend
+    engine = "fbgemm" if "fbgemm" in torch.backends.quantized.supported_engines else "qnnpack"
+    torch.backends.quantized.engine = engine
+    qconfig = get_default_qconfig(engine)
+    for module in (core.quants, core.blocks, core.dequants):
+        module.qconfig = qconfig
+    prepare(core, inplace=True)
+
+    # Calibrazione degli osservatori sulle feature del manifest di training, una clip alla volta:
+    # i frame di padding di un batch finirebbero negli intervalli osservati
+    signals = load_calibration(calibration_manifest, calibration_clips)
+    with torch.inference_mode():
+        for signal in signals:
+            audio = torch.from_numpy(signal).unsqueeze(0)
+            core(*frontend(audio, torch.tensor([len(signal)])))
+    convert(core, inplace=True)
+    print(f"[INFO] Calibrazione su {len(signals)} clip, backend {engine}")
+
+    wrapper = QuantizedClassifier(torch.jit.script(frontend), core).eval()
+    audio = torch.randn(2, model.cfg.sample_rate) * 0.1
+    length = torch.tensor([model.cfg.sample_rate, model.cfg.sample_rate // 2])
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(wrapper, (audio, length), check_trace=False))
+    torch.jit.save(traced, output_path, _extra_files={"labels.json": json.dumps(labels)})
+    print(f"[INFO] Modello int8 salvato in {output_path} ({os.path.getsize(output_path) / 1e6:.2f} MB)")
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quantizzazione int8 post-training del modello per l'inferenza su CPU.")
+    parser.add_argument("model", nargs="?", default="../asr_model2.nemo", help="Checkpoint .nemo da quantizzare")
+    parser.add_argument("--output", default=None, help="File TorchScript di destinazione (default: <modello>.int8.ts)")
+    parser.add_argument("--calibration-manifest", default="../train_manifest.json")
+    parser.add_argument("--calibration-clips", type=int, default=256, help="Numero di clip usate per la calibrazione")
+    args = parser.parse_args()
+
+    quantize(args.model, args.output or quantized_path(args.model), args.calibration_manifest, args.calibration_clips)
@@ -0,0 +1,125 @@
+import argparse
+import bisect
+import json
+import threading
+import time
+
+import numpy as np
+from simple_websocket import Client, ConnectionClosed
+
+from inference import decode_audio
+
+SAMPLE_RATE = 16000
+
+
+def load_manifest(manifest_path, limit):
+    clips = []
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            entry = json.loads(line)
+            with open(entry["audio_filepath"], 'rb') as audio:
+                clips.append((decode_audio(audio.read()), entry["label"]))
+            if len(clips) >= limit:
+                break
+    return clips
+
+
+def build_stream(clips, gap_s, rng):
+    """Concatena le clip separate da silenzio con un leggero rumore; restituisce audio e intervalli delle clip."""
+    parts, spans, position = [], [], 0
+    gap = int(gap_s * SAMPLE_RATE)
+    for signal, label in clips:
+        parts.append(signal)
+        spans.append((position, position + len(signal), label))
+        position += len(signal)
+        parts.append((rng.standard_normal(gap) * 1e-3).astype(np.float32))
+        position += gap
+    return np.concatenate(parts), spans
+
+
+def run_client(url, clips, gap_s, chunk_ms, speed, seed, results):
+    """Un client Unity simulato: invia il flusso a velocita' reale e registra l'arrivo di ogni comando."""
+    stream, spans = build_stream(clips, gap_s, np.random.default_rng(seed))
+    pcm = (np.clip(stream, -1.0, 1.0) * 32767).astype('<i2')
+    chunk = int(SAMPLE_RATE * chunk_ms / 1000)
+    sent_ends, sent_times, received = [], [], []
+    ws = Client.connect(url)
+
+    def receiver():
+        try:
+            while True:
+                message = ws.receive()
+                if message is None:
+                    break
+                received.append((time.perf_counter(), json.loads(message)))
+        except ConnectionClosed:
+            pass
+
+    thread = threading.Thread(target=receiver, daemon=True)
+    thread.start()
+    start = time.perf_counter()
+    for offset in range(0, len(pcm), chunk):
+        if speed > 0:
+            # Il microfono produce audio in tempo reale: non si invia un frame prima che esista
+            delay = start + (offset + chunk) / SAMPLE_RATE / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        ws.send(pcm[offset:offset + chunk].tobytes())
+        sent_ends.append(min(offset + chunk, len(pcm)))
+        sent_times.append(time.perf_counter())
+    # Dopo "end" il server classifica l'ultimo enunciato e chiude la connessione
+    ws.send("end")
+    thread.join(timeout=5.0)
+    try:
+        ws.close()
+    except ConnectionClosed:
+        pass
+
+    for arrival, message in received:
+        # Latenza dalla fine del parlato rilevata dal VAD (istante in cui quel campione e' stato inviato)
+        speech_end = message['end_ms'] * SAMPLE_RATE // 1000
+        sent_index = min(bisect.bisect_left(sent_ends, speech_end), len(sent_times) - 1)
+        label = next((label for clip_start, clip_end, label in spans
+                      if clip_start <= speech_end <= clip_end + int(gap_s * SAMPLE_RATE)), None)
+        results.append({
+            'latency_ms': (arrival - sent_times[sent_index]) * 1000,
+            'command': message['command'],
+            'label': label,
+        })
+    results.append({'clips': len(spans)})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generatore di carico per /stream: riproduce val_manifest come flussi continui.")
+    parser.add_argument("--url", default="ws://localhost:5001/stream")
+    parser.add_argument("--manifest", default="../val_manifest.json")
+    parser.add_argument("--limit", type=int, default=68)
+    parser.add_argument("--clients", type=int, default=4, help="Connessioni concorrenti")
+    parser.add_argument("--gap-s", type=float, default=0.8, help="Silenzio tra due comandi")
+    parser.add_argument("--chunk-ms", type=int, default=20, help="Durata di un frame inviato")
+    parser.add_argument("--speed", type=float, default=1.0, help="Velocita' rispetto al tempo reale (0 = senza attese)")
+    args = parser.parse_args()
+
+    clips = load_manifest(args.manifest, args.limit)
+    results = []
+    threads = [
+        threading.Thread(target=run_client, args=(args.url, clips[i::args.clients], args.gap_s,
+                                                   args.chunk_ms, args.speed, i, results))
+        for i in range(args.clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    total_clips = sum(r['clips'] for r in results if 'clips' in r)
+    commands = [r for r in results if 'latency_ms' in r]
+    latencies = np.array([r['latency_ms'] for r in commands])
+    matched = [r for r in commands if r['label'] is not None]
+    correct = sum(r['command'] == r['label'] for r in matched)
+    print(f"[INFO] {args.clients} client, {total_clips} clip, {len(commands)} enunciati rilevati dal VAD")
+    if len(commands):
+        print(f"Fine parlato -> comando   p50: {np.percentile(latencies, 50):7.1f} ms   "
+              f"p95: {np.percentile(latencies, 95):7.1f} ms   p99: {np.percentile(latencies, 99):7.1f} ms")
+        # Alcune clip contengono piu' ripetizioni del comando: l'accuratezza e' per enunciato
+        print(f"Comandi corretti: {correct}/{len(matched)}  ({len(commands) - len(matched)} enunciati fuori dalle clip)")
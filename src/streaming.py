@@ -0,0 +1,254 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from export_model import build_frontend
+from mel_frontend import NORMALIZE_EPS
+
+
+def _is_masked_conv(module):
+    # MaskedConv1d di NeMo: convoluzione in .conv, maschera sulle lunghezze nel forward
+    return isinstance(getattr(module, "conv", None), nn.Conv1d)
+
+
+class StreamingConv:
+    """
+    Conv1d a stride 1 eseguita a blocchi: conserva gli ultimi (kernel - 1) * dilation frame di input,
+    quindi ogni frame di output viene calcolato una sola volta e coincide con quello della clip intera.
+    Il padding sinistro diventa lo stato iniziale (zeri), quello destro viene aggiunto a fine flusso.
+    """
+
+    def __init__(self, conv):
+        if conv.stride[0] != 1:
+            raise ValueError("Lo streaming richiede convoluzioni con stride 1")
+        self.conv = conv
+        self.context = conv.dilation[0] * (conv.kernel_size[0] - 1)
+        self.left_pad = conv.padding[0] if isinstance(conv.padding, tuple) else self.context // 2
+        self.right_pad = self.context - self.left_pad
+        self.cache = None
+
+    def reset(self):
+        self.cache = None
+
+    def step(self, x, final=False):
+        if self.cache is None:
+            self.cache = x.new_zeros(x.shape[0], x.shape[1], self.left_pad)
+        if final:
+            x = torch.cat([x, x.new_zeros(x.shape[0], x.shape[1], self.right_pad)], dim=2)
+        buffer = torch.cat([self.cache, x], dim=2)
+        if buffer.shape[2] <= self.context:
+            self.cache = buffer
+            return x.new_zeros(x.shape[0], self.conv.out_channels, 0)
+        out = F.conv1d(buffer, self.conv.weight, self.conv.bias, dilation=self.conv.dilation, groups=self.conv.groups)
+        self.cache = buffer[:, :, buffer.shape[2] - self.context:]
+        return out
+
+
+class StreamingBlock:
+    """JasperBlock a blocchi: convoluzioni con cache, BN/attivazioni frame per frame e residuo riallineato."""
+
+    def __init__(self, block):
+        if getattr(block, "dense_residual", False):
+            raise ValueError("dense_residual non e' supportato in streaming")
+        self.layers = []
+        for module in block.mconv:
+            if _is_masked_conv(module):
+                if getattr(module, "heads", -1) != -1:
+                    raise ValueError("MaskedConv1d con heads non e' supportata in streaming")
+                self.layers.append(StreamingConv(module.conv))
+            elif type(module).__name__ == "SqueezeExcite":
+                # Il contesto globale di SqueezeExcite non e' calcolabile in modo incrementale
+                raise ValueError("SqueezeExcite non e' supportato in streaming")
+            else:
+                self.layers.append(module)
+        self.residual = None
+        if block.res is not None:
+            (panes,) = block.res
+            self.residual = []
+            for module in panes:
+                if _is_masked_conv(module):
+                    if module.conv.kernel_size[0] != 1:
+                        raise ValueError("Il residuo deve essere una convoluzione 1x1")
+                    module = module.conv
+                self.residual.append(module)
+        self.residual_mode = getattr(block, "residual_mode", "add")
+        self.mout = block.mout
+        self.pending = None
+
+    def reset(self):
+        for layer in self.layers:
+            if isinstance(layer, StreamingConv):
+                layer.reset()
+        self.pending = None
+
+    def step(self, x, final=False):
+        out = x
+        for layer in self.layers:
+            if isinstance(layer, StreamingConv):
+                out = layer.step(out, final)
+            elif out.shape[2] > 0:
+                out = layer(out)
+        if self.residual is not None:
+            # Il ramo residuo non ha contesto: i suoi frame attendono che il ramo principale li raggiunga
+            if x.shape[2] > 0:
+                res = x
+                for layer in self.residual:
+                    res = layer(res)
+                self.pending = res if self.pending is None else torch.cat([self.pending, res], dim=2)
+        if out.shape[2] == 0:
+            return out
+        if self.residual is not None:
+            ready = out.shape[2]
+            res, self.pending = self.pending[:, :, :ready], self.pending[:, :, ready:]
+            out = out + res if self.residual_mode in ("add", "stride_add") else torch.max(out, res)
+        return self.mout(out)
+
+
+class StreamingMel:
+    """
+    Feature log-mel calcolate a blocchi con la stessa STFT centrata di MelFrontend.
+
+    La normalizzazione per feature di NeMo usa media e deviazione dell'intera clip, che in streaming
+    non sono note: con `stats=(media, std)` si usano statistiche fisse, altrimenti statistiche
+    cumulative aggiornate a ogni blocco.
+    """
+
+    def __init__(self, frontend):
+        self.frontend = frontend
+        self.half = frontend.n_fft // 2
+        self.reset()
+
+    def reset(self, stats=None):
+        self.stats = None if stats is None else tuple(torch.as_tensor(s, dtype=torch.float32).view(1, -1, 1) for s in stats)
+        self.previous = 0.0
+        self.buffer = torch.zeros(0)
+        self.started = False
+        self.count = 0
+        self.total = None
+        self.total_sq = None
+
+    def _normalize(self, features):
+        if self.stats is not None:
+            mean, std = self.stats
+            return (features - mean) / std
+        # Statistiche cumulative (varianza non distorta come in NeMo) fino al frame corrente
+        cumulative = features.cumsum(dim=2) + (0.0 if self.total is None else self.total)
+        cumulative_sq = features.pow(2).cumsum(dim=2) + (0.0 if self.total_sq is None else self.total_sq)
+        counts = torch.arange(self.count + 1, self.count + features.shape[2] + 1, dtype=features.dtype).view(1, 1, -1)
+        mean = cumulative / counts
+        variance = (cumulative_sq - counts * mean.pow(2)) / (counts - 1.0).clamp(min=1.0)
+        std = torch.where(counts > 1, variance.clamp(min=0.0).sqrt(), torch.ones_like(variance)) + NORMALIZE_EPS
+        self.total, self.total_sq = cumulative[:, :, -1:], cumulative_sq[:, :, -1:]
+        self.count += features.shape[2]
+        return (features - mean) / std
+
+    def step(self, samples, final=False):
+        """Campioni float32 [N] -> nuovi frame normalizzati [1, n_mels, T]."""
+        samples = torch.as_tensor(samples, dtype=torch.float32).reshape(-1)
+        if self.frontend.preemph > 0 and samples.numel():
+            shifted = torch.cat([samples.new_tensor([self.previous]), samples[:-1]])
+            self.previous = float(samples[-1])
+            samples = samples - self.frontend.preemph * shifted
+        self.buffer = torch.cat([self.buffer, samples])
+
+        if not self.started:
+            # Padding sinistro della STFT centrata: zeri oppure riflessione dei primi campioni
+            if self.frontend.pad_mode == "reflect":
+                if self.buffer.numel() <= self.half and not final:
+                    return torch.zeros(1, self.frontend.fb.shape[0], 0)
+                left = self.buffer[1:self.half + 1].flip(0)
+            else:
+                left = self.buffer.new_zeros(self.half)
+            self.buffer = torch.cat([left, self.buffer])
+            self.started = True
+        if final:
+            if self.frontend.pad_mode == "reflect":
+                right = self.buffer[-self.half - 1:-1].flip(0)
+            else:
+                right = self.buffer.new_zeros(self.half)
+            self.buffer = torch.cat([self.buffer, right])
+
+        n_frames = (self.buffer.numel() - self.frontend.n_fft) // self.frontend.hop_length + 1
+        if n_frames <= 0:
+            return torch.zeros(1, self.frontend.fb.shape[0], 0)
+        used = (n_frames - 1) * self.frontend.hop_length + self.frontend.n_fft
+        features = self.frontend.frames_to_log_mel(self.buffer[:used].view(1, 1, -1))
+        self.buffer = self.buffer[n_frames * self.frontend.hop_length:]
+        return self._normalize(features)
+
+
+class StreamingClassifier:
+    """
+    Classificazione incrementale: feature mel, encoder Jasper con cache per strato e media
+    cumulativa dei frame dell'encoder (il pooling del decoder), quindi una posterior a ogni blocco.
+    Con le statistiche di normalizzazione della clip il risultato finale coincide con quello a clip intera.
+    """
+
+    def __init__(self, model, labels=None, frontend=None):
+        model.eval()
+        self.frontend = frontend or build_frontend(model, model.cfg.sample_rate)
+        self.mel = StreamingMel(self.frontend)
+        self.blocks = [StreamingBlock(block) for block in model.encoder.encoder]
+        self.decoder = model.decoder
+        self.labels = list(labels if labels is not None else model.cfg.labels)
+        self.sample_rate = model.cfg.sample_rate
+        self.reset()
+
+    @property
+    def lookahead_ms(self):
+        """Ritardo algoritmico: meta' finestra FFT piu' il contesto destro di ogni convoluzione."""
+        frames = sum(layer.right_pad for block in self.blocks for layer in block.layers if isinstance(layer, StreamingConv))
+        samples = self.frontend.n_fft // 2 + frames * self.frontend.hop_length
+        return 1000.0 * samples / self.sample_rate
+
+    def reset(self, stats=None):
+        self.mel.reset(stats)
+        for block in self.blocks:
+            block.reset()
+        self.encoded_sum = None
+        self.frames = 0
+
+    def step(self, samples, final=False):
+        """Elabora un blocco di audio; restituisce la posterior corrente [num_classes] o None se non ci sono frame."""
+        with torch.inference_mode():
+            out = self.mel.step(samples, final)
+            for block in self.blocks:
+                out = block.step(out, final)
+            if out.shape[2] > 0:
+                chunk_sum = out.sum(dim=2)
+                self.encoded_sum = chunk_sum if self.encoded_sum is None else self.encoded_sum + chunk_sum
+                self.frames += out.shape[2]
+            if self.frames == 0:
+                return None
+            logits = self.decoder.decoder_layers(self.encoded_sum / self.frames)
+            return torch.softmax(logits, dim=1)[0].float().numpy()
+
+    def finish(self):
+        """Chiude il flusso (padding destro di STFT e convoluzioni) e restituisce la posterior finale."""
+        return self.step(np.zeros(0, dtype=np.float32), final=True)
+
+    def label_for(self, posterior):
+        return self.labels[int(np.argmax(posterior))]
+
+    def run(self, signal, chunk_size, stats=None):
+        """Elabora una clip intera a blocchi di chunk_size campioni; restituisce le posterior dopo ogni blocco."""
+        self.reset(stats)
+        posteriors = [self.step(signal[start:start + chunk_size]) for start in range(0, len(signal), chunk_size)]
+        posteriors.append(self.finish())
+        return posteriors
+
+
+def clip_feature_stats(frontend, signal):
+    """Media e deviazione per feature della clip intera, calcolate come nella normalizzazione di NeMo."""
+    audio = torch.as_tensor(signal, dtype=torch.float32).view(1, -1)
+    with torch.inference_mode():
+        features = frontend.log_mel(audio, torch.tensor([audio.shape[1]]))[0]
+    features = features[:, :int(frontend.get_seq_len(torch.tensor(audio.shape[1])))]
+    return features.mean(dim=1), features.std(dim=1) + NORMALIZE_EPS
+
+
+def average_feature_stats(frontend, signals):
+    """Statistiche fisse per lo streaming: media delle statistiche per clip su un insieme di clip."""
+    stats = [clip_feature_stats(frontend, signal) for signal in signals]
+    return torch.stack([mean for mean, _ in stats]).mean(dim=0), torch.stack([std for _, std in stats]).mean(dim=0)
@@ -0,0 +1,240 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Limiti superiori (secondi) degli istogrammi di latenza: da 0.5 ms a 10 s
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+class Counter:
+    """Contatore monotono, una serie per combinazione di etichette."""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self, extra=()):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}"
+
+
+class Histogram:
+    """Istogramma cumulativo a bucket fissi (somma, conteggio e bucket come in Prometheus)."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self, extra=()):
+        with self._lock:
+            series = {key: (list(counts), total) for key, (counts, total) in self._series.items()}
+        for key, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [*extra, ("le", _format_value(bound))])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key, extra)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Gauge:
+    """Valore letto al momento dello scrape da una funzione (ad esempio la profondita' di una coda)."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, read):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+
+    def samples(self, extra=()):
+        yield f"{self.name}{_format_labels((), (), extra)} {_format_value(self.read())}"
+
+
+class Registry:
+    """Insieme di metriche esportate nel formato testuale di Prometheus (GET /metrics)."""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics = []
+        # Etichette aggiunte a ogni serie (ad esempio il worker pre-fork che le ha prodotte)
+        self.const_labels = {}
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, read):
+        return self.register(Gauge(name, documentation, read))
+
+    def snapshot(self):
+        """Righe di ogni metrica di questo processo: {nome: [righe]}, con le etichette costanti."""
+        extra = sorted(self.const_labels.items())
+        return {metric.name: list(metric.samples(extra)) for metric in self._metrics}
+
+    def render(self, others=()):
+        """Testo Prometheus con le serie di questo processo e quelle degli snapshot `others` (altri worker)."""
+        own = self.snapshot()
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(own[metric.name])
+            for snapshot in others:
+                lines.extend(snapshot.get(metric.name, ()))
+        return "\n".join(lines) + "\n"
+
+
+class SharedSnapshots:
+    """
+    Metriche dei worker pre-fork: ogni processo ha il proprio Registry (copiato al fork). Un thread
+    scrive ogni `interval_s` secondi lo snapshot del processo in `directory`, e /metrics aggiunge alle
+    proprie serie quelle degli altri worker: ogni scrape vede tutti i worker, distinti dall'etichetta worker.
+    """
+
+    def __init__(self, registry, directory, name, interval_s=1.0):
+        self.registry = registry
+        self.directory = directory
+        self.path = os.path.join(directory, f"{name}.json")
+        self.interval_s = interval_s
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self):
+        # Scrittura atomica: chi legge vede sempre uno snapshot completo
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.registry.snapshot(), f)
+        os.replace(tmp_path, self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            self.write()
+
+    def start(self):
+        self.write()
+        self._thread = threading.Thread(target=self._run, name="metrics-snapshot", daemon=True)
+        self._thread.start()
+        return self
+
+    def others(self):
+        """Ultimi snapshot degli altri worker (quelli illeggibili o in scrittura vengono saltati)."""
+        snapshots = []
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(".json") or path == self.path:
+                continue
+            try:
+                with open(path, 'r') as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval_s * 2)
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+@contextmanager
+def timed(histogram, **labels):
+    """Misura la durata del blocco e la registra nell'istogramma."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+class JsonFormatter(logging.Formatter):
+    """Una riga JSON per evento: messaggio, livello, tempo e i campi passati con extra={'fields': {...}}."""
+
+    def format(self, record):
+        entry = {'time': round(record.created, 3), 'level': record.levelname, 'event': record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(name, level="INFO"):
+    """
+    Logger strutturato: i thread delle richieste accodano il record e un thread separato lo scrive
+    su stderr. Con level "OFF" il logger e' disattivato e ogni chiamata si ferma al controllo del livello.
+    """
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.handlers.clear()
+    if str(level).upper() == "OFF":
+        logger.disabled = True
+        return logger, None
+    logger.disabled = False
+    logger.setLevel(str(level).upper())
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter())
+    records = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    return logger, listener
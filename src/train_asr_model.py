@@ -1,144 +1,211 @@
 import time
 start_time = time.time()
 
-import os
+import glob
 import json
+import os
+import argparse
 import pytorch_lightning as pl
+from pytorch_lightning.callbacks import EarlyStopping, ModelCheckpoint
 from omegaconf import OmegaConf
 from nemo.collections.asr.models import EncDecClassificationModel
-from nemo.collections.asr.metrics.wer import word_error_rate
-from difflib import SequenceMatcher
 
 import torch
-import subprocess
-
-# Esegui il primo script di data augmentation
-script1 = 'data_augmentation.py'
-result1 = subprocess.run(['python3', script1], capture_output=True, text=True)
-print(f"Uscita di {script1}:\n{result1.stdout}")
-if result1.stderr:
-    print(f"Errori di {script1}:\n{result1.stderr}")
-
-# Imposta alta precisione per le moltiplicazioni
-torch.set_float32_matmul_precision('high')
-
-# Carica il file di configurazione aggiornato
-cfg = OmegaConf.load("../config.yaml")
-
-# Imposta il manifest per il training e la validazione
-cfg.model.train_ds.manifest_filepath = "../train_manifest_augmented.json"
-cfg.model.validation_ds.manifest_filepath = "../val_manifest.json"
-
-
-def calculate_cer(hypotheses, references):
+from feature_cache import cached_features, prepare_caches
+from augment_transform import enable_online_augmentation
+from validation_metrics import ValidationMetricsCallback
+from training_callbacks import EpochTimer
+from trainer_profiles import PROFILES, configure_rendezvous, is_launcher_process, trainer_kwargs
+from manifest import TRAIN_MANIFEST, VAL_MANIFEST, build_manifests
+from data_augmentation import AUGMENTED_MANIFEST, INPUT_DIR, OUTPUT_DIR, timed_augment
+
+CONFIG_PATH = "../config.yaml"
+MODEL_PATH = "../asr_model2.nemo"
+# Metrica per checkpoint migliori e stop anticipato (registrata da NeMo a ogni validazione)
+MONITOR = "val_epoch_top@1"
+# File scritti da ModelCheckpoint in checkpoint_dir (migliori e ultimo)
+CHECKPOINT_PATTERNS = ("asr-*.ckpt", "last*.ckpt")
+# Opzioni del training che ha scritto i checkpoint: con la cache delle feature cambiano le chiavi dello state_dict
+RUN_FILE = "run.json"
+
+
+def load_run_options(checkpoint_dir):
+    run_path = os.path.join(checkpoint_dir, RUN_FILE)
+    if not os.path.exists(run_path):
+        return None
+    with open(run_path, 'r') as f:
+        return json.load(f)
+
+
+def save_run_options(checkpoint_dir, options):
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    run_path = os.path.join(checkpoint_dir, RUN_FILE)
+    with open(run_path + '.tmp', 'w') as f:
+        json.dump(options, f)
+    os.replace(run_path + '.tmp', run_path)
+
+
+def prepare_data(online_augment=False, workers=None, seed=0):
+    """Manifest degli originali e (senza augmentation online) file aumentati, nello stesso processo."""
+    build_manifests(seed=seed)
+    if not online_augment:
+        # Solo i file di training: nessun parlante di validazione nel manifest aumentato
+        timed_augment(INPUT_DIR, OUTPUT_DIR, AUGMENTED_MANIFEST, workers or os.cpu_count(), seed,
+                      source_manifest=TRAIN_MANIFEST)
+
+
+def build_config(online_augment=False, config_path=CONFIG_PATH):
+    """Config del modello con i manifest di training (aumentato o originale) e validazione."""
+    cfg = OmegaConf.load(config_path)
+    cfg.model.train_ds.manifest_filepath = TRAIN_MANIFEST if online_augment else AUGMENTED_MANIFEST
+    cfg.model.validation_ds.manifest_filepath = VAL_MANIFEST
+    return cfg
+
+
+def train(cfg, feature_cache=None, online_augment=False, profile="gpu", ranks=None, num_nodes=1,
+          checkpoint_dir="checkpoints", save_top_k=3, patience=10, resume=True):
     """
-    Calculate Character Error Rate (CER) given hypotheses and references.
-    CER = (S + D + I) / N
-    where:
-        S = number of substitutions
-        D = number of deletions
-        I = number of insertions
-        N = total number of characters in the reference
+    Addestra il modello con checkpoint, stop anticipato e ripresa da last.ckpt.
+    Restituisce (modello, trainer): il modello contiene i pesi del checkpoint migliore.
     """
-    total_chars = 0
-    total_errors = 0
-
-    for hyp, ref in zip(hypotheses, references):
-        total_chars += len(ref)
-        matcher = SequenceMatcher(None, ref, hyp)
-        total_errors += sum([tag[1] for tag in matcher.get_opcodes() if tag[0] != 'equal'])
-
-    cer = total_errors / total_chars if total_chars > 0 else 0
-    return cer
-
-class WERandCERCallback(pl.Callback):
-    def __init__(self, val_manifest):
-        super().__init__()
-        self.val_manifest = val_manifest
-
-    def on_validation_end(self, trainer, pl_module):
-        # Carica il manifest di validazione
-        with open(self.val_manifest, 'r') as f:
-            val_data = [json.loads(line) for line in f]
-
-        predictions = []
-        ground_truths = []
-
-        # Genera trascrizioni per ciascun file
-        for item in val_data:
-            audio_path = item["audio_filepath"]
-            ground_truth = item["label"]
-
-            # Ottieni la predizione dal modello
-            predicted_text = pl_module.transcribe([audio_path])[0]
-
-            # Debug: verifica il tipo di predizione
-            print(f"Raw Predicted Text: {predicted_text} (Type: {type(predicted_text)})")
-
-            # Converti in stringa, se necessario
-            if isinstance(predicted_text, int):  # Caso indice numerico
-                predicted_text = pl_module.labels[predicted_text]
-            elif isinstance(predicted_text, list):  # Caso lista di indici
-                predicted_text = " ".join(map(str, predicted_text))
-            elif isinstance(predicted_text, torch.Tensor):  # Caso tensore
-                predicted_text = " ".join(map(str, predicted_text.cpu().numpy()))
-
-            predictions.append(predicted_text)
-            ground_truths.append(str(ground_truth))
-
-        # Debug: verifica il contenuto delle liste
-        print("Predictions:", predictions)
-        print("Ground Truths:", ground_truths)
-
-        # Verifica che tutti gli elementi siano stringhe
-        assert all(isinstance(p, str) for p in predictions), "All predictions must be strings"
-        assert all(isinstance(g, str) for g in ground_truths), "All ground truths must be strings"
-
-        # Calcola WER e CER
-        wer = word_error_rate(hypotheses=predictions, references=ground_truths)
-        cer = calculate_cer(predictions, ground_truths)
-
-        print(f"Validation WER: {wer:.2f}")
-        print(f"Validation CER: {cer:.2f}")
-
-
-trainer = pl.Trainer(
-    max_epochs=cfg.trainer.max_epochs,
-    accelerator=cfg.trainer.accelerator,
-    devices=cfg.trainer.devices,
-    callbacks=[],
-    logger=False
-)
-
-# Inizializza il modello di classificazione
-asr_model = EncDecClassificationModel(cfg=cfg.model)
-
-# Imposta i dati di addestramento e validazione
-asr_model.setup_training_data(train_data_config=cfg.model.train_ds)
-asr_model.setup_validation_data(val_data_config=cfg.model.validation_ds)
-
-# Avvia l'addestramento
-trainer.fit(asr_model)
-
-# Valuta il modello dopo l'addestramento
-trainer.validate(asr_model)
-
-# Salva il modello addestrato
-model_save_path = "../asr_model2.nemo"
-asr_model.save_to(model_save_path)
-
-print(f"Training completato, modello salvato in {model_save_path}")
-
-# Esegui il secondo script
-script2 = 'evaluate_model.py'
-result2 = subprocess.run(['python3', script2], capture_output=True, text=True)
-print(f"Uscita di {script2}:\n{result2.stdout}")
-if result2.stderr:
-    print(f"Errori di {script2}:\n{result2.stderr}")
-
-
-# Calcola e stampa il tempo totale
-end_time = time.time()
-elapsed_time = end_time - start_time
-print("---")
-print(f"Tempo totale di esecuzione: {elapsed_time:.2f} secondi")
\ No newline at end of file
+    # Imposta alta precisione per le moltiplicazioni
+    torch.set_float32_matmul_precision('high')
+
+    # Top-1, matrice di confusione, WER e CER per epoca dai logits del loop di validazione
+    validation_metrics = ValidationMetricsCallback(cfg.model.labels)
+    epoch_timer = EpochTimer()
+
+    # Checkpoint a ogni epoca (last.ckpt per la ripresa) e i save_top_k migliori per accuratezza di validazione
+    checkpoint = ModelCheckpoint(
+        dirpath=checkpoint_dir,
+        filename="asr-{epoch:02d}-{val_epoch_top@1:.4f}",
+        monitor=MONITOR,
+        mode="max",
+        save_top_k=save_top_k,
+        save_last=True,
+        auto_insert_metric_name=False,
+    )
+    callbacks = [validation_metrics, checkpoint, epoch_timer]
+    if patience > 0:
+        callbacks.append(EarlyStopping(monitor=MONITOR, mode="max", patience=patience))
+
+    # Un last.ckpt rimasto indica un training interrotto: si riprende da li' (pesi, ottimizzatore, epoca)
+    last_checkpoint = os.path.join(checkpoint_dir, "last.ckpt")
+    resume_from = last_checkpoint if os.path.exists(last_checkpoint) and resume else None
+    # Si riprende solo con le stesse opzioni: un last.ckpt scritto con (o senza) --feature-cache non si carica
+    # nel modello dell'altra modalita', perche' PrecomputedFeatures sostituisce il preprocessor
+    run_options = {'feature_cache': bool(feature_cache), 'profile': profile}
+    if resume_from and load_run_options(checkpoint_dir) != run_options:
+        if is_launcher_process():
+            print(f"[INFO] {resume_from} e' stato scritto con opzioni diverse da {run_options}: training nuovo")
+        resume_from = None
+    # Con save_top_k = 0 non c'e' un checkpoint migliore: si valuta l'ultima epoca
+    best_checkpoint = "best" if save_top_k != 0 else None
+    if resume_from and is_launcher_process():
+        print(f"[INFO] Ripresa del training da {resume_from}")
+    elif is_launcher_process():
+        # Training nuovo: i checkpoint di un'esecuzione precedente non devono finire nel top-k ne' in "best"
+        stale = [path for pattern in CHECKPOINT_PATTERNS for path in glob.glob(os.path.join(checkpoint_dir, pattern))]
+        for path in stale:
+            os.remove(path)
+        if stale:
+            print(f"[INFO] Rimossi {len(stale)} checkpoint di un training precedente da {checkpoint_dir}")
+    if is_launcher_process():
+        # Letto alla prossima esecuzione (e dagli altri rank, avviati da trainer.fit) per decidere se riprendere
+        save_run_options(checkpoint_dir, run_options)
+
+    trainer = pl.Trainer(
+        max_epochs=cfg.trainer.max_epochs,
+        **trainer_kwargs(cfg, profile, ranks, num_nodes),
+        callbacks=callbacks,
+        logger=False
+    )
+
+    # Inizializza il modello di classificazione
+    asr_model = EncDecClassificationModel(cfg=cfg.model)
+
+    if feature_cache:
+        # Feature calcolate una sola volta: niente decodifica audio ne' STFT a ogni epoca
+        train_cache, val_cache = prepare_caches(cfg, feature_cache)
+        with cached_features(asr_model, train_cache, val_cache, cfg.model.train_ds, cfg.model.validation_ds):
+            trainer.fit(asr_model, ckpt_path=resume_from)
+            # Valuta (e tiene nel modello) i pesi del checkpoint migliore
+            trainer.validate(asr_model, ckpt_path=best_checkpoint)
+    else:
+        # Imposta i dati di addestramento e validazione
+        asr_model.setup_training_data(train_data_config=cfg.model.train_ds)
+        asr_model.setup_validation_data(val_data_config=cfg.model.validation_ds)
+        if online_augment:
+            # Rumore, time shift, pitch e filtri nuovi a ogni epoca, senza file su disco
+            enable_online_augmentation(asr_model)
+
+        # Avvia l'addestramento (o riprende quello interrotto)
+        trainer.fit(asr_model, ckpt_path=resume_from)
+
+        # Valuta il modello dopo l'addestramento: i pesi del checkpoint migliore restano nel modello salvato
+        trainer.validate(asr_model, ckpt_path=best_checkpoint)
+
+    if trainer.is_global_zero:
+        # Training concluso: il last.ckpt non serve piu' alla ripresa, restano i checkpoint migliori
+        if os.path.exists(last_checkpoint):
+            os.remove(last_checkpoint)
+        epochs_run = len(epoch_timer.durations)
+        skipped = cfg.trainer.max_epochs - trainer.current_epoch
+        if epochs_run and skipped > 0:
+            epoch_time = sum(epoch_timer.durations) / epochs_run
+            print(f"[TEMPO] Stop anticipato all'epoca {trainer.current_epoch} su {cfg.trainer.max_epochs}: "
+                  f"{skipped} epoche da {epoch_time:.2f} s evitate, circa {skipped * epoch_time:.0f} s risparmiati")
+        print(f"[INFO] Checkpoint migliore: {checkpoint.best_model_path} ({MONITOR} = {float(checkpoint.best_model_score or 0):.4f})")
+    return asr_model, trainer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Addestramento del modello di classificazione dei comandi vocali.")
+    parser.add_argument("--feature-cache", metavar="DIR", default=None,
+                        help="Usa le feature log-mel precalcolate in DIR (costruite se mancanti o non aggiornate)")
+    parser.add_argument("--online-augment", action="store_true",
+                        help="Augmentation a batch nel DataLoader invece dei file generati da data_augmentation.py")
+    parser.add_argument("--checkpoint-dir", default="checkpoints", help="Checkpoint periodici e migliori")
+    parser.add_argument("--save-top-k", type=int, default=3, help="Checkpoint migliori conservati secondo val_epoch_top@1")
+    parser.add_argument("--patience", type=int, default=10,
+                        help="Epoche senza miglioramenti di val_epoch_top@1 prima dello stop anticipato (0 = mai)")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Ignora last.ckpt lasciato da un training interrotto e riparte da zero")
+    parser.add_argument("--profile", choices=PROFILES, default="gpu",
+                        help="gpu: sezione trainer del config; cpu: trainer_cpu, data-parallel su piu' processi (gloo)")
+    parser.add_argument("--ranks", type=int, default=None, help="Processi data-parallel per macchina (profilo cpu)")
+    parser.add_argument("--num-nodes", type=int, default=1, help="Macchine che partecipano al training (profilo cpu)")
+    parser.add_argument("--node-rank", type=int, default=0, help="Indice di questa macchina (0 = nodo principale)")
+    parser.add_argument("--master-addr", default=None, help="Indirizzo del nodo 0 per il rendezvous")
+    parser.add_argument("--master-port", type=int, default=29500)
+    args = parser.parse_args()
+    if args.online_augment and args.feature_cache:
+        # Le feature in cache sono calcolate sull'audio originale: l'augmentation non avrebbe effetto
+        parser.error("--online-augment non e' compatibile con --feature-cache")
+
+    configure_rendezvous(args.num_nodes, args.node_rank, args.master_addr, args.master_port)
+    # Con piu' rank Lightning riesegue lo script in ogni processo: i dati si preparano una volta sola
+    # (con piu' macchine i manifest e l'audio devono trovarsi sugli stessi percorsi in ogni nodo)
+    if is_launcher_process():
+        # Manifest e data augmentation nello stesso processo (con --online-augment bastano i manifest)
+        prepare_data(args.online_augment)
+
+    cfg = build_config(args.online_augment)
+    asr_model, trainer = train(cfg, args.feature_cache, args.online_augment, args.profile, args.ranks, args.num_nodes,
+                               args.checkpoint_dir, args.save_top_k, args.patience, resume=not args.no_resume)
+
+    if trainer.is_global_zero:
+        # Salva il modello addestrato (solo il rank 0)
+        asr_model.save_to(MODEL_PATH)
+        print(f"Training completato, modello salvato in {MODEL_PATH}")
+
+        # Valutazione nello stesso processo sul modello in memoria, senza ricaricarlo dal .nemo
+        from evaluate_model import ASRInference
+
+        ASRInference(MODEL_PATH, VAL_MANIFEST, model=asr_model).display_results()
+
+    # Calcola e stampa il tempo totale
+    end_time = time.time()
+    elapsed_time = end_time - start_time
+    print("---")
+    print(f"Tempo totale di esecuzione: {elapsed_time:.2f} secondi")
\ No newline at end of file
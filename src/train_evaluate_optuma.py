@@ -1,175 +1,254 @@
 import time
 start_time = time.time()
 
+import copy
+import os
 import optuna
 import pytorch_lightning as pl
+import torch
 from nemo.collections.asr.models import EncDecClassificationModel
 from omegaconf import OmegaConf
-import subprocess
+from feature_cache import cached_features, prepare_caches
+from trainer_profiles import PROFILES, trainer_kwargs
+from functools import partial
+from multiprocessing import get_context
+import argparse
+
+# Studio persistente: il file SQLite del repository sopravvive a crash e interruzioni.
+# Lo studio 'ASR_Hyperparameter_Optimization' gia' presente minimizza una loss con un altro
+# spazio di ricerca, quindi questa ricerca (che massimizza val_epoch_top@1) usa un nome proprio
+STORAGE_URL = "sqlite:///../asr_study.db"
+STUDY_NAME = "ASR_Hyperparameter_Optimization_top1"
+MONITOR = "val_epoch_top@1"
+
+# Configurazione iniziale dell'encoder: i layer suggeriti da Optuna vengono aggiunti a questi due
+BASE_JASPER = [
+    {
+        'filters': 64,
+        'repeat': 1,
+        'kernel': [11],
+        'stride': [1],
+        'dilation': [1],
+        'dropout': 0.3,
+        'residual': False
+    },
+    {
+        'filters': 128,
+        'repeat': 1,
+        'kernel': [13],
+        'stride': [1],
+        'dilation': [1],
+        'dropout': 0.3,
+        'residual': True
+    }
+]
 
-# Load the configuration file
-cfg = OmegaConf.load("../config.yaml")
 
-def objective(trial):
-    # Suggerisci iperparametri
-    learning_rate = trial.suggest_float('learning_rate', 1e-5, 1e-3, log=True)
-    batch_size = trial.suggest_categorical('batch_size', [16, 32, 64])
-    dropout = trial.suggest_float('dropout', 0.1, 0.5)
-    num_layers = trial.suggest_int('num_layers', 2, 5)
-    filters = trial.suggest_categorical('filters', [64, 128, 256])
-    kernel_size = trial.suggest_int('kernel_size', 3, 11, step=2)
-
-    # Ripristina la configurazione iniziale dell'encoder se necessario (per evitare accumuli di layer tra trial)
-    # È importante perché stai appendendo i layer ad ogni trial. Assicurati che l'encoder parta sempre dallo stato iniziale.
-    # Ad esempio, se la config iniziale ha già due layer, rimuovi i layer aggiunti nei trial precedenti:
-    base_jasper = [
-        {
-            'filters': 64,
-            'repeat': 1,
-            'kernel': [11],
-            'stride': [1],
-            'dilation': [1],
-            'dropout': 0.3,
-            'residual': False
-        },
-        {
-            'filters': 128,
-            'repeat': 1,
-            'kernel': [13],
-            'stride': [1],
-            'dilation': [1],
-            'dropout': 0.3,
-            'residual': True
-        }
-    ]
+def get_storage(url=STORAGE_URL):
+    # Piu' processi scrivono sullo stesso file: attesa sul lock invece dell'errore immediato.
+    # Con l'heartbeat i trial rimasti RUNNING dopo un crash vengono segnati FAIL alla ripresa
+    return optuna.storages.RDBStorage(url, heartbeat_interval=60, grace_period=180,
+                                      engine_kwargs={"connect_args": {"timeout": 60}})
+
+
+def build_pruner(name, max_epochs):
+    if name == "hyperband":
+        return optuna.pruners.HyperbandPruner(min_resource=1, max_resource=max_epochs, reduction_factor=3)
+    if name == "median":
+        # Nessun pruning nei primi trial e nelle prime epoche, quando l'accuratezza e' ancora rumorosa
+        return optuna.pruners.MedianPruner(n_startup_trials=3, n_warmup_steps=5)
+    return optuna.pruners.NopPruner()
 
-    # Ripristina la configurazione iniziale
-    cfg.model.encoder.jasper = base_jasper
 
-    # Imposta gli iperparametri scelti da Optuna
-    cfg.model.optim.lr = learning_rate
-    cfg.model.train_ds.batch_size = batch_size
+def apply_params(cfg, params):
+    """Copia di cfg con gli iperparametri del trial (lr, batch, layer aggiuntivi dell'encoder)."""
+    cfg = copy.deepcopy(cfg)
+    cfg.model.optim.lr = params['learning_rate']
+    cfg.model.train_ds.batch_size = params['batch_size']
 
-    # Aggiungi i nuovi layer all'encoder
-    for i in range(num_layers):
+    # Parte sempre dalla configurazione iniziale, per evitare accumuli di layer tra trial
+    cfg.model.encoder.jasper = copy.deepcopy(BASE_JASPER)
+    for i in range(params['num_layers']):
         cfg.model.encoder.jasper.append({
-            'filters': filters,
+            'filters': params['filters'],
             'repeat': 1,
-            'kernel': [kernel_size],
+            'kernel': [params['kernel_size']],
             'stride': [1],
             'dilation': [1],
-            'dropout': dropout,
+            'dropout': params['dropout'],
             'residual': True if i > 0 else False,
             'activation': 'relu',
         })
 
     # Il numero di filtri finali dell'encoder sarà l'ultimo 'filters' aggiunto
-    final_filters = filters
-
-    # Aggiorna la dimensione del decoder
-    cfg.model.decoder.feat_in = final_filters
+    cfg.model.decoder.feat_in = params['filters']
+    return cfg
+
+
+def fit_model(cfg, model, trainer, feature_caches=None, validate=False):
+    """Addestra il modello leggendo audio oppure feature precalcolate."""
+    if feature_caches is None:
+        model.setup_training_data(train_data_config=cfg.model.train_ds)
+        model.setup_validation_data(val_data_config=cfg.model.validation_ds)
+        trainer.fit(model)
+        return trainer.validate(model) if validate else None
+    with cached_features(model, *feature_caches, cfg.model.train_ds, cfg.model.validation_ds):
+        trainer.fit(model)
+        return trainer.validate(model) if validate else None
+
+
+class PruningCallback(pl.Callback):
+    """Riporta a Optuna l'accuratezza di validazione di ogni epoca e ferma il training se il trial va potato."""
+
+    def __init__(self, trial, monitor=MONITOR):
+        super().__init__()
+        self.trial = trial
+        self.monitor = monitor
+        self.pruned = False
+
+    def on_validation_end(self, trainer, pl_module):
+        if trainer.sanity_checking or self.monitor not in trainer.callback_metrics:
+            return
+        epoch = trainer.current_epoch
+        self.trial.report(float(trainer.callback_metrics[self.monitor]), step=epoch)
+        if self.trial.should_prune():
+            # L'eccezione viene sollevata dopo fit(): Lightning chiude in modo pulito dataloader e worker
+            self.pruned = True
+            self.trial.set_user_attr("pruned_at_epoch", epoch)
+            trainer.should_stop = True
+
+
+def build_trainer_kwargs(cfg, profile="gpu", accelerator=None):
+    """Argomenti del Trainer di un trial: profilo cpu a un solo rank, con i thread gia' assegnati al worker."""
+    kwargs = trainer_kwargs(cfg, profile, ranks=1, threads=torch.get_num_threads())
+    if accelerator:
+        kwargs['accelerator'] = accelerator
+    return kwargs
+
+
+def objective(trial, cfg, feature_caches=None, accelerator=None, profile="gpu"):
+    # Suggerisci iperparametri
+    params = {
+        'learning_rate': trial.suggest_float('learning_rate', 1e-5, 1e-3, log=True),
+        'batch_size': trial.suggest_categorical('batch_size', [16, 32, 64]),
+        'dropout': trial.suggest_float('dropout', 0.1, 0.5),
+        'num_layers': trial.suggest_int('num_layers', 2, 5),
+        'filters': trial.suggest_categorical('filters', [64, 128, 256]),
+        'kernel_size': trial.suggest_int('kernel_size', 3, 11, step=2),
+    }
+    trial_cfg = apply_params(cfg, params)
 
     # Inizializza il modello con la config aggiornata
-    asr_model = EncDecClassificationModel(cfg=cfg.model)
-
-    # Set up training and validation data
-    asr_model.setup_training_data(train_data_config=cfg.model.train_ds)
-    asr_model.setup_validation_data(val_data_config=cfg.model.validation_ds)
+    asr_model = EncDecClassificationModel(cfg=trial_cfg.model)
 
     # Trainer setup
+    pruning = PruningCallback(trial)
     trainer = pl.Trainer(
-        max_epochs=cfg.trainer.max_epochs,
-        accelerator=cfg.trainer.accelerator,
-        devices=cfg.trainer.devices,
+        max_epochs=trial_cfg.trainer.max_epochs,
+        **build_trainer_kwargs(trial_cfg, profile, accelerator),
+        callbacks=[pruning],
+        logger=False,
+        enable_checkpointing=False,
+    )
+
+    # Train and validate the model: la validazione dell'ultima epoca e' gia' sui pesi finali
+    fit_model(trial_cfg, asr_model, trainer, feature_caches)
+    if pruning.pruned:
+        raise optuna.TrialPruned()
+
+    return float(trainer.callback_metrics[MONITOR])
+
+
+def run_worker(study_name, storage_url, n_trials, pruner, cfg, feature_caches, accelerator, threads, profile="gpu"):
+    """Processo di ricerca: carica lo studio condiviso e prende trial finche' il totale non e' raggiunto."""
+    if threads:
+        torch.set_num_threads(threads)
+    # Il pruner non e' salvato nel database: ogni worker ricostruisce il proprio
+    study = optuna.load_study(study_name=study_name, storage=get_storage(storage_url),
+                              pruner=build_pruner(pruner, cfg.trainer.max_epochs))
+    # Il limite conta anche i trial delle esecuzioni precedenti: una ripresa completa solo quelli mancanti
+    finished = (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)
+    if len(study.get_trials(deepcopy=False, states=finished)) >= n_trials:
+        return
+    max_trials = optuna.study.MaxTrialsCallback(n_trials, states=finished)
+    study.optimize(partial(objective, cfg=cfg, feature_caches=feature_caches, accelerator=accelerator, profile=profile),
+                   callbacks=[max_trials], gc_after_trial=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ricerca degli iperparametri con Optuna.")
+    parser.add_argument("--feature-cache", metavar="DIR", default=None,
+                        help="Usa le feature log-mel precalcolate in DIR, condivise da tutti i trial")
+    parser.add_argument("--storage", default=STORAGE_URL, help="Database dello studio Optuna")
+    parser.add_argument("--study-name", default=STUDY_NAME)
+    parser.add_argument("--n-trials", type=int, default=15, help="Trial totali dello studio, incluse le esecuzioni precedenti")
+    parser.add_argument("--workers", type=int, default=1, help="Processi che eseguono trial in parallelo")
+    parser.add_argument("--pruner", choices=["median", "hyperband", "none"], default="median")
+    parser.add_argument("--accelerator", default=None, help="Sovrascrive trainer.accelerator del config (es. cpu)")
+    parser.add_argument("--profile", choices=PROFILES, default="gpu",
+                        help="cpu: precisione di trainer_cpu e un rank per trial (i trial sono gia' paralleli)")
+    args = parser.parse_args()
+
+    # Load the configuration file
+    cfg = OmegaConf.load("../config.yaml")
+
+    # Il preprocessor non cambia tra i trial: le feature si calcolano una volta sola
+    feature_caches = prepare_caches(cfg, args.feature_cache) if args.feature_cache else None
+
+    # Crea lo studio o lo riprende dal database
+    study = optuna.create_study(
+        study_name=args.study_name,
+        storage=get_storage(args.storage),
+        direction="maximize",
+        load_if_exists=True,
+    )
+    done = len(study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)))
+    print(f"[INFO] Studio '{args.study_name}': {done} trial gia' conclusi su {args.n_trials}")
+
+    # Ogni worker usa una quota dei core, per non sovrascrivere i thread degli altri
+    threads = max(1, (os.cpu_count() or 1) // args.workers) if args.workers > 1 else None
+    worker_args = (args.study_name, args.storage, args.n_trials, args.pruner, cfg, feature_caches, args.accelerator,
+                   threads, args.profile)
+    if args.workers > 1:
+        # spawn: ogni processo inizializza torch e CUDA da zero
+        context = get_context("spawn")
+        workers = [context.Process(target=run_worker, args=worker_args) for _ in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        run_worker(*worker_args)
+
+    # I trial sono stati aggiunti dai worker: lo studio va riletto dal database
+    study = optuna.load_study(study_name=args.study_name, storage=get_storage(args.storage))
+    print(f"Best hyperparameters: {study.best_params}")
+    print(f"Best validation score: {study.best_value}")
+
+    # Ripeti la procedura per il modello finale con i migliori parametri
+    final_cfg = apply_params(cfg, study.best_params)
+    final_model = EncDecClassificationModel(cfg=final_cfg.model)
+
+    final_trainer = pl.Trainer(
+        max_epochs=final_cfg.trainer.max_epochs,
+        **build_trainer_kwargs(final_cfg, args.profile, args.accelerator),
         callbacks=[],
         logger=False
     )
 
-    # Train the model
-    trainer.fit(asr_model)
-
-    # Validate the model
-    metrics = trainer.validate(asr_model)
-
-    return metrics[0]['val_epoch_top@1']
-
-# Create and run an Optuna study
-study = optuna.create_study(direction="maximize")
-study.optimize(objective, n_trials=15)
-
-print(f"Best hyperparameters: {study.best_params}")
-print(f"Best validation score: {study.best_value}")
+    fit_model(final_cfg, final_model, final_trainer, feature_caches)
 
-# Aggiorna la config con i migliori parametri
-cfg.model.optim.lr = study.best_params['learning_rate']
-cfg.model.train_ds.batch_size = study.best_params['batch_size']
+    final_model_path = "../optimized_asr_model.nemo"
+    final_model.save_to(final_model_path)
+    print(f"Final model saved at {final_model_path}")
 
-# Ripeti la procedura per il modello finale
-base_jasper = [
-    {
-        'filters': 64,
-        'repeat': 1,
-        'kernel': [11],
-        'stride': [1],
-        'dilation': [1],
-        'dropout': 0.3,
-        'residual': False
-    },
-    {
-        'filters': 128,
-        'repeat': 1,
-        'kernel': [13],
-        'stride': [1],
-        'dilation': [1],
-        'dropout': 0.3,
-        'residual': True
-    }
-]
+    # Valutazione nello stesso processo, sul modello appena addestrato (senza ricaricarlo dal .nemo)
+    from evaluate_model import ASRInference
 
-cfg.model.encoder.jasper = base_jasper
-num_layers = study.best_params['num_layers']
-filters = study.best_params['filters']
-kernel_size = study.best_params['kernel_size']
-dropout = study.best_params['dropout']
+    ASRInference(final_model_path, final_cfg.model.validation_ds.manifest_filepath, model=final_model).display_results()
 
-for i in range(num_layers):
-    cfg.model.encoder.jasper.append({
-        'filters': filters,
-        'repeat': 1,
-        'kernel': [kernel_size],
-        'stride': [1],
-        'dilation': [1],
-        'dropout': dropout,
-        'residual': True if i > 0 else False,
-        'activation': 'relu',
-    })
-
-final_filters = filters
-cfg.model.decoder.feat_in = final_filters
-
-final_model = EncDecClassificationModel(cfg=cfg.model)
-final_model.setup_training_data(train_data_config=cfg.model.train_ds)
-final_model.setup_validation_data(val_data_config=cfg.model.validation_ds)
-
-final_trainer = pl.Trainer(
-    max_epochs=cfg.trainer.max_epochs,
-    accelerator=cfg.trainer.accelerator,
-    devices=cfg.trainer.devices,
-    callbacks=[],
-    logger=False
-)
-
-final_trainer.fit(final_model)
-
-final_model_path = "../optimized_asr_model.nemo"
-final_model.save_to(final_model_path)
-print(f"Final model saved at {final_model_path}")
-
-evaluation_script = "evaluate_model.py"
-subprocess.run(["python3", evaluation_script], check=True)
-
-# Calcola e stampa il tempo totale
-end_time = time.time()
-elapsed_time = end_time - start_time
-print("---")
-print(f"Tempo totale di esecuzione: {elapsed_time:.2f} secondi")
\ No newline at end of file
+    # Calcola e stampa il tempo totale
+    end_time = time.time()
+    elapsed_time = end_time - start_time
+    print("---")
+    print(f"Tempo totale di esecuzione: {elapsed_time:.2f} secondi")
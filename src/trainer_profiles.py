@@ -0,0 +1,64 @@
+import os
+
+import torch
+
+PROFILES = ("gpu", "cpu")
+
+
+def bf16_supported():
+    """bf16 conviene su CPU solo con istruzioni native (AVX512-BF16 / AMX), altrimenti e' emulato."""
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def is_launcher_process():
+    """
+    Vero nel processo avviato dall'utente (rank globale 0). Con la strategia ddp Lightning riesegue lo
+    script per ogni rank locale con LOCAL_RANK impostato: preparazione dei dati e salvataggi vanno fatti una volta.
+    """
+    return all(int(os.environ.get(name, 0)) == 0 for name in ("LOCAL_RANK", "NODE_RANK", "RANK"))
+
+
+def configure_rendezvous(num_nodes=1, node_rank=0, master_addr=None, master_port=None):
+    """Indirizzo del nodo 0 e rank di questa macchina: Lightning li legge dall'ambiente per il process group."""
+    if num_nodes > 1:
+        os.environ.setdefault("NODE_RANK", str(node_rank))
+        if master_addr:
+            os.environ["MASTER_ADDR"] = master_addr
+        if master_port:
+            os.environ["MASTER_PORT"] = str(master_port)
+
+
+def trainer_kwargs(cfg, profile="gpu", ranks=None, num_nodes=1, threads=None):
+    """
+    Argomenti di pl.Trainer per il profilo scelto.
+
+    "gpu" usa la sezione trainer del config. "cpu" usa trainer_cpu: `ranks` processi data-parallel
+    per macchina (backend gloo), ognuno con `threads` thread intra-op (default threads_per_rank),
+    bf16 misto solo se la CPU lo supporta in modo nativo e `num_nodes` macchine collegate tramite
+    MASTER_ADDR/MASTER_PORT.
+    """
+    if profile == "gpu":
+        return {'accelerator': cfg.trainer.accelerator, 'devices': cfg.trainer.devices}
+    if profile != "cpu":
+        raise ValueError(f"Profilo di training sconosciuto: {profile}")
+
+    cpu = cfg.trainer_cpu
+    threads = min(threads or cpu.threads_per_rank, os.cpu_count() or 1)
+    if ranks is None:
+        ranks = cpu.devices if cpu.devices != "auto" else max(1, (os.cpu_count() or 1) // threads)
+    # Ogni rank usa la propria quota di core: rank x thread = core disponibili
+    torch.set_num_threads(threads)
+    kwargs = {
+        'accelerator': "cpu",
+        'devices': ranks,
+        'num_nodes': num_nodes,
+        'precision': cpu.precision if cpu.precision != "bf16-mixed" or bf16_supported() else "32-true",
+    }
+    if ranks > 1 or num_nodes > 1:
+        from pytorch_lightning.strategies import DDPStrategy
+
+        kwargs['strategy'] = DDPStrategy(process_group_backend="gloo", find_unused_parameters=False)
+    return kwargs
@@ -0,0 +1,18 @@
+import time
+
+import pytorch_lightning as pl
+
+
+class EpochTimer(pl.Callback):
+    """Registra la durata di ogni epoca di training (validazione inclusa)."""
+
+    def __init__(self):
+        super().__init__()
+        self.durations = []
+        self._start = None
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self._start = time.perf_counter()
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        self.durations.append(time.perf_counter() - self._start)
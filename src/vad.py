@@ -0,0 +1,99 @@
+from collections import deque
+
+import numpy as np
+
+
+class EnergyVAD:
+    """
+    Segmentazione di un flusso audio in enunciati in base all'energia dei frame.
+
+    Un frame e' parlato se la sua energia supera sia la soglia assoluta sia il rumore di fondo
+    stimato (media mobile dei frame di silenzio) piu' un margine. Un enunciato inizia dopo
+    `min_speech_ms` di parlato e termina dopo `end_silence_ms` di silenzio, oppure quando
+    raggiunge `max_utterance_s`. Al segmento vengono aggiunti `pre_roll_ms` di audio precedente
+    e `post_roll_ms` di audio successivo, come nelle clip registrate.
+    """
+
+    def __init__(self, sample_rate=16000, frame_ms=20, threshold_db=-45.0, margin_db=10.0,
+                 min_speech_ms=60, end_silence_ms=300, pre_roll_ms=200, post_roll_ms=100, max_utterance_s=3.0):
+        self.sample_rate = sample_rate
+        self.frame_size = int(sample_rate * frame_ms / 1000)
+        self.threshold_db = threshold_db
+        self.margin_db = margin_db
+        self.min_speech_frames = max(1, min_speech_ms // frame_ms)
+        self.end_silence_frames = max(1, end_silence_ms // frame_ms)
+        self.post_roll_frames = min(post_roll_ms // frame_ms, self.end_silence_frames)
+        self.max_frames = int(max_utterance_s * 1000 / frame_ms)
+        self.pre_roll = deque(maxlen=max(1, pre_roll_ms // frame_ms))
+        self.noise_db = None
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._position = 0
+        self._frames = None
+        self._speech_run = 0
+        self._silence_run = 0
+        self._start = 0
+        self._last_speech_end = 0
+
+    def _frame_db(self, frame):
+        return 10 * np.log10(np.mean(frame.astype(np.float64) ** 2) + 1e-10)
+
+    def _is_speech(self, frame_db):
+        if self.noise_db is None:
+            self.noise_db = frame_db
+        threshold = max(self.threshold_db, self.noise_db + self.margin_db)
+        speech = frame_db > threshold
+        if not speech:
+            # Il rumore di fondo si aggiorna solo sui frame di silenzio
+            self.noise_db = 0.95 * self.noise_db + 0.05 * frame_db
+        return speech
+
+    def _emit(self, keep_frames):
+        audio = np.concatenate(self._frames[:keep_frames])
+        segment = (audio, self._start, self._last_speech_end)
+        self._frames = None
+        self._speech_run = 0
+        self._silence_run = 0
+        return segment
+
+    def feed(self, samples):
+        """Aggiunge campioni float32 al flusso; restituisce gli enunciati conclusi come (audio, inizio, fine parlato)."""
+        samples = np.concatenate([self._pending, np.asarray(samples, dtype=np.float32)])
+        n_frames = len(samples) // self.frame_size
+        self._pending = samples[n_frames * self.frame_size:]
+        segments = []
+        for i in range(n_frames):
+            frame = samples[i * self.frame_size:(i + 1) * self.frame_size]
+            frame_start = self._position
+            self._position += self.frame_size
+            speech = self._is_speech(self._frame_db(frame))
+
+            if self._frames is None:
+                # In attesa di parlato: il pre-roll conserva l'inizio della parola
+                self.pre_roll.append(frame)
+                self._speech_run = self._speech_run + 1 if speech else 0
+                if self._speech_run >= self.min_speech_frames:
+                    self._frames = list(self.pre_roll)
+                    self._start = frame_start - (len(self._frames) - 1) * self.frame_size
+                    self._last_speech_end = self._position
+                    self.pre_roll.clear()
+                continue
+
+            self._frames.append(frame)
+            if speech:
+                self._silence_run = 0
+                self._last_speech_end = self._position
+            else:
+                self._silence_run += 1
+            if self._silence_run >= self.end_silence_frames:
+                silence_frames = self._silence_run - self.post_roll_frames
+                segments.append(self._emit(len(self._frames) - silence_frames))
+            elif len(self._frames) >= self.max_frames:
+                segments.append(self._emit(len(self._frames)))
+        return segments
+
+    def flush(self):
+        """Chiude il flusso: restituisce l'enunciato in corso, se presente."""
+        if self._frames is None:
+            return []
+        keep = len(self._frames) - max(0, self._silence_run - self.post_roll_frames)
+        return [self._emit(keep)]
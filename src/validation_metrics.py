@@ -0,0 +1,81 @@
+import pytorch_lightning as pl
+import torch
+
+from asr_metrics import compute_metrics
+
+
+def _dataset_size(trainer):
+    loaders = trainer.val_dataloaders
+    loader = loaders[0] if isinstance(loaders, (list, tuple)) else loaders
+    return len(loader.dataset)
+
+
+def _unpad(gathered, size):
+    """
+    [world_size, campioni per rank] -> campioni nell'ordine del dataset, senza duplicati. DistributedSampler
+    (senza shuffle) assegna al rank r gli indici r, r + world_size, ... e completa l'ultimo giro ripetendo i
+    primi campioni: trasporre ripristina l'ordine, e i duplicati sono gli elementi oltre `size`.
+    """
+    return gathered.reshape(gathered.shape[0], -1).t().flatten()[:size]
+
+
+class ValidationMetricsCallback(pl.Callback):
+    """
+    Top-1, matrice di confusione, WER e CER di ogni epoca calcolati dagli stessi forward del loop
+    di validazione: un hook sul decoder cattura i logits di ogni batch, le etichette arrivano dal batch.
+    Nessuna trascrizione aggiuntiva dei file del manifest.
+    """
+
+    def __init__(self, labels, verbose=False):
+        super().__init__()
+        self.labels = list(labels)
+        self.verbose = verbose
+        self.history = []
+        self._handle = None
+        self._logits = None
+        self._predictions = []
+        self._targets = []
+
+    def _capture(self, module, inputs, output):
+        self._logits = output
+
+    def on_validation_epoch_start(self, trainer, pl_module):
+        self._predictions, self._targets = [], []
+        if self._handle is None:
+            self._handle = pl_module.decoder.register_forward_hook(self._capture)
+
+    def on_validation_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx=0):
+        if self._logits is None:
+            return
+        # Solo indici sul device: nessuna sincronizzazione con la CPU durante il loop
+        self._predictions.append(self._logits.detach().argmax(dim=-1))
+        self._targets.append(batch[2].detach())
+        self._logits = None
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        if self._handle is not None:
+            self._handle.remove()
+            self._handle = None
+        if not self._predictions:
+            return
+        predictions = torch.cat(self._predictions)
+        targets = torch.cat(self._targets)
+        self._predictions, self._targets = [], []
+        if trainer.world_size > 1:
+            # Con DDP ogni processo vede una parte del manifest: le metriche si calcolano sull'unione
+            size = _dataset_size(trainer)
+            predictions = _unpad(pl_module.all_gather(predictions), size)
+            targets = _unpad(pl_module.all_gather(targets), size)
+
+        metrics = compute_metrics(predictions.cpu().numpy(), targets.cpu().numpy(), self.labels)
+        pl_module.log("val_epoch_wer", metrics['wer'])
+        pl_module.log("val_epoch_cer", metrics['cer'])
+        if trainer.sanity_checking or not trainer.is_global_zero:
+            return
+        self.history.append({'epoch': trainer.current_epoch, **metrics})
+        print(f"[INFO] Epoca {trainer.current_epoch}: top-1 {metrics['accuracy']:.2f}% "
+              f"({metrics['correct']}/{metrics['total']})   WER {metrics['wer']:.3f}   CER {metrics['cer']:.3f}")
+        if self.verbose:
+            print(" " * 10 + " ".join(f"{label[:4]:>4}" for label in self.labels))
+            for label, row in zip(self.labels, metrics['confusion_matrix']):
+                print(f"{label:<10}" + " ".join(f"{count:>4}" for count in row))